@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import sys
 import argparse
 import asyncio
 import logging
@@ -11,10 +10,22 @@ import os.path
 import asyncssh
 
 from .asdnotify import AsyncSystemdNotifier
-from .constants import LogLevel
+from .constants import LogLevel, DEST_STATS_SIZE, DNS_CACHE_SIZE, \
+    MAX_BACKOFF, SSH_KEX_ALGS, SSH_ENCRYPTION_ALGS, CHANNEL_WINDOW_MAX, \
+    WINDOW_BUDGET, DRAIN_TIMEOUT, WARMUP_TIMEOUT, HANDOFF_ENV, HANDOFF_GRACE
 from . import utils
+from . import handoff
 from .ssh_pool import SSHPool
-from .ratelimit import Ratelimit
+from .ratelimit import Ratelimit, TokenBucket
+from .balancer import PoolBalancer
+from .deststats import DestinationStats
+from .resolver import Resolver
+from .metricslistener import MetricsListener
+from .baselistener import ListenerGroup
+from .admission import ClientLimiter
+from .shaper import Shaper
+from .window import WindowBudget
+from .routing import Router
 
 
 def parse_args():
@@ -29,6 +40,13 @@ def parse_args():
                         default=22,
                         type=utils.check_port,
                         help="target port")
+    parser.add_argument("-U", "--upstream",
+                        action="append",
+                        type=utils.check_upstream,
+                        help="additional SSH server to balance connections "
+                        "across. Each server gets own pool with the same "
+                        "options. This option may be specified multiple times",
+                        metavar="HOST[:PORT]")
     parser.add_argument("-v", "--verbosity",
                         help="logging verbosity",
                         type=utils.check_loglevel,
@@ -40,6 +58,26 @@ def parse_args():
     parser.add_argument("--disable-uvloop",
                         help="do not use uvloop even if it is available",
                         action="store_true")
+    parser.add_argument("-W", "--workers",
+                        default=1,
+                        type=utils.check_positive_int,
+                        help="number of worker processes. Workers share "
+                        "listening port with SO_REUSEPORT and split pool "
+                        "size and connect rate evenly. In multi-process mode "
+                        "metrics endpoint of worker N listens on metrics "
+                        "port + N")
+    parser.add_argument("--drain-timeout",
+                        default=DRAIN_TIMEOUT,
+                        type=utils.check_nonnegative_float,
+                        help="on shutdown or reload, stop accepting clients "
+                        "and wait this many seconds for active ones to "
+                        "finish")
+    parser.add_argument("--warmup-timeout",
+                        default=WARMUP_TIMEOUT,
+                        type=utils.check_nonnegative_float,
+                        help="on reload (SIGHUP), new process waits this many "
+                        "seconds for its pool to fill before taking over "
+                        "from old one")
 
     listen_group = parser.add_argument_group('listen options')
     listen_group.add_argument("-a", "--bind-address",
@@ -52,16 +90,140 @@ def parse_args():
     listen_group.add_argument("-T", "--transparent",
                               action="store_true",
                               help="transparent mode")
+    listen_group.add_argument("--tproxy",
+                              action="store_true",
+                              help="transparent mode for connections diverted "
+                              "by TPROXY rule instead of NAT redirect. Needs "
+                              "CAP_NET_ADMIN. Listener on \"::\" accepts both "
+                              "IPv4 and IPv6 connections")
+    listen_group.add_argument("--protocol",
+                              choices=("socks5", "http", "auto"),
+                              default="socks5",
+                              help="proxy protocol served in non-transparent "
+                              "mode. \"http\" serves CONNECT method and "
+                              "forwards requests for http:// URIs, \"auto\" "
+                              "detects SOCKS5 or HTTP by first byte sent by "
+                              "client")
+    listen_group.add_argument("-O", "--optimistic-reply",
+                              action="store_true",
+                              help="send SOCKS5 success reply before tunneled "
+                              "connection is confirmed, so client data is "
+                              "pipelined with connection setup. Failed "
+                              "connections are closed without error reply")
+    listen_group.add_argument("-S", "--listen",
+                              action="append",
+                              type=utils.check_listener,
+                              help="listener specification in form "
+                              "PROTOCOL:HOST[:PORT][,OPTION...], where "
+                              "PROTOCOL is one of socks5, http, auto, "
+                              "transparent or tproxy and OPTION is "
+                              "max-clients=N or optimistic. IPv6 HOST "
+                              "followed by PORT goes in brackets. Can be "
+                              "repeated, all listeners "
+                              "share the same SSH connection pool. Overrides "
+                              "-a, -p, -T, --tproxy and --protocol options",
+                              metavar="SPEC")
+    listen_group.add_argument("--udp-helper",
+                              type=utils.check_udp_helper,
+                              help="enable SOCKS5 UDP ASSOCIATE command. "
+                              "Datagrams are tunneled to rsp-udp-helper "
+                              "listening on this HOST[:PORT] or UNIX socket "
+                              "path on SSH server side",
+                              metavar="ENDPOINT")
+
+    admission_group = parser.add_argument_group('admission control options')
+    admission_group.add_argument("--max-clients",
+                                 type=utils.check_positive_int,
+                                 help="limit of clients served at once by "
+                                 "all listeners. Excess connections are "
+                                 "closed right after accept")
+    admission_group.add_argument("--max-clients-per-ip",
+                                 type=utils.check_positive_int,
+                                 help="limit of clients from one source "
+                                 "address served at once")
+    admission_group.add_argument("--max-waiters",
+                                 type=utils.check_positive_int,
+                                 help="limit of clients awaiting for free "
+                                 "pooled connection. Excess requests are "
+                                 "failed immediately. Waiters are served "
+                                 "round-robin across source addresses")
+    admission_group.add_argument("--max-waiters-per-ip",
+                                 type=utils.check_positive_int,
+                                 help="limit of clients from one source "
+                                 "address awaiting for free pooled "
+                                 "connection")
+
+    shaper_group = parser.add_argument_group('traffic shaping options',
+                                              "rates are in bytes per second "
+                                              "with optional K, M or G suffix "
+                                              "and count both directions")
+    shaper_group.add_argument("--client-rate",
+                              type=utils.check_rate,
+                              help="traffic limit of single client "
+                              "connection",
+                              metavar="RATE")
+    shaper_group.add_argument("--source-rate",
+                              type=utils.check_rate,
+                              help="traffic limit of all connections from "
+                              "one source address",
+                              metavar="RATE")
+    shaper_group.add_argument("--total-rate",
+                              type=utils.check_rate,
+                              help="traffic limit of all relayed "
+                              "connections",
+                              metavar="RATE")
+
+    dns_group = parser.add_argument_group('DNS options')
+    dns_group.add_argument("--dns-server",
+                           type=utils.check_dns_server,
+                           help="resolve destination names of SOCKS5 "
+                           "requests with DNS server at this HOST[:PORT] as "
+                           "seen from SSH server and cache results. By "
+                           "default names are passed to SSH server as is",
+                           metavar="ENDPOINT")
+    dns_group.add_argument("--dns-cache-size",
+                           default=DNS_CACHE_SIZE,
+                           type=utils.check_positive_int,
+                           help="maximum number of cached DNS answers")
+
+    routing_group = parser.add_argument_group('routing options')
+    routing_group.add_argument("--routes",
+                               help="file with routing rules which choose "
+                               "to tunnel, connect directly or reject "
+                               "requests by destination network or domain. "
+                               "File is reloaded when it changes",
+                               metavar="FILE")
+
+    metrics_group = parser.add_argument_group('metrics options')
+    metrics_group.add_argument("--metrics-address",
+                               default="127.0.0.1",
+                               help="bind address of HTTP metrics endpoint")
+    metrics_group.add_argument("--metrics-port",
+                               type=utils.check_port,
+                               help="bind port of HTTP metrics endpoint. "
+                               "Endpoint is disabled if not specified")
 
     pool_group = parser.add_argument_group('pool options')
     pool_group.add_argument("-n", "--pool-size",
                             default=30,
                             type=utils.check_positive_int,
-                            help="target number of steady connections")
+                            help="target number of steady connections. "
+                            "Initial target if autoscaling is enabled")
+    pool_group.add_argument("--min-pool-size",
+                            default=1,
+                            type=utils.check_positive_int,
+                            help="lower bound of autoscaled pool target")
+    pool_group.add_argument("--max-pool-size",
+                            type=utils.check_positive_int,
+                            help="enable pool autoscaling driven by demand "
+                            "and limit pool target by this value")
     pool_group.add_argument("-B", "--backoff",
                             default=5,
                             type=utils.check_positive_float,
-                            help="delay after connection attempt failure in seconds")
+                            help="initial delay after connection attempt "
+                            "failure in seconds. Delay doubles with each "
+                            "consecutive failure up to %d seconds and is "
+                            "randomized by half" % MAX_BACKOFF)
     pool_group.add_argument("-w", "--timeout",
                             default=4,
                             type=utils.check_positive_float,
@@ -70,6 +232,57 @@ def parse_args():
                             default=0.5,
                             type=utils.check_nonnegative_float,
                             help="limit for new pool connections per second")
+    pool_group.add_argument("-b", "--connect-burst",
+                            default=1,
+                            type=utils.check_positive_int,
+                            help="number of pool connections which may be "
+                            "opened at once before connect rate limit applies")
+    pool_group.add_argument("-m", "--max-channels",
+                            default=1,
+                            type=utils.check_positive_int,
+                            help="maximum number of tunneled connections "
+                            "sharing one SSH connection simultaneously")
+    pool_group.add_argument("-c", "--check-interval",
+                            default=30,
+                            type=utils.check_nonnegative_float,
+                            help="interval of SSH keepalives for pooled "
+                            "connections and of idle and lifetime checks in "
+                            "seconds. Connection is dropped after 3 missed "
+                            "keepalives. Zero disables checks")
+    pool_group.add_argument("--max-idle",
+                            default=0,
+                            type=utils.check_nonnegative_float,
+                            help="recycle pooled connections which were not "
+                            "used for this amount of seconds. Zero means "
+                            "no limit")
+    pool_group.add_argument("--max-lifetime",
+                            default=0,
+                            type=utils.check_nonnegative_float,
+                            help="recycle pooled connections older than this "
+                            "amount of seconds. Zero means no limit")
+    pool_group.add_argument("-A", "--affinity",
+                            action="store_true",
+                            help="prefer pooled connection which recently "
+                            "opened channel to the same destination host")
+    pool_group.add_argument("--affinity-table-size",
+                            default=DEST_STATS_SIZE,
+                            type=utils.check_positive_int,
+                            help="number of destination hosts remembered "
+                            "for affinity")
+    pool_group.add_argument("--max-window",
+                            default=CHANNEL_WINDOW_MAX,
+                            type=utils.check_size,
+                            help="upper limit of SSH channel receive window. "
+                            "Windows start from bandwidth-delay product "
+                            "estimated for upstream and grow while channel is "
+                            "limited by window. Size takes optional K, M or "
+                            "G suffix")
+    pool_group.add_argument("--window-budget",
+                            default=WINDOW_BUDGET,
+                            type=utils.check_size,
+                            help="limit of total receive window of all "
+                            "channels. Each channel still gets at least "
+                            "2M window")
 
     ssh_group = parser.add_argument_group('SSH options')
     ssh_group.add_argument("-L", "--login",
@@ -78,7 +291,10 @@ def parse_args():
                            action="append",
                            help="SSH private key file. By default program looks "
                            "for SSH keys in usual locations, including SSH "
-                           "agent socket. This option may be specified "
+                           "agent socket and IdentityFile of SSH config. "
+                           "Keys and SSH agent identities are loaded once "
+                           "at startup, keys given with this option are "
+                           "offered first. This option may be specified "
                            "multiple times",
                            metavar="KEY_FILE")
     ssh_group.add_argument("-P", "--password",
@@ -92,89 +308,378 @@ def parse_args():
                            metavar="FILE")
     ssh_group.add_argument("--client-version",
                            help="override client version string")
+    ssh_group.add_argument("--kex-algs",
+                           default=SSH_KEX_ALGS,
+                           help="key exchange algorithms in OpenSSH format. "
+                           "Leading \"^\" moves listed algorithms to the "
+                           "head of default list, \"+\" and \"-\" add and "
+                           "remove them, plain list replaces defaults",
+                           metavar="ALGS")
+    ssh_group.add_argument("--encryption-algs",
+                           default=SSH_ENCRYPTION_ALGS,
+                           help="ciphers in the same format as --kex-algs",
+                           metavar="ALGS")
+    ssh_group.add_argument("--mac-algs",
+                           help="MAC algorithms in the same format as "
+                           "--kex-algs. Used only with non-AEAD ciphers",
+                           metavar="ALGS")
 
     return parser.parse_args()
 
-def ssh_options_from_args(args, known_hosts):
+async def load_client_keys(args):
+    """ Loads key files and fetches SSH agent identities once, so pooled
+    connections neither read keys nor query agent on every handshake. Key
+    files are given with -I or picked like asyncssh does by default:
+    IdentityFile of SSH config for primary upstream or usual locations.
+    Keys given with -I are offered first, default keys after agent ones. """
+    logger = logging.getLogger('MAIN')
+    kw = dict()
+    if args.identity is not None:
+        kw['client_keys'] = list(args.identity)
+    resolved = asyncssh.SSHClientConnectionOptions(config=(),
+                                                   host=args.dst_address,
+                                                   port=args.dst_port,
+                                                   **kw)
+    file_keys = list(resolved.client_keys or ())
+    agent_keys = []
+    if resolved.agent_path:
+        agent = asyncssh.SSHAgentClient(resolved.agent_path)
+        try:
+            agent_keys.extend(await agent.get_keys())
+        except (OSError, ValueError) as exc:
+            logger.warning("SSH agent identities are not available: %s",
+                           str(exc))
+        finally:
+            # Agent keys reconnect to agent on their own when they sign
+            agent.close()
+            await agent.wait_closed()
+    if args.identity is not None:
+        return file_keys + agent_keys
+    return agent_keys + file_keys
+
+
+async def ssh_options_from_args(args, known_hosts):
+    """ Builds SSH options shared by all pooled connections """
     kw = dict()
     kw['gss_host'] = None
     kw['known_hosts'] = known_hosts
+    kw['agent_path'] = None
+    kw['client_keys'] = (await load_client_keys(args)) or None
+    kw['kex_algs'] = args.kex_algs
+    kw['encryption_algs'] = args.encryption_algs
+    if args.mac_algs is not None:
+        kw['mac_algs'] = args.mac_algs
     if args.login is not None:
         kw['username'] = args.login
     if args.client_version is not None:
         kw['client_version'] = args.client_version
-    if args.identity is not None:
-        kw['client_keys'] = list(args.identity)
     if args.password is not None:
         kw['password'] = args.password
     return asyncssh.SSHClientConnectionOptions(**kw)
 
 
-async def amain(args, loop):  # pragma: no cover
+def make_ratelimit(args):
+    if args.connect_burst > 1:
+        return TokenBucket(args.connect_rate, args.connect_burst)
+    return Ratelimit(args.connect_rate)
+
+
+async def amain(args, loop, sockets=(), warmup=False, predecessor=None,
+                worker=False):  # pragma: no cover
+    """ Runs proxy. sockets are inherited listening sockets, warmup makes
+    readiness wait for pool to fill. Standalone process replaces itself
+    with successor on SIGHUP, taking over from predecessor if given. """
     logger = logging.getLogger('MAIN')
+    sockets = list(sockets)
+
+    upstreams = [(args.dst_address, args.dst_port)]
+    if args.upstream is not None:
+        upstreams.extend(args.upstream)
 
     try:
         known_hosts = asyncssh.read_known_hosts(args.hosts_file)
     except Exception as exc:
         logger.error("Host keys loading failed with error: %s", str(exc))
-        host_keys, ca_keys, x509_certs, x509_subjects = [], [], [], []
-    else:
-        host_keys, ca_keys, _, x509_certs, _, x509_subjects, _ = \
-            known_hosts.match(args.dst_address, "", args.dst_port)
-    if not ( host_keys or ca_keys or x509_certs or x509_subjects ):
-        logger.critical("Specified host is not found in known hosts. "
-                        "Please run following command: "
-                        "rsp-trust '%s' %d",
-                        args.dst_address, args.dst_port)
+        known_hosts = None
+    for dst_address, dst_port in upstreams:
+        if known_hosts is not None:
+            host_keys, ca_keys, _, x509_certs, _, x509_subjects, _ = \
+                known_hosts.match(dst_address, "", dst_port)
+        else:
+            host_keys, ca_keys, x509_certs, x509_subjects = [], [], [], []
+        if not ( host_keys or ca_keys or x509_certs or x509_subjects ):
+            logger.critical("Specified host is not found in known hosts. "
+                            "Please run following command: "
+                            "rsp-trust '%s' %d",
+                            dst_address, dst_port)
+            return
+    try:
+        options = await ssh_options_from_args(args, known_hosts)
+    except (OSError, ValueError) as exc:
+        logger.critical("Invalid SSH options: %s", str(exc))
         return
-    options = partial(ssh_options_from_args, args, known_hosts)
-
-    ratelimit = Ratelimit(args.connect_rate)
-    pool = SSHPool(dst_address=args.dst_address,
-                   dst_port=args.dst_port,
-                   ssh_options=options,
-                   timeout=args.timeout,
-                   backoff=args.backoff,
-                   ratelimit=ratelimit,
-                   size=args.pool_size,
-                   loop=loop)
+    if args.affinity:
+        affinity = DestinationStats(size=args.affinity_table_size, loop=loop)
+    else:
+        affinity = None
+
+    if args.routes is not None:
+        router = Router(path=args.routes, loop=loop)
+        try:
+            router.load()
+        except (OSError, ValueError) as exc:
+            logger.critical("Routing rules loading failed: %s", str(exc))
+            return
+    else:
+        router = None
+
+    window_budget = WindowBudget(limit=args.window_budget,
+                                 max_window=args.max_window)
+    pools = [SSHPool(dst_address=dst_address,
+                     dst_port=dst_port,
+                     ssh_options=options,
+                     timeout=args.timeout,
+                     backoff=args.backoff,
+                     ratelimit=make_ratelimit(args),
+                     size=args.pool_size,
+                     max_channels=args.max_channels,
+                     check_interval=args.check_interval,
+                     max_idle=args.max_idle,
+                     max_lifetime=args.max_lifetime,
+                     min_size=args.min_pool_size,
+                     max_size=args.max_pool_size,
+                     affinity=affinity,
+                     max_waiters=args.max_waiters,
+                     max_waiters_per_source=args.max_waiters_per_ip,
+                     window_budget=window_budget,
+                     loop=loop)
+             for dst_address, dst_port in upstreams]
+    pool = pools[0] if len(pools) == 1 else PoolBalancer(pools, affinity)
     async with pool:
         logger.warning("SSH connection pool is starting up. Pool target: "
                        "%d steady connections. It will take at least %.2f "
                        "seconds to reach it's full size.", args.pool_size,
-                       args.pool_size * 1. / args.connect_rate)
-        if args.transparent:
-            from .transparentlistener import TransparentListener as Listener
+                       max(args.pool_size - args.connect_burst, 0) * 1. /
+                       args.connect_rate)
+        specs = listener_specs(args)
+        if args.dns_server is not None and any(
+                spec.protocol not in ('transparent', 'tproxy')
+                for spec in specs):
+            resolver = Resolver(pool=pool,
+                                server=args.dns_server,
+                                timeout=args.timeout,
+                                cache_size=args.dns_cache_size,
+                                loop=loop)
+        else:
+            resolver = None
+        if args.max_clients is not None or args.max_clients_per_ip is not None:
+            limiter = ClientLimiter(
+                max_clients=args.max_clients,
+                max_clients_per_source=args.max_clients_per_ip)
+        else:
+            limiter = None
+        if (args.client_rate is not None or args.source_rate is not None or
+                args.total_rate is not None):
+            shaper = Shaper(client_rate=args.client_rate,
+                            source_rate=args.source_rate,
+                            total_rate=args.total_rate,
+                            loop=loop)
         else:
-            from .sockslistener import SocksListener as Listener
-        server = Listener(listen_address=args.bind_address,
-                          listen_port=args.bind_port,
-                          timeout=args.timeout,
-                          pool=pool,
-                          loop=loop)
-        async with server:
+            shaper = None
+        server = ListenerGroup(
+            make_listener(spec, args, pool, resolver, limiter, shaper,
+                          router, loop,
+                          handoff.take_socket(sockets, spec.address,
+                                              spec.port))
+            for spec in specs)
+        if args.metrics_port is not None:
+            metrics_server = MetricsListener(
+                listen_address=args.metrics_address,
+                listen_port=args.metrics_port,
+                timeout=args.timeout,
+                reuse_port=args.workers > 1,
+                sock=handoff.take_socket(sockets, args.metrics_address,
+                                         args.metrics_port),
+                loop=loop)
+        else:
+            metrics_server = utils.AsyncNullContext()
+        for sock in sockets:
+            logger.warning("Inherited socket %s matches no listener. "
+                           "Closing it.", sock.getsockname())
+            sock.close()
+        if resolver is None:
+            resolver = utils.AsyncNullContext()
+        if router is None:
+            router = utils.AsyncNullContext()
+        async with resolver, router, server, metrics_server:
             logger.info("Server started.")
 
             exit_event = asyncio.Event()
+            reload_event = asyncio.Event()
             async with utils.Heartbeat():
                 sig_handler = partial(utils.exit_handler, exit_event)
                 signal.signal(signal.SIGTERM, sig_handler)
                 signal.signal(signal.SIGINT, sig_handler)
+                if not worker and hasattr(signal, 'SIGHUP'):
+                    signal.signal(signal.SIGHUP,
+                                  partial(utils.reload_handler, reload_event))
                 async with AsyncSystemdNotifier() as notifier:
-                    await notifier.notify(b"READY=1")
-                    await exit_event.wait()
+                    if warmup:
+                        await handoff.wait_warm(pool, args.warmup_timeout,
+                                                loop)
+                    await handoff.notify_ready(notifier, predecessor)
+                    listening = list(server.sockets)
+                    if args.metrics_port is not None:
+                        listening.extend(metrics_server.sockets)
+                    handed_over = await handoff.wait_exit(
+                        exit_event, reload_event, listening,
+                        args.warmup_timeout + HANDOFF_GRACE, loop)
 
                     logger.debug("Eventloop interrupted. Shutting down server...")
-                    await notifier.notify(b"STOPPING=1")
+                    if not handed_over:
+                        await notifier.notify(b"STOPPING=1")
+                    await server.drain(args.drain_timeout)
+
+
+def listener_specs(args):
+    if args.listen:
+        return args.listen
+    if args.tproxy:
+        protocol = "tproxy"
+    elif args.transparent:
+        protocol = "transparent"
+    else:
+        protocol = args.protocol
+    return [utils.ListenerSpec(protocol, args.bind_address, args.bind_port,
+                               None, False)]
+
+
+def make_listener(spec, args, pool, resolver, limiter, shaper, router, loop,
+                  sock=None):
+    options = {'listen_address': spec.address,
+               'listen_port': spec.port,
+               'timeout': args.timeout,
+               'pool': pool,
+               'reuse_port': args.workers > 1,
+               'sock': sock,
+               'max_clients': spec.max_clients,
+               'limiter': limiter,
+               'shaper': shaper,
+               'router': router,
+               'loop': loop}
+    if spec.protocol in ("transparent", "tproxy"):
+        from .transparentlistener import TransparentListener
+        return TransparentListener(tproxy=spec.protocol == "tproxy",
+                                   **options)
+    socks_options = {'optimistic': spec.optimistic or args.optimistic_reply,
+                     'udp_helper': args.udp_helper,
+                     'resolver': resolver}
+    if spec.protocol == "socks5":
+        from .sockslistener import SocksListener
+        return SocksListener(**socks_options, **options)
+    socks_handler = None
+    if spec.protocol == "auto":
+        from .sockslistener import SocksHandler
+        socks = SocksHandler(pool=pool,
+                             label="%s:%d" % (spec.address, spec.port),
+                             timeout=args.timeout,
+                             shaper=shaper,
+                             router=router,
+                             loop=loop,
+                             **socks_options)
+        socks_handler = socks.handler
+    from .httplistener import HttpListener
+    return HttpListener(resolver=resolver,
+                        socks_handler=socks_handler,
+                        **options)
+
+
+def setup_loggers(args, log_handler):
+    for name in ('SocksListener', 'SocksHandler', 'TransparentListener',
+                 'HttpListener', 'SSHPool', 'AddressBook', 'Relay',
+                 'UDPAssociation', 'PoolBalancer', 'MetricsListener',
+                 'Supervisor',
+                 'Resolver', 'Router'):
+        utils.setup_logger(name, args.verbosity, log_handler)
+    return utils.setup_logger('MAIN', args.verbosity, log_handler)
+
+
+def worker_args(args, index):
+    """ Returns copy of arguments with pool budget split among workers """
+    def share(value):
+        return max(value // args.workers +
+                   (1 if index < value % args.workers else 0), 1)
+
+    wargs = argparse.Namespace(**vars(args))
+    wargs.pool_size = share(args.pool_size)
+    wargs.connect_burst = share(args.connect_burst)
+    wargs.connect_rate = args.connect_rate / args.workers
+    if args.max_pool_size is not None:
+        wargs.max_pool_size = share(args.max_pool_size)
+    if args.max_clients is not None:
+        wargs.max_clients = share(args.max_clients)
+    if args.max_waiters is not None:
+        wargs.max_waiters = share(args.max_waiters)
+    if args.total_rate is not None:
+        wargs.total_rate = args.total_rate / args.workers
+    wargs.window_budget = args.window_budget // args.workers
+    if args.metrics_port is not None:
+        wargs.metrics_port = args.metrics_port + index
+    return wargs
+
+
+def run_worker(args, sockets, warmup, index):  # pragma: no cover
+    args = worker_args(args, index)
+    for name in logging.root.manager.loggerDict:
+        logging.getLogger(name).handlers.clear()
+    with utils.AsyncLoggingHandler(args.logfile) as log_handler:
+        logger = setup_loggers(args, log_handler)
+        logger.info("Worker %d starting...", index)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(amain(args, loop, sockets, warmup,
+                                          worker=True))
+        except Exception as exc:
+            logger.exception("Worker %d failed: %s", index, str(exc))
+            raise
+        finally:
+            loop.close()
+        logger.info("Worker %d finished its work.", index)
+
+
+async def supervise(args, loop, sockets=(),
+                    predecessor=None):  # pragma: no cover
+    from .supervisor import Supervisor
+    exit_event = asyncio.Event()
+    reload_event = asyncio.Event()
+    sig_handler = partial(utils.exit_handler, exit_event)
+    signal.signal(signal.SIGTERM, sig_handler)
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGHUP, partial(utils.reload_handler, reload_event))
+    supervisor = Supervisor(workers=args.workers,
+                            target=partial(run_worker, args, sockets,
+                                           predecessor is not None),
+                            predecessor=predecessor,
+                            loop=loop)
+
+    async def watch():
+        if await handoff.wait_exit(exit_event, reload_event, sockets,
+                                   args.warmup_timeout + HANDOFF_GRACE, loop):
+            supervisor.hand_over()
+            exit_event.set()
+
+    watcher = loop.create_task(watch())
+    try:
+        await supervisor.run(exit_event)
+    finally:
+        watcher.cancel()
 
 
 def main():  # pragma: no cover
     args = parse_args()
     with utils.AsyncLoggingHandler(args.logfile) as log_handler:
-        logger = utils.setup_logger('MAIN', args.verbosity, log_handler)
-        utils.setup_logger('SocksListener', args.verbosity, log_handler)
-        utils.setup_logger('TransparentListener', args.verbosity, log_handler)
-        utils.setup_logger('SSHPool', args.verbosity, log_handler)
+        logger = setup_loggers(args, log_handler)
 
         logger.info("Starting eventloop...")
         if not args.disable_uvloop:
@@ -184,8 +689,19 @@ def main():  # pragma: no cover
                 logger.info("uvloop is not available. "
                             "Falling back to built-in event loop.")
 
+        sockets = handoff.listen_fds()
+        predecessor = os.environ.pop(HANDOFF_ENV, None)
+        if sockets:
+            logger.info("Inherited %d listening sockets.", len(sockets))
+
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(amain(args, loop))
+        if args.workers > 1:
+            loop.run_until_complete(supervise(args, loop, sockets,
+                                              predecessor))
+        else:
+            loop.run_until_complete(amain(args, loop, sockets,
+                                          warmup=predecessor is not None,
+                                          predecessor=predecessor))
         loop.close()
         logger.info("Server finished its work.")
 
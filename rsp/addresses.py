@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import socket
+
+from .constants import HAPPY_EYEBALLS_DELAY, ADDRESS_CACHE_TTL, \
+    ADDRESS_PENALTY, ADDRESS_PENALTY_MAX
+
+
+def interleave(infos):
+    """ Orders getaddrinfo() results alternating address families, first
+    family as returned by resolver goes first (RFC 8305, section 4) """
+    families = []
+    by_family = dict()
+    for family, _, _, _, sockaddr in infos:
+        if family not in by_family:
+            families.append(family)
+            by_family[family] = []
+        if (family, sockaddr) not in by_family[family]:
+            by_family[family].append((family, sockaddr))
+    result = []
+    queues = [by_family[family] for family in families]
+    while any(queues):
+        for queue in queues:
+            if queue:
+                result.append(queue.pop(0))
+    return result
+
+
+class AddressBook:
+    """ Keeps resolved addresses of upstream host and their failure record.
+    Name is resolved at most once per ADDRESS_CACHE_TTL, addresses which
+    failed recently are tried last. """
+
+    def __init__(self, host, port, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._host = host
+        self._port = port
+        self._addresses = []
+        self._expires = None
+        self._failures = dict()
+        self._lock = asyncio.Lock()
+
+    async def _resolve(self):
+        async with self._lock:
+            now = self._loop.time()
+            if self._expires is not None and self._expires > now:
+                return
+            try:
+                infos = await self._loop.getaddrinfo(self._host, self._port,
+                                                     type=socket.SOCK_STREAM)
+            except OSError as exc:
+                if not self._addresses:
+                    raise
+                self._logger.warning("Resolution of %s failed: %s. Using "
+                                     "cached addresses.", self._host, exc)
+                infos = None
+            if infos:
+                self._addresses = interleave(infos)
+                self._logger.debug("%s resolved to %s", self._host,
+                                   [addr[1][0] for addr in self._addresses])
+            self._expires = now + ADDRESS_CACHE_TTL
+
+    async def candidates(self):
+        """ Returns list of (family, sockaddr) pairs in order of preference """
+        if self._expires is None or self._expires <= self._loop.time():
+            await self._resolve()
+        now = self._loop.time()
+        # Stable sort keeps family interleaving within both groups
+        return sorted(self._addresses,
+                      key=lambda addr: self._failures.get(addr[1],
+                                                          (0, 0))[1] > now)
+
+    def report(self, address, ok):
+        sockaddr = address[1]
+        if ok:
+            self._failures.pop(sockaddr, None)
+            return
+        count = self._failures.get(sockaddr, (0, 0))[0] + 1
+        penalty = min(ADDRESS_PENALTY * 2 ** (count - 1), ADDRESS_PENALTY_MAX)
+        self._failures[sockaddr] = (count, self._loop.time() + penalty)
+        self._logger.debug("Address %s failed %d time(s) in a row, "
+                           "deprioritized for %d seconds",
+                           sockaddr[0], count, penalty)
+
+
+async def _connect_sock(family, sockaddr, loop):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def race_connect(addresses, report=None, loop=None):
+    """ Connects TCP socket to one of addresses. Next attempt is started
+    every HAPPY_EYEBALLS_DELAY seconds or as soon as previous one fails,
+    first established connection wins. Attempts still pending at that
+    moment are reported as failed, so slow addresses get deprioritized as
+    well. Returns socket and its address. """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    attempts = dict()
+    pending = set()
+    last_exc = None
+    winner = None
+    remaining = iter(addresses)
+    try:
+        while True:
+            address = next(remaining, None)
+            if address is not None:
+                task = loop.create_task(_connect_sock(address[0], address[1],
+                                                      loop))
+                attempts[task] = address
+                pending.add(task)
+            if not pending:
+                if last_exc is None:
+                    raise OSError("No addresses to connect to")
+                raise last_exc
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=HAPPY_EYEBALLS_DELAY if address is not None else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                exc = task.exception()
+                if report is not None:
+                    report(attempts[task], exc is None)
+                if exc is not None:
+                    last_exc = exc
+                elif winner is None:
+                    winner = task
+                else:
+                    task.result().close()
+            if winner is not None:
+                return winner.result(), attempts[winner]
+    finally:
+        for task in pending:
+            task.cancel()
+            if winner is not None and report is not None:
+                report(attempts[task], False)
+        if pending:
+            await asyncio.wait(pending)
+            for task in pending:
+                if not task.cancelled() and task.exception() is None:
+                    task.result().close()
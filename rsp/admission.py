@@ -0,0 +1,78 @@
+import collections
+
+
+class PoolOverloaded(Exception):
+    pass
+
+
+class FairQueue:
+    """ Queue of pool waiters served round-robin across their sources """
+
+    def __init__(self):
+        self._queues = collections.OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def count(self, key):
+        queue = self._queues.get(key)
+        return len(queue) if queue is not None else 0
+
+    def append(self, key, item):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+        queue.append(item)
+        self._size += 1
+
+    def remove(self, key, item):
+        queue = self._queues.get(key)
+        if queue is None or item not in queue:
+            return
+        queue.remove(item)
+        self._size -= 1
+        if not queue:
+            del self._queues[key]
+
+    def popleft(self):
+        if not self._queues:
+            raise IndexError("pop from an empty queue")
+        key, queue = next(iter(self._queues.items()))
+        item = queue.popleft()
+        self._size -= 1
+        if queue:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        return item
+
+
+class ClientLimiter:
+    """ Counts clients served by all listeners, in total and per source
+    address """
+
+    def __init__(self, *, max_clients=None, max_clients_per_source=None):
+        self._max_clients = max_clients
+        self._max_per_source = max_clients_per_source
+        self._total = 0
+        self._per_source = collections.Counter()
+
+    def admit(self, source):
+        if self._max_clients is not None and self._total >= self._max_clients:
+            return False
+        if (self._max_per_source is not None and
+                self._per_source[source] >= self._max_per_source):
+            return False
+        self._total += 1
+        self._per_source[source] += 1
+        return True
+
+    def leave(self, source):
+        self._total -= 1
+        self._per_source[source] -= 1
+        if not self._per_source[source]:
+            del self._per_source[source]
+
+    def __len__(self):
+        return self._total
@@ -5,8 +5,8 @@ import asyncio
 MAX_QLEN = 128
 
 class AsyncSystemdNotifier:
-    def __init__(self):
-        env_var = os.getenv('NOTIFY_SOCKET')
+    def __init__(self, address=None):
+        env_var = address if address is not None else os.getenv('NOTIFY_SOCKET')
         self._addr = ('\0' + env_var[1:]
                       if env_var is not None and env_var.startswith('@')
                       else env_var)
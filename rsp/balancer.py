@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import random
+
+from .ssh_pool import SSHPoolBorrow
+
+
+class PoolBalancer:
+    """ Spreads borrows across several SSH pools. Two random healthy pools
+    are compared by smoothed latency weighted with current load and the
+    better one is used (power of two choices). Unhealthy pools are used
+    only if every pool is unhealthy. With affinity table given, pool owning
+    connection preferred by destination is chosen first. """
+
+    def __init__(self, pools, affinity=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._pools = list(pools)
+        self._affinity = affinity
+
+    async def start(self):
+        for pool in self._pools:
+            await pool.start()
+
+    async def stop(self):
+        await asyncio.gather(*(pool.stop() for pool in self._pools))
+
+    @staticmethod
+    def _score(pool):
+        return pool.latency * (pool.load + 1)
+
+    def _choose(self, dst=None):
+        if dst is not None and self._affinity is not None:
+            conn = self._affinity.preferred(dst)
+            if conn is not None:
+                pool = self._owner(conn)
+                if pool is not None:
+                    return pool
+        candidates = [pool for pool in self._pools if pool.healthy]
+        if not candidates:
+            candidates = self._pools
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if self._score(first) <= self._score(second) else second
+
+    def _owner(self, conn):
+        for pool in self._pools:
+            if pool.is_alive(conn):
+                return pool
+        return None
+
+    async def get(self, dst=None, source=None):
+        pool = self._choose(dst)
+        self._logger.debug("Selected upstream %s", pool.name)
+        return await pool.get(dst, source)
+
+    def release(self, conn):
+        pool = self._owner(conn)
+        if pool is not None:
+            pool.release(conn)
+
+    def discard(self, conn):
+        pool = self._owner(conn)
+        if pool is not None:
+            pool.discard(conn)
+
+    def is_alive(self, conn):
+        return self._owner(conn) is not None
+
+    def report_open(self, conn, latency, dst=None):
+        pool = self._owner(conn)
+        if pool is not None:
+            pool.report_open(conn, latency, dst)
+
+    def report_failure(self, conn, dst=None):
+        pool = self._owner(conn)
+        if pool is not None:
+            pool.report_failure(conn, dst)
+
+    def report_bytes(self, dst, tx_bytes, rx_bytes):
+        if self._affinity is not None:
+            self._affinity.report_bytes(dst, tx_bytes, rx_bytes)
+
+    def channel_window(self, conn):
+        pool = self._owner(conn)
+        return pool.channel_window(conn) if pool is not None else None
+
+    @property
+    def warm(self):
+        return all(pool.warm for pool in self._pools)
+
+    def borrow(self):
+        return SSHPoolBorrow(self.get, self.release, self.discard)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
@@ -1,3 +1,4 @@
+import asyncio
 from abc import ABC, abstractmethod
 
 class BaseListener(ABC):
@@ -17,3 +18,39 @@ class BaseListener(ABC):
     async def __aexit__(self, exc_type, exc, tb):
         """ Abstract method """
 
+
+class ListenerGroup(BaseListener):
+    """ Starts and stops set of listeners together """
+
+    def __init__(self, listeners):
+        self._listeners = list(listeners)
+        self._started = []
+
+    async def start(self):
+        for listener in self._listeners:
+            await listener.start()
+            self._started.append(listener)
+
+    async def stop(self):
+        started, self._started = self._started, []
+        await asyncio.gather(*(listener.stop() for listener in started))
+
+    async def drain(self, timeout):
+        await asyncio.gather(*(listener.drain(timeout)
+                               for listener in self._started))
+
+    @property
+    def sockets(self):
+        return [sock for listener in self._started
+                for sock in listener.sockets]
+
+    async def __aenter__(self):
+        try:
+            await self.start()
+        except BaseException:
+            await self.stop()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
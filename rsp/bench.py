@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import asyncio
+import logging
+import random
+import struct
+import time
+
+import asyncssh
+
+from . import utils
+from .ssh_pool import SSHPool
+from .ratelimit import Ratelimit
+from .sockslistener import SocksListener
+from .window import WindowBudget
+from .constants import WARMUP_TIMEOUT
+
+
+LOSS_PENALTY = .2
+SIZE_HEADER = struct.Struct('!Q')
+CHUNK = b'\x00' * 65536
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Rapid SSH Proxy: offline benchmark. Runs local SSH "
+        "server, data source server and SOCKS5 proxy in one process and "
+        "drives concurrent clients through it",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-c", "--concurrency",
+                        default=50,
+                        type=utils.check_positive_int,
+                        help="number of simultaneous clients")
+    parser.add_argument("-N", "--connections",
+                        default=1000,
+                        type=utils.check_positive_int,
+                        help="total number of tunneled connections")
+    parser.add_argument("-s", "--size",
+                        default=64 * 1024,
+                        type=utils.check_positive_int,
+                        help="bytes downloaded by each connection")
+    parser.add_argument("-n", "--pool-size",
+                        default=30,
+                        type=utils.check_positive_int,
+                        help="target number of steady connections")
+    parser.add_argument("-m", "--max-channels",
+                        default=1,
+                        type=utils.check_positive_int,
+                        help="maximum number of tunneled connections "
+                        "sharing one SSH connection simultaneously")
+    parser.add_argument("-d", "--delay",
+                        default=0,
+                        type=utils.check_nonnegative_float,
+                        help="simulated round trip time to SSH server "
+                        "in milliseconds")
+    parser.add_argument("-l", "--loss",
+                        default=0,
+                        type=utils.check_nonnegative_float,
+                        help="probability of simulated loss for each chunk "
+                        "of data sent to or from SSH server. Loss is "
+                        "modelled as %d ms retransmission stall" %
+                        (LOSS_PENALTY * 1000,))
+    parser.add_argument("-O", "--optimistic-reply",
+                        help="send SOCKS5 success reply before tunneled "
+                        "connection is confirmed",
+                        action="store_true")
+    parser.add_argument("--fixed-window",
+                        help="disable SSH channel window tuning",
+                        action="store_true")
+    parser.add_argument("--disable-uvloop",
+                        help="do not use uvloop even if it is available",
+                        action="store_true")
+
+    return parser.parse_args()
+
+
+class _BenchServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return False
+
+    def connection_requested(self, dest_host, dest_port, orig_host, orig_port):
+        return True
+
+
+async def _source(reader, writer):
+    """ Reads requested size and sends that many bytes back """
+    try:
+        size, = SIZE_HEADER.unpack(await reader.readexactly(SIZE_HEADER.size))
+        while size > 0:
+            chunk = CHUNK[:size]
+            writer.write(chunk)
+            size -= len(chunk)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+class ShapingProxy:
+    """ TCP proxy adding fixed one-way delay and random stalls """
+
+    def __init__(self, dst_port, delay, loss, loop):
+        self._dst_port = dst_port
+        self._delay = delay / 2
+        self._loss = loss
+        self._loop = loop
+        self._children = set()
+        self._server = None
+        self.port = None
+
+    async def _pipe(self, reader, writer):
+        queue = asyncio.Queue()
+
+        async def sender():
+            while True:
+                deadline, data = await queue.get()
+                wait = deadline - self._loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+
+        task = self._loop.create_task(sender())
+        try:
+            while True:
+                data = await reader.read(65536)
+                deadline = self._loop.time() + self._delay
+                if data and random.random() < self._loss:
+                    deadline += LOSS_PENALTY
+                await queue.put((deadline, data))
+                if not data:
+                    break
+            await task
+        except ConnectionError:
+            pass
+        finally:
+            task.cancel()
+            writer.close()
+
+    async def handler(self, reader, writer):
+        try:
+            dst_reader, dst_writer = await asyncio.open_connection(
+                '127.0.0.1', self._dst_port)
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(self._pipe(reader, dst_writer),
+                             self._pipe(dst_reader, writer))
+
+    async def start(self):
+        def _spawn(reader, writer):
+            task = self._loop.create_task(self.handler(reader, writer))
+            self._children.add(task)
+            task.add_done_callback(self._children.discard)
+
+        self._server = await asyncio.start_server(_spawn, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        children = list(self._children)
+        for task in children:
+            task.cancel()
+        if children:
+            await asyncio.wait(children)
+
+
+async def _client(proxy_port, dst_port, size, ttfb):
+    """ Downloads size bytes through proxy. Time to first byte is appended
+    to ttfb as soon as it is known, even if transfer fails later. """
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+    try:
+        started = time.monotonic()
+        writer.write(b'\x05\x01\x00\x05\x01\x00\x01\x7f\x00\x00\x01' +
+                     dst_port.to_bytes(2, 'big') + SIZE_HEADER.pack(size))
+        resp = await reader.readexactly(12)
+        if resp[:2] != b'\x05\x00' or resp[3] != 0:
+            raise RuntimeError("SOCKS5 request rejected: %s" % resp.hex())
+        got = len(await reader.read(65536))
+        ttfb.append(time.monotonic() - started)
+        while got < size:
+            data = await reader.read(65536)
+            if not data:
+                raise RuntimeError("Connection closed prematurely")
+            got += len(data)
+    finally:
+        writer.close()
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.), len(values) - 1)]
+
+
+async def amain(args, loop):  # pragma: no cover
+    host_key = asyncssh.generate_private_key('ssh-ed25519')
+    ssh_server = await asyncssh.listen('127.0.0.1', 0,
+                                       server_host_keys=[host_key],
+                                       server_factory=_BenchServer)
+    ssh_port = ssh_server.sockets[0].getsockname()[1]
+    source = await asyncio.start_server(_source, '127.0.0.1', 0)
+    source_port = source.sockets[0].getsockname()[1]
+    if args.delay or args.loss:
+        shaper = ShapingProxy(ssh_port, args.delay / 1000., args.loss, loop)
+        await shaper.start()
+        upstream_port = shaper.port
+    else:
+        shaper = None
+        upstream_port = ssh_port
+
+    known_hosts = asyncssh.import_known_hosts(
+        '[127.0.0.1]:%d %s' % (upstream_port,
+                               host_key.export_public_key().decode('ascii')))
+    options = asyncssh.SSHClientConnectionOptions(
+        known_hosts=known_hosts, username='bench', client_keys=None,
+        agent_path=None, gss_host=None)
+    pool = SSHPool(dst_address='127.0.0.1',
+                   dst_port=upstream_port,
+                   ssh_options=options,
+                   ratelimit=Ratelimit(1000),
+                   size=args.pool_size,
+                   max_channels=args.max_channels,
+                   window_budget=(None if args.fixed_window
+                                  else WindowBudget()),
+                   loop=loop)
+    try:
+        async with pool:
+            listener = SocksListener(listen_address='127.0.0.1',
+                                     listen_port=0,
+                                     pool=pool,
+                                     optimistic=args.optimistic_reply,
+                                     loop=loop)
+            async with listener:
+                proxy_port = listener.sockets[0].getsockname()[1]
+                print("Warming up pool...", file=sys.stderr)
+                deadline = loop.time() + WARMUP_TIMEOUT
+                while pool.spare < args.pool_size:
+                    if loop.time() > deadline:
+                        print("Pool failed to warm up: %d of %d connections "
+                              "in %d seconds" % (pool.spare, args.pool_size,
+                                                 WARMUP_TIMEOUT),
+                              file=sys.stderr)
+                        return 1
+                    await asyncio.sleep(.1)
+
+                ttfb = []
+                done = 0
+                errors = 0
+                pending = iter(range(args.connections))
+
+                async def worker():
+                    nonlocal done, errors
+                    for _ in pending:
+                        try:
+                            await _client(proxy_port, source_port, args.size,
+                                          ttfb)
+                        except Exception as exc:  # pylint: disable=broad-except
+                            errors += 1
+                            print("Client error: %s" % (exc,), file=sys.stderr)
+                        else:
+                            done += 1
+
+                cpu_started = time.process_time()
+                started = time.monotonic()
+                await asyncio.gather(*(worker()
+                                       for _ in range(args.concurrency)))
+                elapsed = time.monotonic() - started
+                cpu = time.process_time() - cpu_started
+    finally:
+        if shaper is not None:
+            await shaper.stop()
+        source.close()
+        ssh_server.close()
+
+    gbytes = done * args.size / 1e9
+    print("Connections:        %d ok, %d failed" % (done, errors))
+    print("Elapsed:            %.3f s" % (elapsed,))
+    print("Connections/s:      %.1f" % (done / elapsed,))
+    if ttfb:
+        print("TTFB p50:           %.2f ms" % (_percentile(ttfb, 50) * 1000,))
+        print("TTFB p99:           %.2f ms" % (_percentile(ttfb, 99) * 1000,))
+    print("Throughput:         %.2f Mbit/s" % (gbytes * 8000 / elapsed,))
+    if gbytes:
+        print("CPU per GB:         %.2f s (whole process, including SSH "
+              "server and clients)" % (cpu / gbytes,))
+
+
+def main():  # pragma: no cover
+    args = parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    if not args.disable_uvloop:
+        utils.enable_uvloop()
+    loop = asyncio.get_event_loop()
+    status = loop.run_until_complete(amain(args, loop))
+    loop.close()
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
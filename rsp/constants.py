@@ -17,3 +17,45 @@ class LogLevel(enum.IntEnum):
 BUFSIZE = 16 * 1024
 SO_ORIGINAL_DST = 80
 SOL_IPV6 = 41
+EWMA_ALPHA = .3
+UNHEALTHY_FAILURES = 3
+KEEPALIVE_COUNT = 3
+AUTOSCALE_INTERVAL = 5
+AUTOSCALE_WINDOW = 60
+EARLY_DATA_LIMIT = 256 * 1024
+DEST_STATS_SIZE = 4096
+AFFINITY_TTL = 300
+AFFINITY_FAILURE_RATE = .5
+AFFINITY_SLOWDOWN = 3
+AFFINITY_MAX_BYTES = 64 * 1024 * 1024
+UDP_HELPER_PORT = 1081
+DNS_CACHE_SIZE = 4096
+DNS_MAX_TTL = 3600
+DNS_NEGATIVE_TTL = 60
+DNS_IDLE_TIMEOUT = 60
+SHAPER_BURST_TIME = .25
+SHAPER_QUANTUM = 64 * 1024
+HAPPY_EYEBALLS_DELAY = .25
+ADDRESS_CACHE_TTL = 60
+ADDRESS_PENALTY = 5
+ADDRESS_PENALTY_MAX = 300
+MAX_BACKOFF = 60
+HTTP_MAX_HEADER = 64 * 1024
+HTTP_IDLE_TIMEOUT = 60
+SSH_KEX_ALGS = "^curve25519-sha256,curve25519-sha256@libssh.org"
+SSH_ENCRYPTION_ALGS = "^aes128-gcm@openssh.com,aes256-gcm@openssh.com"
+CHANNEL_WINDOW = 2 * 1024 * 1024
+CHANNEL_WINDOW_MAX = 64 * 1024 * 1024
+WINDOW_BUDGET = 256 * 1024 * 1024
+WINDOW_RATE_TTL = 10
+SOCKS_HANDSHAKE_MAX = (2 + 255) + (4 + 1 + 255 + 2)
+IP_TRANSPARENT = 19
+IPV6_TRANSPARENT = 75
+LISTEN_FDS_START = 3
+HANDOFF_ENV = 'RSP_HANDOFF_SOCKET'
+HANDOFF_POLL = .5
+WARMUP_POLL = .5
+WARMUP_TIMEOUT = 60
+HANDOFF_GRACE = 30
+DRAIN_TIMEOUT = 10
+ROUTES_CHECK_INTERVAL = 5
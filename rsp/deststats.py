@@ -0,0 +1,113 @@
+import asyncio
+import collections
+
+from .constants import DEST_STATS_SIZE, AFFINITY_TTL, AFFINITY_FAILURE_RATE, \
+    AFFINITY_SLOWDOWN, AFFINITY_MAX_BYTES
+from .ssh_pool import ewma
+from . import metrics
+
+
+class DestinationEntry:
+    """ Statistics of channels opened to one destination host over the
+    connection it is bound to """
+    __slots__ = ('conn', 'last_open', 'latency', 'base_latency',
+                 'failure_rate', 'bytes')
+
+    def __init__(self):
+        self.conn = None
+        self.last_open = None
+        self.latency = None
+        self.base_latency = None
+        self.failure_rate = 0.
+        self.bytes = 0
+
+    def bind(self, conn):
+        """ Binds destination to conn. Statistics of previous connection
+        do not apply to new one and are reset. """
+        if conn is not self.conn:
+            self.conn = conn
+            self.latency = None
+            self.base_latency = None
+            self.failure_rate = 0.
+            self.bytes = 0
+
+
+class DestinationStats:
+    """ Per-destination host statistics kept in bounded LRU table. Each
+    entry also remembers pooled connection last used to reach destination,
+    so next channel to the same host can be opened over it.
+
+    Statistics decide whether binding is kept. Failing destination stays
+    on its connection, so its failures do not spread across the pool.
+    Otherwise destination is released if open latency over its connection
+    grew AFFINITY_SLOWDOWN times since binding or if it moved more than
+    AFFINITY_MAX_BYTES, so bulk traffic is spread across connections. """
+
+    def __init__(self, *, size=DEST_STATS_SIZE, ttl=AFFINITY_TTL, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._size = size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        metrics.AFFINITY_DESTINATIONS.labels().set_function(
+            lambda: len(self._entries))
+
+    def _entry(self, host):
+        entry = self._entries.get(host)
+        if entry is None:
+            entry = DestinationEntry()
+            self._entries[host] = entry
+            if len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(host)
+        return entry
+
+    def preferred(self, host):
+        """ Returns connection which recently opened channel to host or
+        None. Caller has to check if connection is still usable. """
+        entry = self._entries.get(host)
+        if entry is None or entry.conn is None:
+            return None
+        if self._loop.time() - entry.last_open > self._ttl:
+            entry.conn = None
+            return None
+        if entry.failure_rate < AFFINITY_FAILURE_RATE and (
+                entry.bytes > AFFINITY_MAX_BYTES or
+                (entry.latency is not None and
+                 entry.latency > AFFINITY_SLOWDOWN * entry.base_latency)):
+            entry.conn = None
+            return None
+        return entry.conn
+
+    def report_open(self, host, conn, latency):
+        entry = self._entry(host)
+        entry.bind(conn)
+        entry.last_open = self._loop.time()
+        if entry.base_latency is None:
+            entry.base_latency = latency
+        entry.latency = ewma(entry.latency, latency)
+        entry.failure_rate = ewma(entry.failure_rate, 0.)
+
+    def report_failure(self, host, conn):
+        """ Destination refused or timed out over conn. Destination stays
+        bound to the same connection, so repeated failures of one host do
+        not spread across the pool. """
+        entry = self._entry(host)
+        entry.bind(conn)
+        entry.last_open = self._loop.time()
+        entry.failure_rate = ewma(entry.failure_rate, 1.)
+
+    def forget(self, conn):
+        """ Unbinds destinations from evicted connection. Evictions are
+        rare, so table is just scanned. """
+        for entry in self._entries.values():
+            if entry.conn is conn:
+                entry.conn = None
+
+    def report_bytes(self, host, tx_bytes, rx_bytes):
+        entry = self._entries.get(host)
+        if entry is not None:
+            entry.bytes += tx_bytes + rx_bytes
+
+    def __len__(self):
+        return len(self._entries)
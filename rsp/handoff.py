@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+
+from .asdnotify import AsyncSystemdNotifier
+from .constants import LISTEN_FDS_START, HANDOFF_ENV, HANDOFF_POLL, \
+    WARMUP_POLL
+
+
+def listen_fds():
+    """ Returns listening sockets passed with systemd socket activation
+    protocol, either by systemd or by predecessor process """
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return []
+    try:
+        count = int(os.environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    return [socket.socket(fileno=fd)
+            for fd in range(LISTEN_FDS_START, LISTEN_FDS_START + count)]
+
+
+def take_socket(sockets, host, port):
+    """ Removes from sockets and returns one bound to host and port, None if
+    there is no such socket """
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                                   flags=socket.AI_PASSIVE)
+    except OSError:
+        return None
+    wanted = set(info[4][:2] for info in infos)
+    for sock in sockets:
+        if sock.getsockname()[:2] in wanted:
+            sockets.remove(sock)
+            return sock
+    return None
+
+
+def _exec_successor(sockets, notify_addr):  # pragma: no cover
+    """ Runs in forked child: moves listening sockets to descriptors
+    starting from LISTEN_FDS_START and executes new instance of rsp """
+    import fcntl
+    temp = [fcntl.fcntl(sock.fileno(), fcntl.F_DUPFD_CLOEXEC,
+                        LISTEN_FDS_START + len(sockets))
+            for sock in sockets]
+    for index, fd in enumerate(temp):
+        os.dup2(fd, LISTEN_FDS_START + index)
+    env = dict(os.environ)
+    env[HANDOFF_ENV] = notify_addr
+    if sockets:
+        env['LISTEN_PID'] = str(os.getpid())
+        env['LISTEN_FDS'] = str(len(sockets))
+    os.execve(sys.executable, [sys.executable, '-m', 'rsp'] + sys.argv[1:],
+              env)
+
+
+async def spawn_successor(sockets, timeout, loop=None):
+    """ Starts new instance of rsp which inherits listening sockets and
+    waits until it reports readiness. Returns True if successor is ready
+    to take over, False if it failed or was not ready within timeout. """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    logger = logging.getLogger('MAIN')
+    notify_addr = '@rsp-handoff-%d' % (os.getpid(),)
+    ready = loop.create_future()
+
+    def on_notify():
+        while True:
+            try:
+                msg = sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            if b'READY=1' in msg.split(b'\n') and not ready.done():
+                ready.set_result(None)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind('\0' + notify_addr[1:])
+    loop.add_reader(sock.fileno(), on_notify)
+    try:
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                _exec_successor(sockets, notify_addr)
+            finally:
+                os._exit(1)  # pylint: disable=protected-access
+        logger.warning("Started successor process with PID %d", pid)
+        deadline = loop.time() + timeout
+        while not ready.done():
+            try:
+                exited = os.waitpid(pid, os.WNOHANG)[0] != 0
+            except ChildProcessError:
+                exited = True
+            if exited:
+                logger.error("Successor process exited before it became "
+                             "ready. Keep serving.")
+                return False
+            if loop.time() >= deadline:
+                logger.error("Successor process was not ready in time. "
+                             "Terminating it and keep serving.")
+                os.kill(pid, signal.SIGTERM)
+                return False
+            try:
+                await asyncio.wait_for(asyncio.shield(ready), HANDOFF_POLL)
+            except asyncio.TimeoutError:
+                pass
+        logger.warning("Successor process is ready. Handing over.")
+        return True
+    finally:
+        loop.remove_reader(sock.fileno())
+        sock.close()
+
+
+async def wait_exit(exit_event, reload_event, sockets, timeout, loop=None):
+    """ Waits until process should exit: either exit is requested or
+    reload request resulted in successor taking over. Returns True in latter
+    case. """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    while True:
+        waiters = (loop.create_task(exit_event.wait()),
+                   loop.create_task(reload_event.wait()))
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for task in waiters:
+            task.cancel()
+        if exit_event.is_set():
+            return False
+        reload_event.clear()
+        if await spawn_successor(sockets, timeout, loop):
+            return True
+
+
+async def wait_warm(pool, timeout, loop=None):
+    """ Waits until pool has all its connections established, so successor
+    does not take over with cold pool """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not pool.warm:
+        if loop.time() >= deadline:
+            logging.getLogger('MAIN').warning(
+                "Pool is not warmed up in time. Proceeding anyway.")
+            return
+        await asyncio.sleep(WARMUP_POLL)
+
+
+async def notify_ready(notifier, predecessor):
+    """ Reports readiness to systemd and to predecessor process, if any.
+    Successor also claims main process role, which needs NotifyAccess=all
+    in systemd unit. """
+    if predecessor is None:
+        await notifier.notify(b"READY=1")
+        return
+    await notifier.notify(b"MAINPID=%d\nREADY=1" % (os.getpid(),))
+    async with AsyncSystemdNotifier(predecessor) as handoff:
+        await handoff.notify(b"READY=1")
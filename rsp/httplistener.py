@@ -0,0 +1,750 @@
+import asyncio
+import logging
+from functools import partial
+
+import asyncssh
+
+from .baselistener import BaseListener
+from .constants import HTTP_MAX_HEADER, HTTP_IDLE_TIMEOUT
+from . import metrics
+from .relay import Relay
+from .resolver import HostNotFound
+from .admission import PoolOverloaded
+from .routing import Route
+
+
+CHUNKED = -1
+UNTIL_CLOSE = -2
+HEX_DIGITS = b'0123456789abcdefABCDEF'
+HOP_HEADERS = frozenset((b'proxy-connection', b'proxy-authorization',
+                         b'keep-alive'))
+
+STATUS_BAD_REQUEST = b'400 Bad Request'
+STATUS_FORBIDDEN = b'403 Forbidden'
+STATUS_HEADER_TOO_LARGE = b'431 Request Header Fields Too Large'
+STATUS_NOT_IMPLEMENTED = b'501 Not Implemented'
+STATUS_BAD_GATEWAY = b'502 Bad Gateway'
+STATUS_SERVICE_UNAVAILABLE = b'503 Service Unavailable'
+STATUS_GATEWAY_TIMEOUT = b'504 Gateway Timeout'
+
+# States of _HttpRelay: between requests, relaying request and response,
+# relaying as is after protocol switch
+_IDLE = object()
+_HTTP = object()
+_TUNNEL = object()
+
+
+class HttpError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+
+
+def parse_head(head):
+    """ Splits message head into start line fields and list of
+    (lowercased header name, raw header line) pairs """
+    lines = head[:-4].split(b'\r\n')
+    start = lines[0].split(b' ', 2)
+    if len(start) != 3:
+        raise HttpError(STATUS_BAD_REQUEST, "Malformed start line")
+    headers = []
+    for line in lines[1:]:
+        name, sep, _ = line.partition(b':')
+        if not sep:
+            raise HttpError(STATUS_BAD_REQUEST, "Malformed header line")
+        headers.append((name.strip().lower(), line))
+    return start, headers
+
+
+def header_tokens(headers, *names):
+    result = set()
+    for name, line in headers:
+        if name in names:
+            result.update(token.strip().lower()
+                          for token in line.partition(b':')[2].split(b','))
+    return result
+
+
+def body_length(headers, default):
+    """ Returns CHUNKED, length given by Content-Length or default if body
+    length is not set by headers. Framing which upstream and proxy could
+    read differently is rejected with ValueError. """
+    encodings = []
+    lengths = set()
+    for name, line in headers:
+        value = line.partition(b':')[2]
+        if name == b'transfer-encoding':
+            encodings.extend(token.strip().lower()
+                             for token in value.split(b','))
+        elif name == b'content-length':
+            for token in value.split(b','):
+                token = token.strip()
+                if not token.isdigit():
+                    raise ValueError("Malformed Content-Length")
+                lengths.add(int(token))
+    if encodings and lengths:
+        raise ValueError("Both Transfer-Encoding and Content-Length are set")
+    if encodings:
+        if encodings[-1] == b'chunked':
+            return CHUNKED
+        if default != UNTIL_CLOSE:
+            # Request body without chunked coding last has no known end
+            raise ValueError("Unsupported Transfer-Encoding")
+        return UNTIL_CLOSE
+    if len(lengths) > 1:
+        raise ValueError("Conflicting Content-Length values")
+    return lengths.pop() if lengths else default
+
+
+def split_authority(authority, default_port):
+    authority = authority.rpartition(b'@')[2]
+    if authority.startswith(b'['):
+        host, _, rest = authority[1:].partition(b']')
+        port = rest[1:] if rest.startswith(b':') else b''
+    else:
+        host, _, port = authority.partition(b':')
+    port = int(port) if port else default_port
+    if not host or port is None or not 0 < port < 65536:
+        raise HttpError(STATUS_BAD_REQUEST, "Bad request target")
+    return host.decode('ascii'), port
+
+
+def split_absolute_uri(target):
+    """ Returns authority and origin-form path of http:// URI """
+    if target[:7].lower() != b'http://':
+        raise HttpError(STATUS_NOT_IMPLEMENTED,
+                        "Only http:// URIs can be forwarded")
+    rest = target[7:]
+    end = len(rest)
+    for sep in (b'/', b'?'):
+        pos = rest.find(sep)
+        if 0 <= pos < end:
+            end = pos
+    path = rest[end:]
+    if not path.startswith(b'/'):
+        path = b'/' + path
+    return rest[:end], path
+
+
+class _BodyFramer:
+    """ Finds end of message body in data fed piece by piece """
+
+    def __init__(self, length):
+        self._length = length
+        self._line = bytearray()
+        self._chunk = 0
+        self._after_data = False
+        self._trailer = False
+        self.done = length == 0
+
+    def feed(self, data):
+        """ Returns how many leading bytes of data belong to body. Malformed
+        chunked coding raises ValueError. """
+        if self._length == UNTIL_CLOSE:
+            return len(data)
+        if self._length != CHUNKED:
+            size = min(len(data), self._length)
+            self._length -= size
+            self.done = self._length == 0
+            return size
+        pos = 0
+        while pos < len(data) and not self.done:
+            if self._chunk > 0:
+                size = min(len(data) - pos, self._chunk)
+                self._chunk -= size
+                pos += size
+                continue
+            end = data.find(b'\n', pos)
+            if end < 0:
+                self._line += data[pos:]
+                pos = len(data)
+            else:
+                self._line += data[pos:end + 1]
+                pos = end + 1
+            if len(self._line) > HTTP_MAX_HEADER:
+                raise ValueError("Chunk line is too long")
+            if end >= 0:
+                line = bytes(self._line)
+                self._line.clear()
+                self._next_line(line)
+        return pos
+
+    def _next_line(self, line):
+        if not line.endswith(b'\r\n'):
+            raise ValueError("Bad line ending in chunked body")
+        line = line[:-2]
+        if self._trailer:
+            self.done = not line
+        elif self._after_data:
+            if line:
+                raise ValueError("Chunk data is longer than its size")
+            self._after_data = False
+        else:
+            size = line.split(b';', 1)[0].rstrip(b' \t')
+            if not size or len(size) > 16 or size.translate(None, HEX_DIGITS):
+                raise ValueError("Malformed chunk size")
+            self._chunk = int(size, 16)
+            if self._chunk:
+                self._after_data = True
+            else:
+                self._trailer = True
+
+
+class _HttpRelay(Relay):  # pylint: disable=too-many-instance-attributes
+    """ Relay which carries one request and its response at a time and
+    gives client connection back to stream reader and writer when response
+    is over, so upstream connection may serve more requests. Response
+    switching protocols turns it into plain relay. """
+
+    def __init__(self, target, **kwargs):
+        super().__init__(**kwargs)
+        self.target = target
+        self.reusable = True
+        self._mode = _IDLE
+        self._reader = None
+        self._protocol = None
+        self._exchange = None
+        self._method = None
+        self._request = None
+        self._response = None
+        self._head = bytearray()
+        self._head_sent = False
+        self._leftover = bytearray()
+        self._held = False
+        self._result = None
+
+    async def exchange(self, reader, writer, head, method, request_length):
+        """ Sends request head, then request body read from client, and
+        passes response back. Returns response version, headers and body
+        length or None if client connection can't serve more requests.
+        Failure before response reached client raises exception. """
+        await writer.drain()
+        if not self.reusable or writer.transport.is_closing():
+            raise ConnectionResetError("Connection is closed")
+        self._client_data(head)
+        self._mode = _HTTP
+        self._method = method
+        self._request = _BodyFramer(request_length)
+        self._response = None
+        self._head_sent = False
+        self._exchange = self._loop.create_future()
+        self._reader = reader
+        self._protocol = writer.transport.get_protocol()
+        self.attach(reader, writer)
+        try:
+            result = await self._exchange
+        except BaseException:
+            self._abort(None)
+            raise
+        if result is _TUNNEL:
+            await self.wait()
+            return None
+        return result
+
+    def _client_data(self, data):
+        if self._mode is not _HTTP:
+            super()._client_data(data)
+            return
+        if not self._request.done:
+            try:
+                size = self._request.feed(data)
+            except ValueError as exc:
+                self._abort(HttpError(STATUS_BAD_REQUEST, str(exc)))
+                return
+            if size:
+                super()._client_data(data[:size] if size < len(data)
+                                     else data)
+            data = data[size:]
+        if data:
+            # Next request of client, taken over by reader when response ends
+            self._leftover += data
+            if len(self._leftover) >= HTTP_MAX_HEADER:
+                self._held = True
+                self._pause_client()
+
+    def _resume_client(self):
+        if not self._held:
+            super()._resume_client()
+
+    def _client_eof(self):
+        if self._mode is not _HTTP:
+            return super()._client_eof()
+        self._eof_from_client = True
+        if not self._request.done:
+            self._abort(asyncio.IncompleteReadError(b'', None))
+        return True
+
+    def _upstream_data(self, data):
+        if self._mode is _TUNNEL:
+            super()._upstream_data(data)
+            return
+        if self._mode is _IDLE:
+            # Nothing is expected between responses
+            self.reusable = False
+            return
+        while data and self._mode is _HTTP:
+            if self._response is None:
+                data = self._response_head(data)
+                continue
+            try:
+                size = self._response.feed(data)
+            except ValueError as exc:
+                self._abort(HttpError(STATUS_BAD_GATEWAY,
+                                      "Malformed response: %s" % exc))
+                return
+            if size:
+                super()._upstream_data(data[:size] if size < len(data)
+                                       else data)
+            data = data[size:]
+            if self._response.done:
+                self._complete()
+        if data:
+            if self._mode is _TUNNEL:
+                super()._upstream_data(data)
+            else:
+                # Upstream sent more than response, can't be trusted
+                self.reusable = False
+
+    def _response_head(self, data):
+        """ Collects response head and passes it to client. Returns data
+        left after it. """
+        self._head += data
+        end = self._head.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self._head) > HTTP_MAX_HEADER:
+                self._abort(HttpError(STATUS_BAD_GATEWAY,
+                                      "Response head is too large"))
+            return b''
+        head, data = bytes(self._head[:end + 4]), bytes(self._head[end + 4:])
+        self._head.clear()
+        try:
+            (version, status, _), headers = parse_head(head)
+            status = int(status)
+            if self._method == b'HEAD' or status in (204, 304):
+                length = 0
+            else:
+                length = body_length(headers, UNTIL_CLOSE)
+        except (HttpError, ValueError) as exc:
+            self._abort(HttpError(STATUS_BAD_GATEWAY,
+                                  "Malformed response: %s" % exc))
+            return b''
+        super()._upstream_data(head)
+        self._head_sent = True
+        if status == 101:
+            self._tunnel()
+        elif not 100 <= status < 200:
+            self._result = (version, headers, length)
+            self._response = _BodyFramer(length)
+            if self._response.done:
+                self._complete()
+        return data
+
+    def _tunnel(self):
+        """ Protocol switched, connection is relayed as is from now on """
+        self._mode = _TUNNEL
+        self.reusable = False
+        self._held = False
+        leftover = bytes(self._leftover)
+        self._leftover.clear()
+        self._exchange.set_result(_TUNNEL)
+        if leftover:
+            self._client_data(leftover)
+        if self._eof_from_client:
+            super()._client_eof()
+        self._resume_client()
+
+    def _upstream_eof(self):
+        if self._mode is _TUNNEL:
+            return super()._upstream_eof()
+        self._eof_from_upstream = True
+        self.reusable = False
+        if self._mode is _HTTP:
+            if self._response is not None and self._result[2] == UNTIL_CLOSE:
+                self._complete()
+            else:
+                self._abort(asyncio.IncompleteReadError(bytes(self._head),
+                                                        None))
+        return False
+
+    def _finish(self):
+        self.reusable = False
+        if self._mode is _HTTP:
+            self._abort(ConnectionResetError("Connection lost"))
+        else:
+            super()._finish()
+
+    def _complete(self):
+        """ Response is over. Client connection may go on unless it is
+        still sending request body. """
+        if self._request.done:
+            result = self._result
+        else:
+            result = None
+            self.reusable = False
+        self._mode = _IDLE
+        self._detach()
+        self._exchange.set_result(result)
+        if not self.reusable:
+            super()._finish()
+
+    def _abort(self, exc):
+        """ Exchange can't complete: upstream connection is closed and exc
+        is raised from exchange() unless response reached client """
+        if self._mode is not _HTTP:
+            return
+        self._mode = _IDLE
+        self.reusable = False
+        self._detach()
+        if not self._exchange.done():
+            if self._head_sent or exc is None:
+                self._exchange.set_result(None)
+            else:
+                self._exchange.set_exception(exc)
+        super()._finish()
+
+    def _detach(self):
+        """ Gives client connection back to stream reader and writer """
+        transport, self._transport = self._transport, None
+        reader, self._reader = self._reader, None
+        protocol, self._protocol = self._protocol, None
+        if self._flow is not None:
+            self._flow.close()
+            self._flow = None
+        self._held = False
+        if transport is None:
+            return
+        transport.set_protocol(protocol)
+        if transport.is_closing():
+            return
+        if self._client_full:
+            # Write buffer is still over limit, writer has to wait for it
+            self._client_full = False
+            protocol.pause_writing()
+        if self._leftover:
+            reader.feed_data(bytes(self._leftover))
+            self._leftover.clear()
+        if self._eof_from_client:
+            reader.feed_eof()
+        transport.resume_reading()
+        self._chan.resume_reading()
+
+
+class HttpListener(BaseListener):  # pylint: disable=too-many-instance-attributes
+    """ HTTP proxy: CONNECT requests are served with relay, requests with
+    absolute http:// URI are forwarded over SSH channel kept open while
+    client sends requests to the same origin. Optional socks_handler
+    serves connections starting with SOCKS5 version byte. """
+
+    def __init__(self, *,
+                 listen_address,
+                 listen_port,
+                 pool,
+                 timeout=4,
+                 reuse_port=False,
+                 sock=None,
+                 resolver=None,
+                 socks_handler=None,
+                 max_clients=None,
+                 limiter=None,
+                 shaper=None,
+                 router=None,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._listen_address = listen_address
+        self._listen_port = listen_port
+        self._children = set()
+        self._server = None
+        self._pool = pool
+        self._timeout = timeout
+        self._reuse_port = reuse_port
+        self._sock = sock
+        self._max_clients = max_clients
+        self._limiter = limiter
+        self._shaper = shaper
+        self._resolver = resolver
+        self._router = router
+        self._socks_handler = socks_handler
+
+        label = "%s:%d" % (listen_address, listen_port)
+        metrics.LISTENER_CLIENTS.labels(label).set_function(
+            lambda: len(self._children))
+        self._handshake_hist = metrics.LISTENER_HANDSHAKE_LATENCY.labels(label)
+        self._open_hist = metrics.LISTENER_OPEN_LATENCY.labels(label)
+        self._open_failures = metrics.LISTENER_OPEN_FAILURES.labels(label)
+        self._rejected = metrics.LISTENER_REJECTED.labels(label)
+        self._tx_bytes = metrics.RELAY_BYTES.labels(label, 'upstream')
+        self._rx_bytes = metrics.RELAY_BYTES.labels(label, 'downstream')
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        while self._children:
+            children = list(self._children)
+            self._children.clear()
+            self._logger.debug("Cancelling %d client handlers...",
+                               len(children))
+            for task in children:
+                task.cancel()
+            await asyncio.wait(children)
+            # workaround for TCP server keeps spawning handlers for a while
+            # after wait_closed() completed
+            await asyncio.sleep(.5)
+
+    async def drain(self, timeout):
+        """ Stops accepting clients and waits up to timeout seconds for
+        active ones to finish """
+        self._server.close()
+        if self._children and timeout:
+            self._logger.info("Waiting for %d clients to finish...",
+                              len(self._children))
+            await asyncio.wait(list(self._children), timeout=timeout)
+
+    def _respond(self, writer, status):
+        self._logger.debug("Sending response to client: %s", status)
+        writer.write(b'HTTP/1.1 ' + status + b'\r\n'
+                     b'Content-Length: 0\r\n'
+                     b'Connection: close\r\n\r\n')
+
+    async def _resolve(self, host):
+        if self._resolver is None:
+            return host
+        return await self._resolver.resolve(host) or host
+
+    def _route(self, host, addr, port):
+        route = (self._router.route(host, addr) if self._router is not None
+                 else Route.tunnel)
+        if route is Route.reject:
+            raise HttpError(STATUS_FORBIDDEN, "connection to %s:%s rejected "
+                            "by routing rules" % (host, port))
+        return route
+
+    async def _connect(self, host, port, source):
+        addr = await self._resolve(host)
+        route = self._route(host, addr, port)
+        relay = _HttpRelay((host, port),
+                           loop=self._loop,
+                           tx_bytes=self._tx_bytes,
+                           rx_bytes=self._rx_bytes,
+                           shaper=self._shaper)
+        started = self._loop.time()
+        try:
+            if route is Route.direct:
+                await relay.open_direct(host, port, self._timeout)
+            else:
+                await relay.open(self._pool, addr, port, self._timeout, host,
+                                 source)
+        except BaseException:
+            relay.close()
+            raise
+        self._open_hist.observe(self._loop.time() - started)
+        return relay
+
+    def _disconnect(self, upstream):
+        upstream.close()
+
+    async def _tunnel(self, reader, writer, peer_addr, target):
+        host, port = split_authority(target, None)
+        self._logger.info("Client %s requested connection to %s:%s",
+                          peer_addr, host, port)
+        relay = Relay(loop=self._loop,
+                      tx_bytes=self._tx_bytes,
+                      rx_bytes=self._rx_bytes,
+                      shaper=self._shaper)
+        try:
+            addr = await self._resolve(host)
+            route = self._route(host, addr, port)
+            started = self._loop.time()
+            if route is Route.direct:
+                await relay.open_direct(host, port, self._timeout)
+            else:
+                await relay.open(self._pool, addr, port, self._timeout, host,
+                                 peer_addr[0])
+            self._open_hist.observe(self._loop.time() - started)
+            writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            relay.attach(reader, writer)
+            await relay.wait()
+        finally:
+            relay.close()
+
+    async def _forward(self, reader, writer, peer_addr, start, headers,
+                       upstream):
+        """ Forwards one request and its response. Returns whether client
+        connection may serve next request and upstream kept for it. """
+        method, target, version = start
+        try:
+            authority, path = split_absolute_uri(target)
+            host, port = split_authority(authority, 80)
+            request_length = body_length(headers, 0)
+        except Exception:
+            if upstream is not None:
+                self._disconnect(upstream)
+            raise
+        self._logger.info("Client %s requested %s %s:%s%s", peer_addr,
+                          method.decode('ascii', 'replace'), host, port,
+                          path.decode('ascii', 'replace'))
+        client_tokens = header_tokens(headers, b'connection',
+                                      b'proxy-connection')
+        keep_alive = (b'close' not in client_tokens if version == b'HTTP/1.1'
+                      else b'keep-alive' in client_tokens)
+
+        if upstream is not None and (upstream.target != (host, port) or
+                                     not upstream.reusable):
+            self._disconnect(upstream)
+            upstream = None
+        if upstream is None:
+            upstream = await self._connect(host, port, peer_addr[0])
+
+        lines = [b' '.join((method, path, version))]
+        lines.extend(line for name, line in headers if name not in HOP_HEADERS)
+        lines.append(b'\r\n')
+        try:
+            result = await upstream.exchange(reader, writer,
+                                             b'\r\n'.join(lines), method,
+                                             request_length)
+        except BaseException:
+            self._disconnect(upstream)
+            raise
+        if result is None:
+            # Response is cut short or client connection is taken over
+            self._disconnect(upstream)
+            return False, None
+        resp_version, resp_headers, response_length = result
+
+        server_tokens = header_tokens(resp_headers, b'connection')
+        if (response_length == UNTIL_CLOSE or b'close' in server_tokens or
+                (resp_version != b'HTTP/1.1' and
+                 b'keep-alive' not in server_tokens)):
+            self._disconnect(upstream)
+            upstream = None
+        return keep_alive and response_length != UNTIL_CLOSE, upstream
+
+    async def _detect_socks(self, reader, writer):
+        first = await asyncio.wait_for(reader.readexactly(1),
+                                       HTTP_IDLE_TIMEOUT)
+        reader._buffer[0:0] = first  # pylint: disable=protected-access
+        if first == b'\x05':
+            await self._socks_handler(reader, writer)
+            return True
+        return False
+
+    async def handler(self, reader, writer):
+        if self._socks_handler is not None:
+            try:
+                if await self._detect_socks(reader, writer):
+                    return
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                    ConnectionError):
+                writer.close()
+                return
+        peer_addr = writer.transport.get_extra_info('peername')
+        self._logger.info("Client %s connected", str(peer_addr))
+        started = self._loop.time()
+        upstream = None
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), HTTP_IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except asyncio.LimitOverrunError:
+                    self._respond(writer, STATUS_HEADER_TOO_LARGE)
+                    break
+                if started is not None:
+                    self._handshake_hist.observe(self._loop.time() - started)
+                    started = None
+                start, headers = parse_head(head)
+                if start[0] == b'CONNECT':
+                    if upstream is not None:
+                        self._disconnect(upstream)
+                        upstream = None
+                    await self._tunnel(reader, writer, peer_addr, start[1])
+                    break
+                prev, upstream = upstream, None
+                keep_alive, upstream = await self._forward(
+                    reader, writer, peer_addr, start, headers, prev)
+                if not keep_alive:
+                    break
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            raise
+        except HttpError as exc:
+            self._logger.info("Client %s: request failed: %s", peer_addr, exc)
+            self._respond(writer, exc.status)
+        except ValueError as exc:
+            self._logger.info("Client %s: bad request: %s", peer_addr, exc)
+            self._respond(writer, STATUS_BAD_REQUEST)
+        except HostNotFound as exc:
+            self._open_failures.inc()
+            self._logger.info("Client %s: %s", peer_addr, exc)
+            self._respond(writer, STATUS_BAD_GATEWAY)
+        except asyncssh.ChannelOpenError as exc:
+            self._open_failures.inc()
+            self._logger.info("Client %s: connection failed: %s",
+                              peer_addr, exc.reason)
+            self._respond(writer, STATUS_BAD_GATEWAY)
+        except PoolOverloaded:
+            self._rejected.inc()
+            self._logger.warning("Client %s: request shed: pool is "
+                                 "overloaded", peer_addr)
+            self._respond(writer, STATUS_SERVICE_UNAVAILABLE)
+        except asyncio.TimeoutError:
+            self._open_failures.inc()
+            self._logger.info("Client %s: connection timed out", peer_addr)
+            self._respond(writer, STATUS_GATEWAY_TIMEOUT)
+        except (asyncio.IncompleteReadError, OSError,
+                asyncssh.Error) as exc:
+            self._logger.debug("Client %s: connection closed: %s", peer_addr,
+                               str(exc) or exc.__class__.__name__)
+            self._respond(writer, STATUS_BAD_GATEWAY)
+        except Exception as exc:  # pragma: no cover
+            self._logger.exception("Connection handler stopped with exception:"
+                                   " %s", str(exc))
+        finally:
+            self._logger.info("Client %s disconnected", str(peer_addr))
+            if upstream is not None:
+                self._disconnect(upstream)
+            writer.close()
+
+    async def start(self):
+        def _spawn(reader, writer):
+            peer_addr = writer.get_extra_info('peername')
+            def task_cb(task, fut):
+                self._children.discard(task)
+                if self._limiter is not None:
+                    self._limiter.leave(peer_addr[0])
+            if ((self._max_clients is not None and
+                 len(self._children) >= self._max_clients) or
+                    (self._limiter is not None and
+                     not self._limiter.admit(peer_addr[0]))):
+                self._rejected.inc()
+                self._logger.warning("Client %s rejected: clients limit "
+                                     "reached", peer_addr)
+                if self._socks_handler is None:
+                    self._respond(writer, STATUS_SERVICE_UNAVAILABLE)
+                writer.close()
+                return
+            task = self._loop.create_task(self.handler(reader, writer))
+            self._children.add(task)
+            task.add_done_callback(partial(task_cb, task))
+
+        if self._sock is not None:
+            self._server = await asyncio.start_server(_spawn, sock=self._sock,
+                                                      limit=HTTP_MAX_HEADER)
+        else:
+            self._server = await asyncio.start_server(
+                _spawn, self._listen_address, self._listen_port,
+                reuse_port=self._reuse_port, limit=HTTP_MAX_HEADER)
+        self._logger.info("HTTP proxy server listening on %s:%d",
+                          self._listen_address, self._listen_port)
+
+    @property
+    def sockets(self):
+        return self._server.sockets
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
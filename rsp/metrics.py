@@ -0,0 +1,245 @@
+import bisect
+
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    __slots__ = ('value', '_func')
+
+    def __init__(self):
+        self.value = 0
+        self._func = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, func):
+        """ Value will be obtained from func at collection time """
+        self._func = func
+
+    def samples(self, name, labels):
+        yield name, labels, self.value if self._func is None else self._func()
+
+
+class Histogram:
+    __slots__ = ('_buckets', '_counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        acc = 0
+        for bound, count in zip(self._buckets + (float('inf'),), self._counts):
+            acc += count
+            yield name + '_bucket', labels + (('le', bound),), acc
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class MetricFamily:
+    def __init__(self, name, kind, doc, labelnames, factory):
+        self.name = name
+        self.kind = kind
+        self.doc = doc
+        self._labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = dict()
+
+    def labels(self, *values):
+        """ Returns metric for given label values. Callers are expected to
+        keep the result instead of looking it up on every update """
+        child = self._children.get(values)
+        if child is None:
+            child = self._factory()
+            self._children[values] = child
+        return child
+
+    def remove(self, *values):
+        self._children.pop(values, None)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in self._children.items():
+            for name, extra, value in child.samples(self.name, ()):
+                lines.append('%s%s %s' % (
+                    name,
+                    _format_labels(self._labelnames, values,
+                                   ((label, _format_value(v))
+                                    for label, v in extra)),
+                    _format_value(value)))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._families = []
+
+    def _add(self, name, kind, doc, labelnames, factory):
+        family = MetricFamily(name, kind, doc, labelnames, factory)
+        self._families.append(family)
+        return family
+
+    def counter(self, name, doc, labelnames=()):
+        return self._add(name, 'counter', doc, labelnames, Counter)
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._add(name, 'gauge', doc, labelnames, Gauge)
+
+    def histogram(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(name, 'histogram', doc, labelnames,
+                         lambda: Histogram(buckets))
+
+    def render(self):
+        lines = []
+        for family in self._families:
+            lines.extend(family.render())
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+
+REGISTRY = Registry()
+
+POOL_RESERVE = REGISTRY.gauge(
+    'rsp_pool_reserve_connections',
+    'Idle connections in pool reserve', ('upstream',))
+POOL_SHARED = REGISTRY.gauge(
+    'rsp_pool_borrowed_connections',
+    'Pooled connections with borrowed channels', ('upstream',))
+POOL_WAITERS = REGISTRY.gauge(
+    'rsp_pool_waiters',
+    'Borrowers waiting for free connection', ('upstream',))
+POOL_BUILDS = REGISTRY.gauge(
+    'rsp_pool_builds_in_flight',
+    'Connection build tasks in progress', ('upstream',))
+POOL_TARGET = REGISTRY.gauge(
+    'rsp_pool_target_connections',
+    'Target number of spare pool connections', ('upstream',))
+POOL_CONNECT_LATENCY = REGISTRY.histogram(
+    'rsp_pool_connect_seconds',
+    'SSH connection establishment latency', ('upstream',))
+POOL_CONNECT_FAILURES = REGISTRY.counter(
+    'rsp_pool_connect_failures_total',
+    'Failed SSH connection attempts', ('upstream',))
+POOL_BACKOFFS = REGISTRY.counter(
+    'rsp_pool_backoffs_total',
+    'Backoff delays taken after connect failures', ('upstream',))
+POOL_EVICTIONS = REGISTRY.counter(
+    'rsp_pool_evictions_total',
+    'Connections removed from pool', ('upstream',))
+POOL_AFFINITY_HITS = REGISTRY.counter(
+    'rsp_pool_affinity_hits_total',
+    'Channels opened over connection preferred by destination',
+    ('upstream',))
+POOL_SHED = REGISTRY.counter(
+    'rsp_pool_shed_total',
+    'Requests for connection rejected because waiters limit was reached',
+    ('upstream',))
+AFFINITY_DESTINATIONS = REGISTRY.gauge(
+    'rsp_affinity_destinations',
+    'Destination hosts tracked in affinity table')
+RATELIMIT_QUEUE = REGISTRY.gauge(
+    'rsp_ratelimit_queue_depth',
+    'Connection attempts waiting for rate limit', ('upstream',))
+
+RESOLVER_CACHE_ENTRIES = REGISTRY.gauge(
+    'rsp_resolver_cache_entries',
+    'Names kept in resolver cache')
+RESOLVER_CACHE_HITS = REGISTRY.counter(
+    'rsp_resolver_cache_hits_total',
+    'Names resolved from cache')
+RESOLVER_CACHE_MISSES = REGISTRY.counter(
+    'rsp_resolver_cache_misses_total',
+    'Names looked up remotely')
+RESOLVER_FAILURES = REGISTRY.counter(
+    'rsp_resolver_failures_total',
+    'Lookups failed for reasons other than nonexistent name')
+
+LISTENER_CLIENTS = REGISTRY.gauge(
+    'rsp_listener_active_clients',
+    'Client connections being served', ('listener',))
+LISTENER_HANDSHAKE_LATENCY = REGISTRY.histogram(
+    'rsp_listener_handshake_seconds',
+    'Time to obtain destination from client', ('listener',))
+LISTENER_OPEN_LATENCY = REGISTRY.histogram(
+    'rsp_listener_open_seconds',
+    'Time to open tunneled connection to destination', ('listener',))
+LISTENER_OPEN_FAILURES = REGISTRY.counter(
+    'rsp_listener_open_failures_total',
+    'Failed attempts to open tunneled connection', ('listener',))
+LISTENER_REJECTED = REGISTRY.counter(
+    'rsp_listener_rejected_total',
+    'Client connections closed because listener limit was reached',
+    ('listener',))
+SHAPER_THROTTLED = REGISTRY.counter(
+    'rsp_shaper_throttled_total',
+    'Times relayed connection was paused by traffic shaper')
+SHAPER_SOURCES = REGISTRY.gauge(
+    'rsp_shaper_sources',
+    'Client source addresses tracked by traffic shaper')
+RELAY_BYTES = REGISTRY.counter(
+    'rsp_relay_bytes_total',
+    'Bytes relayed between clients and tunneled connections',
+    ('listener', 'direction'))
+WINDOW_RESERVED = REGISTRY.gauge(
+    'rsp_window_reserved_bytes',
+    'Receive window of open SSH channels')
+WINDOW_GROWN = REGISTRY.counter(
+    'rsp_window_grown_total',
+    'Times receive window of open channel was enlarged')
+ROUTE_DECISIONS = REGISTRY.counter(
+    'rsp_route_decisions_total',
+    'Client requests by route chosen by routing rules', ('route',))
+ROUTE_RULES = REGISTRY.gauge(
+    'rsp_route_rules',
+    'Routing rules loaded')
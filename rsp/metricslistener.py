@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from functools import partial
+
+from .baselistener import BaseListener
+from . import metrics
+
+
+MAX_REQUEST_SIZE = 8192
+
+
+class MetricsListener(BaseListener):  # pylint: disable=too-many-instance-attributes
+    def __init__(self, *,
+                 listen_address,
+                 listen_port,
+                 registry=None,
+                 timeout=4,
+                 reuse_port=False,
+                 sock=None,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._listen_address = listen_address
+        self._listen_port = listen_port
+        self._registry = registry if registry is not None else metrics.REGISTRY
+        self._children = set()
+        self._server = None
+        self._timeout = timeout
+        self._reuse_port = reuse_port
+        self._sock = sock
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        while self._children:
+            children = list(self._children)
+            self._children.clear()
+            for task in children:
+                task.cancel()
+            await asyncio.wait(children)
+
+    def _respond(self, writer, status, body, content_type='text/plain'):
+        writer.write(('HTTP/1.1 %s\r\n'
+                      'Content-Type: %s\r\n'
+                      'Content-Length: %d\r\n'
+                      'Connection: close\r\n\r\n' %
+                      (status, content_type, len(body))).encode('ascii'))
+        writer.write(body)
+
+    async def handler(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                             self._timeout)
+            method, _, rest = request.partition(b' ')
+            path = rest.split(b' ', 1)[0].split(b'?', 1)[0]
+            if method not in (b'GET', b'HEAD'):
+                self._respond(writer, '405 Method Not Allowed', b'')
+            elif path not in (b'/', b'/metrics'):
+                self._respond(writer, '404 Not Found', b'')
+            else:
+                body = self._registry.render()
+                self._respond(writer, '200 OK',
+                              body if method == b'GET' else b'',
+                              'text/plain; version=0.0.4; charset=utf-8')
+            await writer.drain()
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            raise
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as exc:  # pragma: no cover
+            self._logger.exception("Metrics handler stopped with exception:"
+                                   " %s", str(exc))
+        finally:
+            writer.close()
+
+    async def start(self):
+        def _spawn(reader, writer):
+            def task_cb(task, fut):
+                self._children.discard(task)
+            task = self._loop.create_task(self.handler(reader, writer))
+            self._children.add(task)
+            task.add_done_callback(partial(task_cb, task))
+
+        if self._sock is not None:
+            self._server = await asyncio.start_server(_spawn,
+                                                      sock=self._sock,
+                                                      limit=MAX_REQUEST_SIZE)
+        else:
+            self._server = await asyncio.start_server(
+                _spawn, self._listen_address, self._listen_port,
+                reuse_port=self._reuse_port, limit=MAX_REQUEST_SIZE)
+        self._logger.info("Metrics server listening on %s:%d",
+                          self._listen_address, self._listen_port)
+
+    @property
+    def sockets(self):
+        return self._server.sockets
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
@@ -9,6 +9,10 @@ class Ratelimit:
         self._waiters = deque()
         self._release_scheduled = False
 
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
     def _schedule_dispatch(self):
         self._loop.call_at(self._last_released + self._delay, self._dispatch)
         self._release_scheduled = True
@@ -41,3 +45,75 @@ class Ratelimit:
 
     async def __aexit__(self, exc, exc_type, tb):
         pass
+
+
+class TokenBucket:
+    """ Rate limit allowing bursts of up to `burst` acquisitions. Tokens are
+    refilled continuously with `rate` tokens per second. """
+
+    def __init__(self, rate, burst=1, loop=None):
+        self._loop = asyncio.get_event_loop() if loop is None else loop
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last_refill = self._loop.time()
+        self._waiters = deque()
+        self._release_scheduled = False
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def _refill(self):
+        t = self._loop.time()
+        self._tokens = min(self._burst,
+                           self._tokens + (t - self._last_refill) * self._rate)
+        self._last_refill = t
+
+    def _schedule_dispatch(self):
+        self._loop.call_later((1 - self._tokens) / self._rate, self._dispatch)
+        self._release_scheduled = True
+
+    def _dispatch(self):
+        self._release_scheduled = False
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            fut = self._waiters.popleft()
+            if not fut.cancelled():
+                fut.set_result(None)
+                self._tokens -= 1
+        if self._waiters:
+            self._schedule_dispatch()
+
+    async def wait(self):
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        fut = self._loop.create_future()
+        self._waiters.append(fut)
+        if not self._release_scheduled:
+            self._schedule_dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # token was granted to cancelled waiter, return it
+                self._tokens += 1
+                if self._waiters and not self._release_scheduled:
+                    self._loop.call_soon(self._dispatch)
+                    self._release_scheduled = True
+            else:
+                # dispatch may have dropped it already
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+
+    async def __aenter__(self):
+        await self.wait()
+        return self
+
+    async def __aexit__(self, exc, exc_type, tb):
+        pass
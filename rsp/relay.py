@@ -0,0 +1,384 @@
+import asyncio
+import logging
+from functools import partial
+
+import asyncssh
+
+from .ssh_pool import is_transport_failure
+from .metrics import Counter
+from .constants import EARLY_DATA_LIMIT
+
+
+async def open_channel(pool, host, opener, timeout, *,
+                       loop, logger, done=None, source=None):
+    """ Borrows connection from pool and calls opener(conn) to open channel
+    on it. Timeout covers waiting for connection too. Opens failed because
+    of dead SSH transport or channel shortage are retried on other pooled
+    connections until timeout expires or done future resolves. Source
+    identifies client for fair queueing in pool. Returns borrowed
+    connection and opener result. """
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        conn = await asyncio.wait_for(pool.get(host, source), remaining)
+        started = loop.time()
+        try:
+            result = await asyncio.wait_for(opener(conn),
+                                            deadline - loop.time())
+        except asyncio.CancelledError:
+            pool.release(conn)
+            raise
+        except Exception as exc:
+            if is_transport_failure(exc) or not pool.is_alive(conn):
+                pool.discard(conn)
+            else:
+                pool.report_failure(conn, host)
+                pool.release(conn)
+                if not (isinstance(exc, asyncssh.ChannelOpenError) and
+                        exc.code == asyncssh.OPEN_RESOURCE_SHORTAGE):
+                    raise
+            if (done is not None and done.done()) or loop.time() >= deadline:
+                raise
+            logger.warning("Channel open to %s failed: %s. "
+                           "Retrying on another connection.",
+                           host, str(exc))
+        else:
+            pool.report_open(conn, loop.time() - started, host)
+            return conn, result
+
+
+class _ClientProtocol(asyncio.Protocol):
+    def __init__(self, relay):
+        self._relay = relay
+
+    def data_received(self, data):
+        self._relay._client_data(data)
+
+    def eof_received(self):
+        return self._relay._client_eof()
+
+    def connection_lost(self, exc):
+        self._relay._finish()
+
+    def pause_writing(self):
+        self._relay._client_full = True
+        self._relay._chan.pause_reading()
+
+    def resume_writing(self):
+        self._relay._client_full = False
+        self._relay._resume_upstream()
+
+
+class _UpstreamSession(asyncssh.SSHTCPSession):
+    def __init__(self, relay, window):
+        self._relay = relay
+        self._window = window
+        self._chan = None
+
+    def connection_made(self, chan):
+        self._chan = chan
+        if not hasattr(chan, '_init_recv_window'):
+            # Unknown asyncssh internals: window stays at size given on open
+            self._window = None
+
+    def data_received(self, data, datatype):
+        if self._window is not None and self._window.consume(len(data)):
+            # Window adjust sent after this callback advertises new size
+            self._chan._init_recv_window = self._window.size  # pylint: disable=protected-access
+        self._relay._upstream_data(data)
+
+    def eof_received(self):
+        return self._relay._upstream_eof()
+
+    def connection_lost(self, exc):
+        self._relay._finish()
+
+    def pause_writing(self):
+        self._relay._upstream_full = True
+        self._relay._pause_client()
+
+    def resume_writing(self):
+        self._relay._upstream_full = False
+        self._relay._resume_client()
+
+
+class _DirectProtocol(asyncio.Protocol):
+    """ Upstream side of relay connected to destination directly. Its
+    transport stands in for SSH channel. """
+
+    def __init__(self, relay):
+        self._relay = relay
+
+    def data_received(self, data):
+        self._relay._upstream_data(data)
+
+    def eof_received(self):
+        return self._relay._upstream_eof()
+
+    def connection_lost(self, exc):
+        self._relay._finish()
+
+    def pause_writing(self):
+        self._relay._upstream_full = True
+        self._relay._pause_client()
+
+    def resume_writing(self):
+        self._relay._upstream_full = False
+        self._relay._resume_client()
+
+
+class _PendingChannel:
+    """ Stands in for SSH channel while it is being opened. Client data
+    received early is held until channel open is confirmed, reading from
+    client is paused if too much of it piles up. """
+
+    def __init__(self, relay):
+        self._relay = relay
+        self._data = []
+        self._size = 0
+        self._eof = False
+        self._paused = False
+        self._throttled = False
+
+    def write(self, data):
+        self._data.append(data)
+        self._size += len(data)
+        if self._size >= EARLY_DATA_LIMIT and not self._throttled:
+            self._throttled = True
+            self._relay._pause_client()
+
+    def write_eof(self):
+        self._eof = True
+
+    def pause_reading(self):
+        self._paused = True
+
+    def resume_reading(self):
+        self._paused = False
+
+    def close(self):
+        self._data.clear()
+
+    def replay(self, chan):
+        """ Passes everything collected so far to real channel """
+        if self._throttled:
+            self._relay._resume_client()
+        if self._data:
+            chan.write(b''.join(self._data))
+            self._data.clear()
+        if self._eof:
+            chan.write_eof()
+        if self._paused:
+            chan.pause_reading()
+
+
+class Relay:
+    """ Moves data between client transport and SSH channel (or direct
+    connection to destination) right from protocol callbacks. Backpressure
+    on either side pauses reading on the opposite one, so relay needs no
+    buffers and no tasks of its own once channel is open. Optional shaper
+    pauses both sides the same way when client exceeds its traffic
+    budget. """
+
+    def __init__(self, loop=None, tx_bytes=None, rx_bytes=None, shaper=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._tx_bytes = tx_bytes if tx_bytes is not None else Counter()
+        self._rx_bytes = rx_bytes if rx_bytes is not None else Counter()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._pool = None
+        self._conn = None
+        self._chan = None
+        self._transport = None
+        self._pending = []
+        self._dst = None
+        self._tx_total = 0
+        self._rx_total = 0
+        self._eof_from_client = False
+        self._eof_from_upstream = False
+        self._shaper = shaper
+        self._flow = None
+        self._window = None
+        self._client_full = False
+        self._upstream_full = False
+        self._done = self._loop.create_future()
+
+    async def open(self, pool, dst_addr, dst_port, timeout, host=None,
+                   source=None):
+        """ Borrows connection from pool and opens channel to destination.
+        Host names destination for affinity and statistics and defaults to
+        dst_addr, source is client address. Connection is returned to pool
+        when relay is closed.
+
+        Relay may be attached to client before open: client data received
+        in the meantime is sent as soon as channel is confirmed. """
+        if host is None:
+            host = dst_addr
+        conn, (chan, _) = await open_channel(
+            pool, host,
+            lambda conn: self._create_connection(pool, conn,
+                                                 dst_addr, dst_port),
+            timeout, loop=self._loop, logger=self._logger, done=self._done,
+            source=source)
+        self._pool, self._conn, self._dst = pool, conn, host
+        pending, self._chan = self._chan, chan
+        if self._done.done():
+            self.close()
+        elif pending is not None:
+            pending.replay(chan)
+
+    async def open_direct(self, dst_addr, dst_port, timeout):
+        """ Connects to destination directly, bypassing SSH. Otherwise
+        works like open(). """
+        transport, _ = await asyncio.wait_for(
+            self._loop.create_connection(partial(_DirectProtocol, self),
+                                         dst_addr, dst_port),
+            timeout)
+        pending, self._chan = self._chan, transport
+        if self._done.done():
+            self.close()
+        elif pending is not None:
+            pending.replay(transport)
+
+    async def _create_connection(self, pool, conn, dst_addr, dst_port):
+        """ Opens channel with receive window sized by pool """
+        window = pool.channel_window(conn)
+        kw = {'window': window.size} if window is not None else {}
+        try:
+            result = await conn.create_connection(
+                partial(_UpstreamSession, self, window),
+                dst_addr, dst_port, **kw)
+        except BaseException:
+            if window is not None:
+                window.close()
+            raise
+        self._window = window
+        return result
+
+    def attach(self, reader, writer):
+        """ Takes over client connection from stream reader and writer.
+        Data already buffered by reader is passed upstream first. """
+        transport = writer.transport
+        if self._done.done() or transport.is_closing():
+            self._finish()
+            if self._pending and not transport.is_closing():
+                # Destination spoke and hung up before client was attached
+                transport.writelines(self._pending)
+                size = sum(len(data) for data in self._pending)
+                self._rx_bytes.inc(size)
+                self._pending.clear()
+                if transport.can_write_eof():
+                    transport.write_eof()
+            transport.close()
+            return
+        buffered = bytes(reader._buffer)  # pylint: disable=protected-access
+        reader._buffer.clear()  # pylint: disable=protected-access
+        transport.set_protocol(_ClientProtocol(self))
+        self._transport = transport
+        self._resume_client()
+        if self._chan is None:
+            self._chan = _PendingChannel(self)
+        if self._shaper is not None:
+            self._flow = self._shaper.flow(
+                transport.get_extra_info('peername')[0],
+                self._throttle, self._unthrottle)
+        if buffered:
+            self._client_data(buffered)
+        if self._pending:
+            transport.writelines(self._pending)
+            size = sum(len(data) for data in self._pending)
+            self._rx_bytes.inc(size)
+            self._rx_total += size
+            self._pending.clear()
+            if self._flow is not None:
+                self._flow.charge(size)
+        if reader.at_eof() or (reader.exception() is not None):
+            self._client_eof()
+        if self._eof_from_upstream and not self._done.done():
+            self._upstream_eof()
+
+    def _client_data(self, data):
+        self._chan.write(data)
+        self._tx_bytes.inc(len(data))
+        self._tx_total += len(data)
+        if self._flow is not None:
+            self._flow.charge(len(data))
+
+    def _upstream_data(self, data):
+        if self._transport is None:
+            self._pending.append(data)
+        else:
+            self._transport.write(data)
+            self._rx_bytes.inc(len(data))
+            self._rx_total += len(data)
+            if self._flow is not None:
+                self._flow.charge(len(data))
+
+    def _throttle(self):
+        self._pause_client()
+        self._chan.pause_reading()
+
+    def _unthrottle(self):
+        self._resume_client()
+        self._resume_upstream()
+
+    def _pause_client(self):
+        if self._transport is not None:
+            self._transport.pause_reading()
+
+    def _resume_client(self):
+        """ Resumes reading from client unless channel is full or flow is
+        throttled """
+        if self._transport is None:
+            return
+        if not self._upstream_full and not (self._flow is not None and
+                                            self._flow.paused):
+            self._transport.resume_reading()
+
+    def _resume_upstream(self):
+        if not self._client_full and not (self._flow is not None and
+                                          self._flow.paused):
+            self._chan.resume_reading()
+
+    def _client_eof(self):
+        self._eof_from_client = True
+        if self._eof_from_upstream:
+            self._finish()
+            return False
+        self._chan.write_eof()
+        return True
+
+    def _upstream_eof(self):
+        self._eof_from_upstream = True
+        if self._transport is None:
+            return True
+        if self._eof_from_client or not self._transport.can_write_eof():
+            self._finish()
+            return False
+        self._transport.write_eof()
+        return True
+
+    def _finish(self):
+        if not self._done.done():
+            self._done.set_result(None)
+        self.close()
+
+    def close(self):
+        if self._flow is not None:
+            self._flow.close()
+            self._flow = None
+        if self._window is not None:
+            self._window.close()
+            self._window = None
+        if self._chan is not None:
+            self._chan.close()
+        if self._transport is not None:
+            self._transport.close()
+        if self._conn is not None:
+            self._pool.report_bytes(self._dst, self._tx_total, self._rx_total)
+            self._pool.release(self._conn)
+            self._conn = None
+
+    async def wait(self):
+        await self._done
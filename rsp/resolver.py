@@ -0,0 +1,283 @@
+import asyncio
+import collections
+import logging
+import random
+import socket
+import struct
+from functools import partial
+
+from .constants import DNS_CACHE_SIZE, DNS_MAX_TTL, DNS_NEGATIVE_TTL, \
+    DNS_IDLE_TIMEOUT
+from .ssh_pool import is_transport_failure
+from . import metrics
+
+DNS_HEADER = struct.Struct('!HHHHHH')
+DNS_RR = struct.Struct('!HHIH')
+QTYPE_A = 1
+QTYPE_SOA = 6
+QTYPE_AAAA = 28
+RCODE_NXDOMAIN = 3
+
+
+class HostNotFound(Exception):
+    pass
+
+
+def is_ip_address(value):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, value)
+        except OSError:
+            continue
+        return True
+    return False
+
+
+def build_query(qid, name, qtype):
+    labels = name.rstrip('.').encode('idna').split(b'.')
+    qname = b''.join(bytes((len(label),)) + label for label in labels)
+    # Recursion desired
+    return (DNS_HEADER.pack(qid, 0x0100, 1, 0, 0, 0) + qname + b'\x00' +
+            struct.pack('!HH', qtype, 1))
+
+
+def _skip_name(msg, pos):
+    while True:
+        length = msg[pos]
+        if length & 0xC0 == 0xC0:
+            return pos + 2
+        if length == 0:
+            return pos + 1
+        pos += 1 + length
+
+
+def parse_response(msg):
+    """ Returns rcode, addresses from answer section, their smallest TTL
+    and negative caching TTL derived from SOA record if it is present """
+    _, flags, qdcount, ancount, nscount, _ = DNS_HEADER.unpack_from(msg)
+    pos = DNS_HEADER.size
+    for _ in range(qdcount):
+        pos = _skip_name(msg, pos) + 4
+    addresses = []
+    ttl = None
+    for _ in range(ancount):
+        pos = _skip_name(msg, pos)
+        rtype, _, rttl, rdlen = DNS_RR.unpack_from(msg, pos)
+        pos += DNS_RR.size
+        if rtype == QTYPE_A and rdlen == 4:
+            addresses.append(socket.inet_ntop(socket.AF_INET,
+                                              msg[pos:pos + 4]))
+        elif rtype == QTYPE_AAAA and rdlen == 16:
+            addresses.append(socket.inet_ntop(socket.AF_INET6,
+                                              msg[pos:pos + 16]))
+        else:
+            pos += rdlen
+            continue
+        pos += rdlen
+        ttl = rttl if ttl is None else min(ttl, rttl)
+    negative_ttl = None
+    for _ in range(nscount):
+        pos = _skip_name(msg, pos)
+        rtype, _, rttl, rdlen = DNS_RR.unpack_from(msg, pos)
+        pos += DNS_RR.size
+        if rtype == QTYPE_SOA and rdlen >= 20:
+            minimum, = struct.unpack_from('!I', msg, pos + rdlen - 4)
+            negative_ttl = min(rttl, minimum)
+        pos += rdlen
+    return flags & 0xF, addresses, ttl, negative_ttl
+
+
+class Resolver:
+    """ Resolves destination names remotely: DNS queries are sent over TCP
+    to DNS server reachable from SSH server through one long-lived channel
+    on pooled connection. Answers, including negative ones, are kept in
+    bounded LRU cache for their TTL and concurrent lookups of the same
+    name share one query. """
+
+    def __init__(self, *,
+                 pool,
+                 server,
+                 timeout=4,
+                 cache_size=DNS_CACHE_SIZE,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._pool = pool
+        self._server = server
+        self._timeout = timeout
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._inflight = dict()
+        self._pending = dict()
+        self._next_id = random.randrange(0x10000)
+        self._conn = None
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = asyncio.Lock()
+        self._idle_timer = None
+
+        metrics.RESOLVER_CACHE_ENTRIES.labels().set_function(
+            lambda: len(self._cache))
+        self._hits = metrics.RESOLVER_CACHE_HITS.labels()
+        self._misses = metrics.RESOLVER_CACHE_MISSES.labels()
+        self._failures = metrics.RESOLVER_FAILURES.labels()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        task = self._reader_task
+        self._disconnect()
+        if task is not None:
+            task.cancel()
+            await asyncio.wait((task,))
+
+    async def _ensure_channel(self):
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            conn = await self._pool.get()
+            try:
+                reader, writer = await asyncio.wait_for(
+                    conn.open_connection(*self._server), self._timeout)
+            except asyncio.CancelledError:
+                self._pool.release(conn)
+                raise
+            except Exception as exc:
+                if is_transport_failure(exc) or not self._pool.is_alive(conn):
+                    self._pool.discard(conn)
+                else:
+                    self._pool.release(conn)
+                raise
+            self._logger.debug("DNS channel to %s:%d opened", *self._server)
+            self._conn, self._writer = conn, writer
+            self._reader_task = self._loop.create_task(
+                self._read_responses(reader, writer))
+
+    def _disconnect(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader_task = None
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError("DNS channel closed"))
+        self._pending.clear()
+
+    def _idle(self):
+        self._idle_timer = None
+        if self._pending:
+            self._touch()
+        else:
+            self._logger.debug("Closing idle DNS channel")
+            self._disconnect()
+
+    def _touch(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+        self._idle_timer = self._loop.call_later(DNS_IDLE_TIMEOUT, self._idle)
+
+    async def _read_responses(self, reader, writer):
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(2), 'big')
+                msg = await reader.readexactly(size)
+                fut = self._pending.pop(int.from_bytes(msg[:2], 'big'), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg)
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            raise
+        except Exception as exc:
+            self._logger.debug("DNS channel closed: %s",
+                               str(exc) or exc.__class__.__name__)
+        finally:
+            if self._writer is writer:
+                self._disconnect()
+
+    async def _query(self, name, qtype):
+        await self._ensure_channel()
+        qid = self._next_id
+        while qid in self._pending:
+            qid = (qid + 1) & 0xFFFF
+        self._next_id = (qid + 1) & 0xFFFF
+        fut = self._loop.create_future()
+        self._pending[qid] = fut
+        msg = build_query(qid, name, qtype)
+        self._writer.write(len(msg).to_bytes(2, 'big') + msg)
+        self._touch()
+        try:
+            return parse_response(
+                await asyncio.wait_for(fut, self._timeout))
+        finally:
+            self._pending.pop(qid, None)
+
+    def _store(self, name, address, ttl):
+        self._cache[name] = (self._loop.time() + ttl, address)
+        self._cache.move_to_end(name)
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def _lookup(self, name):
+        rcode, addresses, ttl, negative_ttl = await self._query(name, QTYPE_A)
+        if rcode == 0 and not addresses:
+            rcode, addresses, ttl, negative_ttl = await self._query(
+                name, QTYPE_AAAA)
+        if addresses:
+            self._store(name, addresses[0], min(ttl, DNS_MAX_TTL))
+            return addresses[0]
+        if rcode in (0, RCODE_NXDOMAIN):
+            self._store(name, None, min(negative_ttl, DNS_NEGATIVE_TTL)
+                        if negative_ttl is not None else DNS_NEGATIVE_TTL)
+            raise HostNotFound("%s not found" % (name,))
+        raise OSError("DNS server returned error code %d" % (rcode,))
+
+    def _lookup_done(self, name, task):
+        self._inflight.pop(name, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def resolve(self, name):
+        """ Returns address for name. Raises HostNotFound if name does not
+        exist and returns None if it can't be resolved for other reasons,
+        so caller may pass the name upstream as is. """
+        if is_ip_address(name):
+            return name
+        key = name.lower()
+        entry = self._cache.get(key)
+        if entry is not None:
+            expires, address = entry
+            if expires > self._loop.time():
+                self._hits.inc()
+                self._cache.move_to_end(key)
+                if address is None:
+                    raise HostNotFound("%s not found" % (name,))
+                return address
+            del self._cache[key]
+        task = self._inflight.get(key)
+        if task is None:
+            self._misses.inc()
+            task = self._loop.create_task(self._lookup(key))
+            task.add_done_callback(partial(self._lookup_done, key))
+            self._inflight[key] = task
+        try:
+            return await asyncio.shield(task)
+        except (asyncio.CancelledError, HostNotFound):  # pylint: disable=try-except-raise
+            raise
+        except Exception as exc:
+            self._failures.inc()
+            self._logger.debug("Resolution of %s failed: %s", name,
+                               str(exc) or exc.__class__.__name__)
+            return None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
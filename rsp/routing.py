@@ -0,0 +1,231 @@
+import asyncio
+import enum
+import ipaddress
+import logging
+import os
+
+from .constants import ROUTES_CHECK_INTERVAL
+from . import metrics
+
+
+class Route(enum.Enum):
+    tunnel = 'tunnel'
+    direct = 'direct'
+    reject = 'reject'
+
+    def __str__(self):
+        return self.name
+
+
+def parse_ip(host):
+    """ Returns address object if host is IP address literal, else None.
+    IPv4-mapped IPv6 addresses are converted to IPv4. """
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return None
+    if addr.version == 6 and addr.ipv4_mapped is not None:
+        return addr.ipv4_mapped
+    return addr
+
+
+class PrefixTrie:
+    """ Binary trie of network prefixes. Lookup walks address bits and
+    returns value of longest matching prefix. """
+
+    __slots__ = ('_root',)
+
+    def __init__(self):
+        # node is [zero child, one child, value]
+        self._root = [None, None, None]
+
+    def insert(self, network, value):
+        node = self._root
+        bits = int(network.network_address)
+        top = network.max_prefixlen - 1
+        for index in range(network.prefixlen):
+            bit = (bits >> (top - index)) & 1
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None, None, None]
+            node = child
+        node[2] = value
+
+    def lookup(self, addr):
+        node = self._root
+        found = node[2]
+        bits = int(addr)
+        for shift in range(addr.max_prefixlen - 1, -1, -1):
+            node = node[(bits >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+        return found
+
+
+class SuffixTrie:
+    """ Trie of domain names keyed by labels in reverse order. Lookup
+    returns value of longest rule which is the name itself or its parent
+    domain. """
+
+    __slots__ = ('_root',)
+
+    def __init__(self):
+        # node is [children by label, value]
+        self._root = [{}, None]
+
+    def insert(self, domain, value):
+        node = self._root
+        for label in reversed(domain.split('.')):
+            node = node[0].setdefault(label, [{}, None])
+        node[1] = value
+
+    def lookup(self, domain):
+        node = self._root
+        found = None
+        for label in reversed(domain.split('.')):
+            node = node[0].get(label)
+            if node is None:
+                break
+            if node[1] is not None:
+                found = node[1]
+        return found
+
+
+class RoutingTable:
+    """ Decides how to reach destination. Rules for domain names are
+    checked first, then rules for address, then default route. """
+
+    def __init__(self, default=Route.tunnel):
+        self.default = default
+        self.size = 0
+        self._networks = {4: PrefixTrie(), 6: PrefixTrie()}
+        self._domains = SuffixTrie()
+
+    def add(self, pattern, route):
+        """ Adds rule for pattern, which is either network prefix, domain
+        name matching itself and its subdomains or "*" for default """
+        if pattern == '*':
+            self.default = route
+        elif parse_ip(pattern.split('/', 1)[0]) is not None:
+            network = ipaddress.ip_network(pattern, strict=False)
+            self._networks[network.version].insert(network, route)
+        else:
+            domain = pattern.lower().rstrip('.')
+            if domain.startswith('*.'):
+                domain = domain[2:]
+            domain = domain.lstrip('.')
+            if not domain or '/' in domain:
+                raise ValueError("bad pattern %s" % (repr(pattern),))
+            self._domains.insert(domain, route)
+        self.size += 1
+
+    def route(self, host, addr=None):
+        """ Returns route to destination host, which resolved to addr if
+        it was looked up """
+        ip = parse_ip(host)
+        if ip is None:
+            found = self._domains.lookup(host.lower().rstrip('.'))
+            if found is not None:
+                return found
+            ip = parse_ip(addr) if addr is not None else None
+        if ip is not None:
+            found = self._networks[ip.version].lookup(ip)
+            if found is not None:
+                return found
+        return self.default
+
+
+def load_rules(path):
+    """ Reads routing table from file. Each line holds route (tunnel,
+    direct or reject) followed by patterns, "#" starts comment. """
+    table = RoutingTable()
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                route = Route(fields[0].lower())
+            except ValueError:
+                raise ValueError("%s:%d: unknown route %s" %
+                                 (path, lineno, repr(fields[0]))) from None
+            if len(fields) < 2:
+                raise ValueError("%s:%d: no patterns for route" %
+                                 (path, lineno))
+            for pattern in fields[1:]:
+                try:
+                    table.add(pattern, route)
+                except ValueError as exc:
+                    raise ValueError("%s:%d: %s" %
+                                     (path, lineno, exc)) from None
+    return table
+
+
+class Router:
+    """ Routing table loaded from file. File is checked for changes
+    periodically and reloaded, so rules can be edited without restart.
+    If reload fails, previous rules stay in effect. """
+
+    def __init__(self, *, path, check_interval=ROUTES_CHECK_INTERVAL,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._path = path
+        self._check_interval = check_interval
+        self._table = RoutingTable()
+        self._stamp = None
+        self._watcher = None
+        self._decisions = {route: metrics.ROUTE_DECISIONS.labels(str(route))
+                           for route in Route}
+        metrics.ROUTE_RULES.labels().set_function(lambda: self._table.size)
+
+    def _file_stamp(self):
+        st = os.stat(self._path)
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def load(self):
+        """ Loads rules from file. Raises OSError or ValueError on
+        failure. """
+        stamp = self._file_stamp()
+        self._table = load_rules(self._path)
+        self._stamp = stamp
+        self._logger.info("Loaded %d routing rules from %s",
+                          self._table.size, self._path)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self._check_interval)
+            try:
+                stamp = self._file_stamp()
+            except OSError:
+                stamp = None
+            if stamp == self._stamp:
+                continue
+            # Failed reload is not retried until file changes again
+            self._stamp = stamp
+            try:
+                self.load()
+            except (OSError, ValueError) as exc:
+                self._logger.error("Routing rules reload failed: %s. "
+                                   "Keeping previous rules.", str(exc))
+
+    def route(self, host, addr=None):
+        route = self._table.route(host, addr)
+        self._decisions[route].inc()
+        return route
+
+    async def start(self):
+        self._watcher = self._loop.create_task(self._watch())
+
+    async def stop(self):
+        self._watcher.cancel()
+        await asyncio.gather(self._watcher, return_exceptions=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
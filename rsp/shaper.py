@@ -0,0 +1,168 @@
+import asyncio
+
+from .constants import SHAPER_BURST_TIME, SHAPER_QUANTUM
+from . import metrics
+
+
+class _Bucket:
+    """ Token bucket which is charged after the fact and may go into debt.
+    Flows throttled on it are resumed together once debt is repaid. """
+
+    __slots__ = ('_loop', '_rate', '_burst', '_tokens', '_stamp', '_blocked',
+                 '_timer', 'users')
+
+    def __init__(self, loop, rate):
+        self._loop = loop
+        self._rate = rate
+        self._burst = rate * SHAPER_BURST_TIME
+        self._tokens = self._burst
+        self._stamp = loop.time()
+        self._blocked = set()
+        self._timer = None
+        self.users = 0
+
+    def _refill(self):
+        now = self._loop.time()
+        tokens = self._tokens + (now - self._stamp) * self._rate
+        self._tokens = tokens if tokens < self._burst else self._burst
+        self._stamp = now
+
+    def charge(self, size):
+        """ Takes size tokens, returns True if bucket is in debt """
+        self._refill()
+        self._tokens -= size
+        return self._tokens < 0
+
+    def block(self, flow):
+        self._blocked.add(flow)
+        if self._timer is None:
+            self._timer = self._loop.call_later(-self._tokens / self._rate,
+                                                self._release)
+
+    def discard(self, flow):
+        self._blocked.discard(flow)
+        if not self._blocked and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _release(self):
+        self._timer = None
+        self._refill()
+        if self._tokens < 0:
+            # Exempt flows kept charging while others were waiting
+            self._timer = self._loop.call_later(-self._tokens / self._rate,
+                                                self._release)
+            return
+        blocked, self._blocked = self._blocked, set()
+        for flow in blocked:
+            flow.unblock()
+
+
+class Flow:
+    """ Shaping state of one relayed connection. Flow is paused when any
+    of its buckets is in debt, except shared buckets don't pause flow
+    while it spends its interactive credit: SHAPER_QUANTUM bytes per second
+    pass without waiting for other flows of the same source or of the
+    whole process, so light interactive flows are served ahead of bulk
+    ones. """
+
+    __slots__ = ('_shaper', '_source', '_own', '_shared', '_pause', '_resume',
+                 '_credit', '_stamp', '_blocks')
+
+    def __init__(self, shaper, source, own, shared, pause, resume):
+        self._shaper = shaper
+        self._source = source
+        self._own = own
+        self._shared = shared
+        self._pause = pause
+        self._resume = resume
+        self._credit = SHAPER_QUANTUM
+        self._stamp = shaper.loop.time()
+        self._blocks = 0
+
+    def charge(self, size):
+        if self._blocks:
+            # Already paused, data in flight is accounted only
+            for bucket in self._shared:
+                bucket.charge(size)
+            if self._own is not None:
+                self._own.charge(size)
+            return
+        now = self._shaper.loop.time()
+        credit = self._credit + (now - self._stamp) * SHAPER_QUANTUM - size
+        self._credit = credit if credit < SHAPER_QUANTUM else SHAPER_QUANTUM
+        self._stamp = now
+        if self._own is not None and self._own.charge(size):
+            self._block(self._own)
+        for bucket in self._shared:
+            if bucket.charge(size) and credit < 0:
+                self._block(bucket)
+
+    def _block(self, bucket):
+        bucket.block(self)
+        self._blocks += 1
+        if self._blocks == 1:
+            self._shaper.throttled.inc()
+            self._pause()
+
+    def unblock(self):
+        self._blocks -= 1
+        if not self._blocks:
+            self._resume()
+
+    @property
+    def paused(self):
+        return self._blocks > 0
+
+    def close(self):
+        for bucket in self._shared:
+            bucket.discard(self)
+        if self._own is not None:
+            self._own.discard(self)
+        self._blocks = 0
+        self._shaper.release(self._source)
+
+
+class Shaper:
+    """ Limits relayed traffic (both directions together) per client
+    connection, per client source address and in total. Rates are in bytes
+    per second, None means unlimited. """
+
+    def __init__(self, *,
+                 client_rate=None,
+                 source_rate=None,
+                 total_rate=None,
+                 loop=None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self._client_rate = client_rate
+        self._source_rate = source_rate
+        self._total = (_Bucket(self.loop, total_rate)
+                       if total_rate is not None else None)
+        self._sources = dict()
+        self.throttled = metrics.SHAPER_THROTTLED.labels()
+        metrics.SHAPER_SOURCES.labels().set_function(
+            lambda: len(self._sources))
+
+    def flow(self, source, pause, resume):
+        """ Creates flow for client connection. pause() and resume() are
+        called to stop and restart reading on both sides of the relay. """
+        shared = []
+        if self._source_rate is not None:
+            bucket = self._sources.get(source)
+            if bucket is None:
+                bucket = self._sources[source] = _Bucket(self.loop,
+                                                         self._source_rate)
+            bucket.users += 1
+            shared.append(bucket)
+        if self._total is not None:
+            shared.append(self._total)
+        own = (_Bucket(self.loop, self._client_rate)
+               if self._client_rate is not None else None)
+        return Flow(self, source, own, tuple(shared), pause, resume)
+
+    def release(self, source):
+        bucket = self._sources.get(source)
+        if bucket is not None:
+            bucket.users -= 1
+            if not bucket.users:
+                del self._sources[source]
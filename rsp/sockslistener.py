@@ -1,17 +1,26 @@
 import asyncio
 import logging
-import collections
 from functools import partial
 import struct
 import socket
 
-from .constants import BUFSIZE
+import asyncssh
+
 from .utils import detect_af
 from .baselistener import BaseListener
+from . import metrics
+from .relay import Relay
+from .udprelay import UDPAssociation
+from .resolver import HostNotFound
+from .admission import PoolOverloaded
+from .routing import Route
+from .constants import SOCKS_HANDSHAKE_MAX
 
 
 class SocksException(Exception):
-    pass
+    """ Handshake error. rep is reply code sent to client, None means
+    connection is closed without reply. """
+    rep = None
 
 
 class BadVersion(SocksException):
@@ -23,183 +32,449 @@ class BadAuthMethod(SocksException):
 
 
 class BadAddress(SocksException):
-    pass
+    rep = 1
+
+
+class UnsupportedCommand(SocksException):
+    rep = 7
+
+
+class UnsupportedAddress(SocksException):
+    rep = 8
 
 
 SOCKS5REQ = struct.Struct('!BBBB')
 
+OPEN_ERROR_REPLY = {
+    asyncssh.OPEN_ADMINISTRATIVELY_PROHIBITED: 2,
+    asyncssh.OPEN_CONNECT_FAILED: 5,
+}
+
+
+def parse_greeting(buf):
+    """ Parses method selection message at the start of buf. Returns its
+    length or None if it is incomplete. """
+    if len(buf) < 2:
+        return None
+    if buf[0] != 5:
+        raise BadVersion("Incorrect protocol version")
+    if buf[1] == 0:
+        raise BadAuthMethod("Client didn't proposed any auth method, "
+                            "even \"NO AUTHENTICATION REQUIRED\" method")
+    size = 2 + buf[1]
+    if len(buf) < size:
+        return None
+    if 0 not in buf[2:size]:
+        raise BadAuthMethod("Client didn't proposed the only suitable "
+                            "\"NO AUTHENTICATION REQUIRED\" method")
+    return size
+
+
+def parse_request(buf, offset):
+    """ Parses request message starting at offset of buf. Returns command,
+    address, port and offset of request end or None if request is
+    incomplete. """
+    if len(buf) < offset + SOCKS5REQ.size + 1:
+        return None
+    ver, cmd, _, atyp = SOCKS5REQ.unpack_from(buf, offset)
+    if ver != 5:
+        raise BadVersion("Client specified inappropriate version "
+                         "in connection request")
+    if not 1 <= cmd <= 3:
+        raise UnsupportedCommand("Client requested unsupported command")
+    start = offset + SOCKS5REQ.size
+    if atyp == 1:
+        end = start + 4
+    elif atyp == 4:
+        end = start + 16
+    elif atyp == 3:
+        if buf[start] == 0:
+            raise BadAddress("Client requested connection to 0-length "
+                             "domain name")
+        start += 1
+        end = start + buf[start - 1]
+    else:
+        raise UnsupportedAddress("Client requested connection to "
+                                 "unsupported address type")
+    if len(buf) < end + 2:
+        return None
+    address = bytes(buf[start:end])
+    if atyp == 1:
+        address = socket.inet_ntoa(address)
+    elif atyp == 4:
+        address = socket.inet_ntop(socket.AF_INET6, address)
+    else:
+        try:
+            address = address.decode('ascii')
+        except UnicodeDecodeError:
+            raise BadAddress("Client requested connection to non-ASCII "
+                             "domain name") from None
+    port = int.from_bytes(buf[end:end + 2], 'big')
+    return cmd, address, port, end + 2
+
+
+class SocksHandler:
+    """ Serves SOCKS5 clients accepted by listener. HTTP listener uses it
+    too for clients detected as SOCKS5. Metrics are accounted under label
+    of listener. """
 
-class SocksListener(BaseListener):  # pylint: disable=too-many-instance-attributes
     def __init__(self, *,
-                 listen_address,
-                 listen_port,
                  pool,
+                 label,
                  timeout=4,
+                 optimistic=False,
+                 udp_helper=None,
+                 resolver=None,
+                 shaper=None,
+                 router=None,
                  loop=None):
         self._loop = loop if loop is not None else asyncio.get_event_loop()
         self._logger = logging.getLogger(self.__class__.__name__)
-        self._listen_address = listen_address
-        self._listen_port = listen_port
-        self._children = set()
-        self._server = None
         self._pool = pool
         self._timeout = timeout
+        self._shaper = shaper
+        self._optimistic = optimistic
+        self._udp_helper = udp_helper
+        self._resolver = resolver
+        self._router = router
 
-    async def stop(self):
-        self._server.close()
-        await self._server.wait_closed()
-        while self._children:
-            children = list(self._children)
-            self._children.clear()
-            self._logger.debug("Cancelling %d client handlers...",
-                               len(children))
-            for task in children:
-                task.cancel()
-            await asyncio.wait(children)
-            # workaround for TCP server keeps spawning handlers for a while
-            # after wait_closed() completed
-            await asyncio.sleep(.5)
+        self._handshake_hist = metrics.LISTENER_HANDSHAKE_LATENCY.labels(label)
+        self._open_hist = metrics.LISTENER_OPEN_LATENCY.labels(label)
+        self._open_failures = metrics.LISTENER_OPEN_FAILURES.labels(label)
+        self._rejected = metrics.LISTENER_REJECTED.labels(label)
+        self._tx_bytes = metrics.RELAY_BYTES.labels(label, 'upstream')
+        self._rx_bytes = metrics.RELAY_BYTES.labels(label, 'downstream')
 
     async def _socks_prologue(self, reader, writer):
-        ver = await reader.readexactly(1)
-        if ver != b'\x05':
-            raise BadVersion("Incorrect protocol version")
-
-        n_methods = await reader.readexactly(1)
-        n_methods = int.from_bytes(n_methods, 'big')
-        if n_methods == 0:
-            writer.write(b'\x05\xff')
-            raise BadAuthMethod("Client didn't proposed any auth method, "
-                                "even \"NO AUTHENTICATION REQUIRED\" method")
-
-        methods = await reader.readexactly(n_methods)
-        if b'\x00' not in methods:
+        """ Reads SOCKS5 method selection and request messages. Everything
+        client has sent so far is parsed at once, so greeting pipelined with
+        request takes single read. Data following request is left in
+        reader. """
+        buf = bytearray()
+        greeting = None
+        request = None
+        try:
+            while request is None:
+                data = await reader.read(SOCKS_HANDSHAKE_MAX)
+                if not data:
+                    raise asyncio.IncompleteReadError(bytes(buf), None)
+                buf += data
+                if greeting is None:
+                    greeting = parse_greeting(buf)
+                    if greeting is None:
+                        continue
+                    writer.write(b'\x05\x00')
+                request = parse_request(buf, greeting)
+        except BadAuthMethod:
             writer.write(b'\x05\xff')
-            raise BadAuthMethod("Client didn't proposed the only suitable "
-                                "\"NO AUTHENTICATION REQUIRED\" method")
-
-        writer.write(b'\x05\x00')
-
-        req_header = await reader.readexactly(SOCKS5REQ.size)
-        req_ver, req_cmd, req_rsv, req_atyp = SOCKS5REQ.unpack(req_header)
-        if req_ver != 5:
-            ...
-            raise BadVersion("Client specified inappropriate version "
-                             "in connection request")
-        if not (1 <= req_cmd <= 3):
-            writer.write(b'\x05\x07')
-            raise UnsupportedCommand("Client requested unsupported command")
-
-        if req_atyp not in (1,3,4):
-            writer.write(b'\x05\x08')
-            raise UnsupportedAddress("Client requested connection to "
-                                     "unsupported address type")
-
-        if req_atyp == 3:
-            # FQDN address
-            fqdn_len = await reader.readexactly(1)
-            fqdn_len = int.from_bytes(fqdn_len, 'big')
-            if fqdn_len == 0:
-                writer.write(b'\x05\x01')
-                raise BadAddress("Client requested connection to 0-length "
-                                 "domain name")
-            address = (await reader.readexactly(fqdn_len)).decode('ascii')
-        elif req_atyp == 1:
-            # IPv4 address
-            address = await reader.readexactly(4)
-            address = socket.inet_ntoa(address)
-        elif req_atyp == 4:
-            # IPv6 address
-            address = await reader.readexactly(16)
-            address = socket.inet_ntop(socket.AF_INET6, address)
-        port = await reader.readexactly(2)
-        port = int.from_bytes(port, 'big')
-        return req_cmd, address, port
+            raise
+        except SocksException as exc:
+            if exc.rep is not None:
+                self._socks_fail(writer, exc.rep)
+            raise
+        cmd, address, port, end = request
+        reader._buffer[0:0] = buf[end:]  # pylint: disable=protected-access
+        return cmd, address, port
 
     async def _socks_ok(self, reader, writer, peer):
-        peer_addr, peer_port = peer
+        peer_addr, peer_port = peer[:2]
         peer_af = None
         try:
             peer_af = detect_af(peer_addr)
-        except:
+        except OSError:
             pass
         if peer_af == socket.AF_INET:
             resp = (b'\x05\x00\x00\x01' + socket.inet_aton(peer_addr) +
                     peer_port.to_bytes(2, 'big'))
         elif peer_af == socket.AF_INET6:
-            resp = (b'\x05\x00\x00\x04' + socket.inet_pton(AF_INET6, peer_addr) +
+            resp = (b'\x05\x00\x00\x04' +
+                    socket.inet_pton(socket.AF_INET6, peer_addr) +
                     peer_port.to_bytes(2, 'big'))
         else:
             resp = b'\x05\x00\x00\x03\x00\x00\x00'
         self._logger.debug("Sending response to client: %s", resp.hex())
         writer.write(resp)
 
-    async def _pump(self, writer, reader):
-        while True:
-            data = await reader.read(BUFSIZE)
-            if not data:
-                break
-            writer.write(data)
-            await writer.drain()
+    def _socks_fail(self, writer, rep):
+        resp = b'\x05' + bytes((rep,)) + b'\x00\x01\x00\x00\x00\x00\x00\x00'
+        self._logger.debug("Sending response to client: %s", resp.hex())
+        writer.write(resp)
+
+    async def _udp_associate(self, reader, writer, peer_addr, client_port):
+        """ Serves UDP ASSOCIATE request. Association lasts until client
+        closes control connection or tunnel to UDP helper is lost. """
+        if self._udp_helper is None:
+            self._socks_fail(writer, 7)
+            return
+        assoc = UDPAssociation(client_host=peer_addr[0],
+                               client_port=client_port,
+                               loop=self._loop)
+        control = tunnel = None
+        try:
+            try:
+                await assoc.open(self._pool, self._udp_helper,
+                                 writer.get_extra_info('sockname')[0],
+                                 self._timeout)
+            except asyncssh.ChannelOpenError as exc:
+                self._open_failures.inc()
+                self._logger.info("Client %s: UDP association failed: %s",
+                                  peer_addr, exc.reason)
+                self._socks_fail(writer, 1)
+                return
+            except asyncio.TimeoutError:
+                self._open_failures.inc()
+                self._logger.info("Client %s: UDP association timed out",
+                                  peer_addr)
+                self._socks_fail(writer, 4)
+                return
+            except PoolOverloaded:
+                self._rejected.inc()
+                self._logger.warning("Client %s: UDP association shed: "
+                                     "pool is overloaded", peer_addr)
+                self._socks_fail(writer, 1)
+                return
+            except OSError as exc:
+                # Local UDP socket bind failed or SSH connection was lost
+                self._open_failures.inc()
+                self._logger.info("Client %s: UDP association failed: %s",
+                                  peer_addr, str(exc))
+                self._socks_fail(writer, 1)
+                return
+            await self._socks_ok(reader, writer, assoc.sockname)
+            self._logger.info("Client %s: UDP association bound to %s:%d",
+                              peer_addr, *assoc.sockname)
+
+            async def drain_control():
+                try:
+                    while await reader.read(4096):
+                        pass
+                except ConnectionError:
+                    pass
+            control = self._loop.create_task(drain_control())
+            tunnel = self._loop.create_task(assoc.wait())
+            await asyncio.wait((control, tunnel),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (control, tunnel):
+                if task is not None:
+                    task.cancel()
+            assoc.close()
 
     async def handler(self, reader, writer):
         peer_addr = writer.transport.get_extra_info('peername')
         self._logger.info("Client %s connected", str(peer_addr))
-        dst_writer = None
+        relay = None
+        started = self._loop.time()
         try:
             cmd, dst_addr, dst_port = await self._socks_prologue(reader, writer)
+            self._handshake_hist.observe(self._loop.time() - started)
+            if cmd == 3:
+                await self._udp_associate(reader, writer, peer_addr, dst_port)
+                return
             if cmd != 1:
-                writer.write(b'\x05\x07')
+                self._socks_fail(writer, 7)
                 return
             self._logger.info("Client %s requested connection to %s:%s",
                               peer_addr, dst_addr, dst_port)
-            async with self._pool.borrow() as ssh_conn:
-                dst_reader, dst_writer = await asyncio.wait_for(
-                    ssh_conn.open_connection(dst_addr, dst_port),
-                    self._timeout)
-                await self._socks_ok(reader, writer, writer.get_extra_info('sockname'))
-                t1 = asyncio.ensure_future(self._pump(writer, dst_reader))
-                t2 = asyncio.ensure_future(self._pump(dst_writer, reader))
+            host = dst_addr
+            if self._resolver is not None:
                 try:
-                    await asyncio.gather(t1, t2)
-                finally:
-                    self._logger.debug("Client %s: gather finally begin", peer_addr)
-                    for t in (t1, t2):
-                        if not t.done():
-                            t.cancel()
-                            while not t.done():
-                                try:
-                                    await t
-                                except asyncio.CancelledError:
-                                    pass
-                    self._logger.debug("Client %s: gather finally end", peer_addr)
+                    dst_addr = await self._resolver.resolve(host) or host
+                except HostNotFound:
+                    self._open_failures.inc()
+                    self._logger.info("Client %s: host %s not found",
+                                      peer_addr, host)
+                    self._socks_fail(writer, 4)
+                    return
+            route = (self._router.route(host, dst_addr)
+                     if self._router is not None else Route.tunnel)
+            if route is Route.reject:
+                self._logger.info("Client %s: connection to %s:%s rejected "
+                                  "by routing rules", peer_addr, host, dst_port)
+                self._socks_fail(writer, 2)
+                return
+            relay = Relay(loop=self._loop,
+                          tx_bytes=self._tx_bytes,
+                          rx_bytes=self._rx_bytes,
+                          shaper=self._shaper)
+            if self._optimistic:
+                # Reply before channel is confirmed: client data sent
+                # after reply is pipelined with channel open
+                await self._socks_ok(reader, writer,
+                                     writer.get_extra_info('sockname'))
+                relay.attach(reader, writer)
+            started = self._loop.time()
+            try:
+                if route is Route.direct:
+                    # Name is resolved locally for direct connection
+                    await relay.open_direct(host, dst_port, self._timeout)
+                else:
+                    await relay.open(self._pool, dst_addr, dst_port,
+                                     self._timeout, host, peer_addr[0])
+            except PoolOverloaded:
+                self._rejected.inc()
+                self._logger.warning("Client %s: connection to %s:%s shed: "
+                                     "pool is overloaded",
+                                     peer_addr, dst_addr, dst_port)
+                if not self._optimistic:
+                    self._socks_fail(writer, 1)
+                return
+            except asyncssh.ChannelOpenError as exc:
+                self._open_failures.inc()
+                self._logger.info("Client %s: connection to %s:%s failed: %s",
+                                  peer_addr, dst_addr, dst_port, exc.reason)
+                if not self._optimistic:
+                    self._socks_fail(writer, OPEN_ERROR_REPLY.get(exc.code, 1))
+                return
+            except asyncio.TimeoutError:
+                self._open_failures.inc()
+                self._logger.info("Client %s: connection to %s:%s timed out",
+                                  peer_addr, dst_addr, dst_port)
+                if not self._optimistic:
+                    self._socks_fail(writer, 4)
+                return
+            except OSError as exc:
+                # Direct connection failed or SSH connection was lost
+                self._open_failures.inc()
+                self._logger.info("Client %s: %s connection to %s:%s "
+                                  "failed: %s", peer_addr, route, dst_addr,
+                                  dst_port, str(exc))
+                if not self._optimistic:
+                    if route is not Route.direct:
+                        rep = 1
+                    elif isinstance(exc, ConnectionRefusedError):
+                        rep = 5
+                    else:
+                        rep = 4
+                    self._socks_fail(writer, rep)
+                return
+            self._open_hist.observe(self._loop.time() - started)
+            if not self._optimistic:
+                await self._socks_ok(reader, writer,
+                                     writer.get_extra_info('sockname'))
+                relay.attach(reader, writer)
+            await relay.wait()
         except asyncio.CancelledError:  # pylint: disable=try-except-raise
             raise
         except ConnectionResetError:
             self._logger.debug("Connection for client %s has been reset", peer_addr)
+        except asyncio.IncompleteReadError:
+            self._logger.debug("Client %s disconnected during handshake",
+                               peer_addr)
+        except SocksException as exc:
+            self._logger.info("Client %s: bad SOCKS5 handshake: %s",
+                              peer_addr, str(exc))
         except Exception as exc:  # pragma: no cover
             self._logger.exception("Connection handler stopped with exception:"
                                    " %s", str(exc))
         finally:
             self._logger.info("Client %s disconnected", str(peer_addr))
-            if dst_writer is not None:
-                dst_writer.close()
+            if relay is not None:
+                relay.close()
             writer.close()
 
+
+class SocksListener(BaseListener):  # pylint: disable=too-many-instance-attributes
+    def __init__(self, *,
+                 listen_address,
+                 listen_port,
+                 pool,
+                 timeout=4,
+                 reuse_port=False,
+                 sock=None,
+                 optimistic=False,
+                 udp_helper=None,
+                 resolver=None,
+                 max_clients=None,
+                 limiter=None,
+                 shaper=None,
+                 router=None,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._listen_address = listen_address
+        self._listen_port = listen_port
+        self._children = set()
+        self._server = None
+        self._reuse_port = reuse_port
+        self._sock = sock
+        self._max_clients = max_clients
+        self._limiter = limiter
+
+        label = "%s:%d" % (listen_address, listen_port)
+        self._socks = SocksHandler(pool=pool,
+                                   label=label,
+                                   timeout=timeout,
+                                   optimistic=optimistic,
+                                   udp_helper=udp_helper,
+                                   resolver=resolver,
+                                   shaper=shaper,
+                                   router=router,
+                                   loop=self._loop)
+        metrics.LISTENER_CLIENTS.labels(label).set_function(
+            lambda: len(self._children))
+        self._rejected = metrics.LISTENER_REJECTED.labels(label)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        while self._children:
+            children = list(self._children)
+            self._children.clear()
+            self._logger.debug("Cancelling %d client handlers...",
+                               len(children))
+            for task in children:
+                task.cancel()
+            await asyncio.wait(children)
+            # workaround for TCP server keeps spawning handlers for a while
+            # after wait_closed() completed
+            await asyncio.sleep(.5)
+
+    async def drain(self, timeout):
+        """ Stops accepting clients and waits up to timeout seconds for
+        active ones to finish """
+        self._server.close()
+        if self._children and timeout:
+            self._logger.info("Waiting for %d clients to finish...",
+                              len(self._children))
+            await asyncio.wait(list(self._children), timeout=timeout)
+
     async def start(self):
         def _spawn(reader, writer):
+            peer_addr = writer.get_extra_info('peername')
             def task_cb(task, fut):
                 self._children.discard(task)
-            task = self._loop.create_task(self.handler(reader, writer))
+                if self._limiter is not None:
+                    self._limiter.leave(peer_addr[0])
+            if ((self._max_clients is not None and
+                 len(self._children) >= self._max_clients) or
+                    (self._limiter is not None and
+                     not self._limiter.admit(peer_addr[0]))):
+                self._rejected.inc()
+                self._logger.warning("Client %s rejected: clients limit "
+                                     "reached", peer_addr)
+                # Refuse with "no acceptable methods" reply
+                writer.write(b'\x05\xff')
+                writer.close()
+                return
+            task = self._loop.create_task(self._socks.handler(reader,
+                                                              writer))
             self._children.add(task)
             task.add_done_callback(partial(task_cb, task))
 
-        self._server = await asyncio.start_server(_spawn,
-                                                  self._listen_address,
-                                                  self._listen_port)
+        if self._sock is not None:
+            self._server = await asyncio.start_server(_spawn, sock=self._sock)
+        else:
+            self._server = await asyncio.start_server(
+                _spawn, self._listen_address, self._listen_port,
+                reuse_port=self._reuse_port)
         self._logger.info("SOCKS5 server listening on %s:%d",
                           self._listen_address, self._listen_port)
 
+    @property
+    def sockets(self):
+        return self._server.sockets
+
     async def __aenter__(self):
         await self.start()
         return self
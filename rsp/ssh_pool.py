@@ -1,26 +1,74 @@
 import asyncio
 import logging
 import collections
+import math
+import random
 from functools import partial
 
 import asyncssh
 
+from . import metrics
+from .admission import FairQueue, PoolOverloaded
+from .addresses import AddressBook, race_connect
+from .window import WindowTuner
+from .constants import EWMA_ALPHA, UNHEALTHY_FAILURES, AUTOSCALE_INTERVAL, \
+    AUTOSCALE_WINDOW, MAX_BACKOFF, KEEPALIVE_COUNT
+
+
+def ewma(avg, sample):
+    return sample if avg is None else avg + EWMA_ALPHA * (sample - avg)
+
+
+def is_transport_failure(exc):
+    """ Tells if exception means SSH connection itself is gone. Channel
+    opens pending on dropped connection fail with OPEN_CONNECT_FAILED, the
+    same code server uses for refused destination, so reason is checked. """
+    if isinstance(exc, asyncssh.ChannelOpenError):
+        return (exc.code == asyncssh.OPEN_CONNECT_FAILED and
+                exc.reason == 'SSH connection closed')
+    return isinstance(exc, (asyncssh.DisconnectError, ConnectionError))
+
 
 class SSHPoolBorrow:
-    def __init__(self, get, release):
+    def __init__(self, get, release, discard):
         self._conn = None
         self._get = get
         self._release = release
+        self._discard = discard
 
     async def __aenter__(self):
         self._conn = await self._get()
         return self._conn
 
-    async def __aexit__(self, exc, exc_type, tb):
-        if exc_type is None:
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc is not None and is_transport_failure(exc):
+            self._discard(self._conn)
+        else:
             self._release(self._conn)
 
 
+class _ConnState:
+    __slots__ = ('born', 'last_used', 'rtt')
+
+    def __init__(self, now):
+        self.born = now
+        self.last_used = now
+        self.rtt = None
+
+
+class _PoolClient(asyncssh.SSHClient):
+    def __init__(self, on_lost):
+        self._on_lost = on_lost
+        self._conn = None
+
+    def connection_made(self, conn):
+        self._conn = conn
+
+    def connection_lost(self, exc):
+        if self._conn is not None:
+            self._on_lost(self._conn)
+
+
 class SSHPool:
     def __init__(self, *,
                  dst_address,
@@ -30,6 +78,16 @@ class SSHPool:
                  timeout=4,
                  backoff=5,
                  size=15,
+                 max_channels=1,
+                 check_interval=None,
+                 max_idle=None,
+                 max_lifetime=None,
+                 min_size=None,
+                 max_size=None,
+                 affinity=None,
+                 max_waiters=None,
+                 max_waiters_per_source=None,
+                 window_budget=None,
                  loop=None):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._loop = loop if loop is not None else asyncio.get_event_loop()
@@ -39,15 +97,72 @@ class SSHPool:
         self._ssh_options = ssh_options
         self._size = size
         self._backoff = backoff
-        self._waiters = collections.deque()
+        self._addresses = AddressBook(dst_address, dst_port, loop=self._loop)
+        self._waiters = FairQueue()
+        self._max_waiters = max_waiters
+        self._max_waiters_per_source = max_waiters_per_source
         self._reserve = collections.deque()
+        self._max_channels = max_channels
+        self._shared = dict()
+        self._borrows = 0
+        self._state = dict()
+        self._check_interval = check_interval
+        self._max_idle = max_idle
+        self._max_lifetime = max_lifetime
+        self._health_task = None
+        self._connect_latency = None
+        self._open_latency = None
+        self._failures = 0
+        self._min_size = min_size if min_size is not None else 1
+        self._max_size = max_size
+        self._autoscale_task = None
+        self._window = collections.deque(
+            maxlen=math.ceil(AUTOSCALE_WINDOW / AUTOSCALE_INTERVAL))
+        self._borrow_count = 0
+        self._peak_borrows = 0
+        self._peak_waiters = 0
         self._ratelimit = ratelimit
+        self._affinity = affinity
+        self._tuner = (WindowTuner(window_budget, loop=self._loop)
+                       if window_budget is not None else None)
+        self._min_rtt = None
         self._tasks = set()
+        self._retiring = set()
+
+        name = self.name
+        metrics.POOL_RESERVE.labels(name).set_function(
+            lambda: len(self._reserve))
+        metrics.POOL_SHARED.labels(name).set_function(
+            lambda: len(self._shared))
+        metrics.POOL_WAITERS.labels(name).set_function(
+            lambda: len(self._waiters))
+        metrics.POOL_BUILDS.labels(name).set_function(
+            lambda: len(self._tasks))
+        metrics.POOL_TARGET.labels(name).set_function(lambda: self._size)
+        metrics.RATELIMIT_QUEUE.labels(name).set_function(
+            lambda: self._ratelimit.queue_depth)
+        self._connect_hist = metrics.POOL_CONNECT_LATENCY.labels(name)
+        self._connect_failures = metrics.POOL_CONNECT_FAILURES.labels(name)
+        self._backoffs = metrics.POOL_BACKOFFS.labels(name)
+        self._evictions = metrics.POOL_EVICTIONS.labels(name)
+        self._affinity_hits = metrics.POOL_AFFINITY_HITS.labels(name)
+        self._shed = metrics.POOL_SHED.labels(name)
 
     async def start(self):
         self._rebalance_pool()
+        if self._check_interval:
+            self._health_task = self._loop.create_task(self._health_loop())
+        if self._max_size:
+            self._autoscale_task = self._loop.create_task(self._autoscale_loop())
 
     async def stop(self):
+        for task in (self._health_task, self._autoscale_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.wait((task,))
+        self._health_task = self._autoscale_task = None
+        self._state.clear()
+        self._retiring.clear()
         while self._tasks:
             tasks = list(self._tasks)
             self._tasks.clear()
@@ -56,6 +171,8 @@ class SSHPool:
             await asyncio.wait(tasks)
         for conn in self._reserve:
             conn.abort()
+        for conn in self._shared:
+            conn.abort()
 
     def _task_done_cb(self, task):
         if not task.cancelled():
@@ -68,70 +185,379 @@ class SSHPool:
                                            "task: %s", str(exc))
         self._tasks.discard(task)
 
+    def _free_slots(self):
+        # Retiring connections take no new channels
+        retiring_borrows = sum(self._shared[conn] for conn in self._retiring)
+        return ((len(self._reserve) + len(self._shared) -
+                 len(self._retiring)) * self._max_channels -
+                self._borrows + retiring_borrows)
+
     def _rebalance_pool(self):
-        debt = self._size - len(self._reserve) + len(self._waiters) - len(self._tasks)
+        # Debt is measured in connections: spare channel capacity is
+        # converted to whole connections and every waiter needs a slot.
+        # Finished builds stay in tasks until their done callback runs, so
+        # only unfinished ones count.
+        spare = self.spare
+        wanted = -(-len(self._waiters) // self._max_channels)
+        building = sum(not task.done() for task in self._tasks)
+        debt = self._size - spare + wanted - building
         self._logger.debug("_rebalance_pool: debt=%d; len(reserve)=%d, "
-                           "len(waiters)=%d, len(tasks)=%d", debt,
-                           len(self._reserve), len(self._waiters),
-                           len(self._tasks))
+                           "len(shared)=%d, len(waiters)=%d, building=%d",
+                           debt, len(self._reserve), len(self._shared),
+                           len(self._waiters), building)
         for i in range(debt):
             task = self._loop.create_task(self._build_conn())
             task.add_done_callback(self._task_done_cb)
             self._tasks.add(task)
 
+    def _backoff_delay(self, attempts):
+        """ Exponential backoff with equal jitter, grows with consecutive
+        failed attempts of one connection build """
+        cap = max(self._backoff, MAX_BACKOFF)
+        delay = min(self._backoff * 2 ** max(attempts - 1, 0), cap)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _connect(self):
+        """ Races TCP connections to upstream addresses and runs SSH
+        handshake over the winner. Host key is checked against configured
+        host name. """
+        addresses = await self._addresses.candidates()
+        sock, address = await race_connect(addresses, self._addresses.report,
+                                           loop=self._loop)
+        self._logger.debug("Connected to upstream address %s", address[1][0])
+        kw = ({'keepalive_interval': self._check_interval,
+               'keepalive_count_max': KEEPALIVE_COUNT}
+              if self._check_interval else {})
+        try:
+            return await asyncssh.connect(self._dst_address,
+                                          self._dst_port,
+                                          sock=sock,
+                                          options=self._ssh_options,
+                                          client_factory=partial(_PoolClient,
+                                                                 self._evict),
+                                          **kw)
+        except BaseException:
+            sock.close()
+            raise
+
     async def _build_conn(self):
+        # Pool-wide failure count tracks health, while backoff of each build
+        # grows with its own attempts only: concurrent builds failing at
+        # once must not push each other to maximum delay
+        attempts = 0
+
         async def fail():
-            self._logger.debug("Failed upstream connection. Backoff for %d "
-                               "seconds", self._backoff)
-            await asyncio.sleep(self._backoff)
+            nonlocal attempts
+            attempts += 1
+            delay = self._backoff_delay(attempts)
+            self._logger.debug("Failed upstream connection. Backoff for %.2f "
+                               "seconds", delay)
+            self._connect_failures.inc()
+            self._backoffs.inc()
+            await asyncio.sleep(delay)
 
         while True:
             try:
                 async with self._ratelimit:
                     self._logger.debug("_build_conn: connect attempt.")
-                    conn = await asyncio.wait_for(
-                        asyncssh.connect(self._dst_address,
-                                         self._dst_port,
-                                         options=self._ssh_options()),
-                        self._timeout)
+                    started = self._loop.time()
+                    conn = await asyncio.wait_for(self._connect(),
+                                                  self._timeout)
                     break
             except asyncio.TimeoutError:
                 self._logger.error("Connection to upstream timed out.")
+                self._failures += 1
                 await fail()
             except asyncio.CancelledError:
                 raise
             except Exception as exc:
                 self._logger.exception("Got exception while connecting to upstream: %s", str(exc))
+                self._failures += 1
                 await fail()
         self._logger.debug("Successfully built upstream connection.")
-        while self._waiters:
-            fut = self._waiters.popleft()
-            if not fut.cancelled():
-                self._logger.warning("Pool exhausted. Dispatching connection directly to waiter!")
-                fut.set_result(conn)
-                break
+        now = self._loop.time()
+        self._connect_hist.observe(now - started)
+        self._connect_latency = ewma(self._connect_latency, now - started)
+        self._failures = 0
+        self._state[conn] = _ConnState(now)
+        if self._waiters:
+            self._logger.warning("Pool exhausted. Dispatching connection directly to waiter!")
+        self._reserve.append(conn)
+        self._dispatch_waiters()
+
+    def _expired(self, conn, now):
+        return (self._max_lifetime and
+                now - self._state[conn].born > self._max_lifetime)
+
+    def _evict(self, conn):
+        """ Removes connection from pool and closes it. Borrowers of shared
+        connection will get channel errors and their releases are ignored """
+        if self._state.pop(conn, None) is None:
+            return
+        self._retiring.discard(conn)
+        if conn in self._shared:
+            self._borrows -= self._shared.pop(conn)
         else:
-            self._reserve.append(conn)
-                    
-    async def get(self):
+            try:
+                self._reserve.remove(conn)
+            except ValueError:
+                pass
+        if self._affinity is not None:
+            self._affinity.forget(conn)
+        self._evictions.inc()
+        conn.close()
+        self._rebalance_pool()
+
+    def _sample_rtt(self, conn, rtt):
+        """ Round trip time of connection is the minimum of its channel
+        open latencies, which also include remote connect time. TCP
+        handshake is not sampled as it may complete with middlebox rather
+        than with SSH server. """
+        state = self._state.get(conn)
+        if state is not None and (state.rtt is None or rtt < state.rtt):
+            state.rtt = rtt
+        if self._min_rtt is None or rtt < self._min_rtt:
+            self._min_rtt = rtt
+
+    def _rtt(self, conn):
+        """ RTT of connection, or lowest RTT of pool until connection has
+        own samples """
+        state = self._state.get(conn)
+        if state is not None and state.rtt is not None:
+            return state.rtt
+        return self._min_rtt
+
+    async def _health_loop(self):
+        """ Recycles old and idle connections. Liveness of every pooled
+        connection, shared ones included, is checked by SSH keepalives. """
+        while True:
+            await asyncio.sleep(self._check_interval)
+            now = self._loop.time()
+            for conn in list(self._reserve):
+                state = self._state[conn]
+                if self._expired(conn, now):
+                    self._logger.debug("Recycling connection which reached "
+                                       "max lifetime.")
+                    self._evict(conn)
+                elif (self._max_idle and
+                      now - state.last_used > self._max_idle):
+                    self._logger.debug("Recycling connection which was idle "
+                                       "for too long.")
+                    self._evict(conn)
+            for conn in list(self._shared):
+                if conn not in self._retiring and self._expired(conn, now):
+                    # Closed by release() once its last channel is done
+                    self._logger.debug("Retiring shared connection which "
+                                       "reached max lifetime.")
+                    self._retiring.add(conn)
+                    self._rebalance_pool()
+
+    async def _autoscale_loop(self):
+        while True:
+            await asyncio.sleep(AUTOSCALE_INTERVAL)
+            self._window.append((self._borrow_count, self._peak_borrows,
+                                 self._peak_waiters))
+            self._borrow_count = 0
+            self._peak_borrows = self._borrows
+            self._peak_waiters = len(self._waiters)
+            self._autoscale()
+
+    def _autoscale(self):
+        """ Sizes spare capacity to cover borrows expected during the time
+        needed to build a replacement connection, plus observed shortage """
+        borrows = sum(sample[0] for sample in self._window)
+        peak_borrows = max(sample[1] for sample in self._window)
+        peak_waiters = max(sample[2] for sample in self._window)
+        rate = borrows / (len(self._window) * AUTOSCALE_INTERVAL)
+        lead = AUTOSCALE_INTERVAL + (self._connect_latency or self._timeout)
+        target = math.ceil((rate * lead + peak_waiters) / self._max_channels)
+        target = min(max(target, self._min_size), self._max_size)
+        if target < self._size:
+            # shrink gradually to avoid flapping on short pauses
+            target = self._size - 1
+        if target != self._size:
+            self._logger.debug("Autoscale: pool target %d -> %d; borrow "
+                               "rate=%.2f/s, peak borrows=%d, peak waiters=%d",
+                               self._size, target, rate, peak_borrows,
+                               peak_waiters)
+            self._size = target
+        self._rebalance_pool()
+        while (self._reserve and
+               self._free_slots() // self._max_channels > self._size):
+            self._evict(self._reserve[0])
+
+    def _acquire(self, conn):
+        self._state[conn].last_used = self._loop.time()
+        self._borrow_count += 1
+        self._borrows += 1
+        if self._borrows > self._peak_borrows:
+            self._peak_borrows = self._borrows
+        self._shared[conn] = self._shared.get(conn, 0) + 1
+
+    def _pick(self):
+        """ Returns least loaded connection with spare channel slot or None """
         if self._reserve:
-            conn = self._reserve.popleft()
+            return self._reserve.popleft()
+        if self._max_channels > 1 and self._borrows < len(self._shared) * self._max_channels:
+            candidates = [item for item in self._shared.items()
+                          if item[0] not in self._retiring]
+            if candidates:
+                conn, load = min(candidates, key=lambda item: item[1])
+                if load < self._max_channels:
+                    return conn
+        return None
+
+    def _pick_preferred(self, dst):
+        """ Returns connection which recently reached dst if it has spare
+        channel slot, or None """
+        conn = self._affinity.preferred(dst)
+        if conn is None or conn not in self._state:
+            return None
+        load = self._shared.get(conn)
+        if load is None:
+            self._reserve.remove(conn)
+        elif load >= self._max_channels or conn in self._retiring:
+            return None
+        self._affinity_hits.inc()
+        return conn
+
+    def _dispatch_waiters(self):
+        while self._waiters:
+            conn = self._pick()
+            if conn is None:
+                break
+            fut = self._waiters.popleft()
+            if fut.cancelled():
+                if conn not in self._shared:
+                    self._reserve.appendleft(conn)
+                continue
+            self._acquire(conn)
+            fut.set_result(conn)
+
+    async def get(self, dst=None, source=None):
+        """ Returns connection with free channel slot. If there is none,
+        waits for it in queue served round-robin across sources or raises
+        PoolOverloaded if waiters limit is reached. """
+        conn = None
+        if dst is not None and self._affinity is not None:
+            conn = self._pick_preferred(dst)
+        if conn is None:
+            conn = self._pick()
+        if conn is not None:
+            self._acquire(conn)
             self._rebalance_pool()
             self._logger.debug("Obtained connection from pool.")
             return conn
         else:
+            if ((self._max_waiters is not None and
+                 len(self._waiters) >= self._max_waiters) or
+                    (self._max_waiters_per_source is not None and
+                     self._waiters.count(source) >=
+                     self._max_waiters_per_source)):
+                self._shed.inc()
+                raise PoolOverloaded("Too many clients awaiting for "
+                                     "connection")
             fut = self._loop.create_future()
-            self._waiters.append(fut)
+            self._waiters.append(source, fut)
+            if len(self._waiters) > self._peak_waiters:
+                self._peak_waiters = len(self._waiters)
             self._rebalance_pool()
             self._logger.debug("Awaiting for free connection.")
-            return await fut
+            try:
+                return await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self.release(fut.result())
+                else:
+                    self._waiters.remove(source, fut)
+                raise
 
     def release(self, conn):
         self._logger.debug("Connection released.")
-        self._reserve.append(conn)
+        state = self._state.get(conn)
+        load = self._shared.pop(conn, None)
+        if state is None or load is None:
+            return
+        now = self._loop.time()
+        state.last_used = now
+        self._borrows -= 1
+        load -= 1
+        if load:
+            self._shared[conn] = load
+        elif self._expired(conn, now):
+            self._logger.debug("Recycling released connection which reached "
+                               "max lifetime.")
+            self._evict(conn)
+        else:
+            self._reserve.append(conn)
+        self._dispatch_waiters()
+
+    def discard(self, conn):
+        self._logger.debug("Connection discarded.")
+        self._evict(conn)
+        self._dispatch_waiters()
+
+    def is_alive(self, conn):
+        return conn in self._state
+
+    def report_open(self, conn, latency, dst=None):
+        self._open_latency = ewma(self._open_latency, latency)
+        self._sample_rtt(conn, latency)
+        if dst is not None and self._affinity is not None:
+            self._affinity.report_open(dst, conn, latency)
+
+    def report_failure(self, conn, dst=None):
+        """ Channel open to dst was rejected or timed out on healthy
+        connection """
+        if dst is not None and self._affinity is not None:
+            self._affinity.report_failure(dst, conn)
+
+    def report_bytes(self, dst, tx_bytes, rx_bytes):
+        if self._affinity is not None:
+            self._affinity.report_bytes(dst, tx_bytes, rx_bytes)
+
+    def channel_window(self, conn):
+        """ Returns receive window for new channel on conn or None if
+        window tuning is disabled """
+        if self._tuner is None:
+            return None
+        return self._tuner.window(partial(self._rtt, conn))
+
+    @property
+    def latency(self):
+        """ Smoothed channel open latency, or handshake latency if no
+        channels were opened yet """
+        if self._open_latency is not None:
+            return self._open_latency
+        if self._connect_latency is not None:
+            return self._connect_latency
+        return self._timeout
+
+    @property
+    def warm(self):
+        """ True when pool holds its target number of connections """
+        return len(self._state) >= self._size
+
+    @property
+    def spare(self):
+        """ Spare channel capacity expressed in whole connections """
+        return self._free_slots() // self._max_channels
+
+    @property
+    def load(self):
+        return self._borrows + len(self._waiters)
+
+    @property
+    def healthy(self):
+        return (self._failures < UNHEALTHY_FAILURES or
+                bool(self._reserve) or bool(self._shared))
+
+    @property
+    def name(self):
+        return "%s:%d" % (self._dst_address, self._dst_port)
 
     def borrow(self):
-        return SSHPoolBorrow(self.get, self.release)
+        return SSHPoolBorrow(self.get, self.release, self.discard)
 
     async def __aenter__(self):
         await self.start()
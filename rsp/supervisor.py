@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+from .asdnotify import AsyncSystemdNotifier
+from . import handoff
+
+
+RESTART_DELAY = 1.
+REAP_INTERVAL = .5
+
+
+class Supervisor:
+    """ Runs `target(index)` in `workers` forked processes, restarts
+    crashed ones and forwards termination request to them. Workers report
+    readiness with systemd notify protocol to supervisor socket and
+    supervisor reports READY=1 upstream once every worker is ready. If
+    supervisor replaces predecessor process, predecessor is notified too. """
+
+    def __init__(self, *, workers, target, predecessor=None, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._workers = workers
+        self._target = target
+        self._children = dict()
+        self._sock = None
+        self._notify_addr = '@rsp-supervisor-%d' % (os.getpid(),)
+        self._notifier = None
+        self._ready = 0
+        self._stopping = False
+        self._predecessor = predecessor
+        self._handed_over = False
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            code = 1
+            try:
+                os.setpgid(0, 0)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                self._sock.close()
+                os.environ['NOTIFY_SOCKET'] = self._notify_addr
+                self._target(index)
+                code = 0
+            except BaseException:  # pylint: disable=broad-except
+                self._logger.exception("Worker %d failed", index)
+            finally:
+                os._exit(code)  # pylint: disable=protected-access
+        self._logger.info("Started worker %d with PID %d", index, pid)
+        self._children[pid] = index
+
+    def _respawn(self, index):
+        if not self._stopping:
+            self._spawn(index)
+
+    def _reap(self):
+        # Only own workers are waited for: successor process spawned on
+        # reload is reaped by its spawner
+        for pid in list(self._children):
+            try:
+                reaped, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                reaped, status = pid, -1
+            if reaped == 0:
+                continue
+            index = self._children.pop(pid)
+            if self._stopping:
+                self._logger.info("Worker %d (PID %d) finished", index, pid)
+                continue
+            self._logger.error("Worker %d (PID %d) exited unexpectedly with "
+                               "status %d. Restarting in %.1f seconds.",
+                               index, pid, status, RESTART_DELAY)
+            self._loop.call_later(RESTART_DELAY, self._respawn, index)
+
+    def _on_notify(self):
+        while True:
+            try:
+                msg = self._sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            for line in msg.split(b'\n'):
+                if line == b'READY=1':
+                    self._ready += 1
+                    if self._ready == self._workers:
+                        self._logger.info("All workers are ready.")
+                        self._loop.create_task(handoff.notify_ready(
+                            self._notifier, self._predecessor))
+                elif line and line != b'STOPPING=1':
+                    self._loop.create_task(self._notifier.notify(line))
+
+    def hand_over(self):
+        """ Marks that successor took over service, so its termination is
+        not reported as service stop """
+        self._handed_over = True
+
+    def _signal(self, signum):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    async def run(self, exit_event):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind('\0' + self._notify_addr[1:])
+        self._loop.add_reader(self._sock.fileno(), self._on_notify)
+        try:
+            async with AsyncSystemdNotifier() as notifier:
+                self._notifier = notifier
+                for index in range(self._workers):
+                    self._spawn(index)
+                while not exit_event.is_set():
+                    self._reap()
+                    try:
+                        await asyncio.wait_for(exit_event.wait(), REAP_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                self._logger.debug("Terminating workers...")
+                self._stopping = True
+                if not self._handed_over:
+                    await notifier.notify(b"STOPPING=1")
+                self._signal(signal.SIGTERM)
+                while self._children:
+                    await asyncio.sleep(REAP_INTERVAL)
+                    self._reap()
+        finally:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
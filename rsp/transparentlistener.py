@@ -1,81 +1,86 @@
 import asyncio
 import logging
-import collections
 import socket
-import ctypes
+import struct
 from functools import partial
 
+import asyncssh
+
 from . import constants
-from .utils import detect_af
 from .baselistener import BaseListener
+from . import metrics
+from .relay import Relay
+from .admission import PoolOverloaded
+from .routing import Route
 
 
-BUFSIZE = constants.BUFSIZE
-
-
-def detect_af(addr):
-    return socket.getaddrinfo(addr,
-                              None,
-                              socket.AF_UNSPEC,
-                              0,
-                              0,
-                              socket.AI_NUMERICHOST)[0][0]
-
-
-class sockaddr(ctypes.Structure):
-    _fields_ = [('sa_family', ctypes.c_uint16),
-                ('sa_data', ctypes.c_char * 14),
-               ]
-
-
-class sockaddr_in(ctypes.Structure):
-    _fields_ = [('sin_family', ctypes.c_uint16),
-                ('sin_port', ctypes.c_uint16),
-                ('sin_addr', ctypes.c_uint32),
-               ]
+SOCKADDR_IN = struct.Struct('!2xH4s8x')
+SOCKADDR_IN6 = struct.Struct('!2xH4x16s4x')
 
 
-sockaddr_size = max(ctypes.sizeof(sockaddr_in), ctypes.sizeof(sockaddr))
-
-
-class sockaddr_in6(ctypes.Structure):
-    _fields_ = [('sin6_family', ctypes.c_uint16),
-                ('sin6_port', ctypes.c_uint16),
-                ('sin6_flowinfo', ctypes.c_uint32),
-                ('sin6_addr', ctypes.c_char * 16),
-                ('sin6_scope_id', ctypes.c_uint32),
-               ]
-
-
-sockaddr6_size = ctypes.sizeof(sockaddr_in6)
+def unmap_address(addr):
+    """ Converts IPv4-mapped IPv6 address to plain IPv4 address """
+    if addr.startswith('::ffff:') and '.' in addr:
+        return addr[7:]
+    return addr
 
 
 def get_orig_dst(sock):
+    """ Returns destination of connection redirected by NAT, as recorded by
+    conntrack """
     own_addr = sock.getsockname()[0]
-    own_af = detect_af(own_addr)
-    if own_af == socket.AF_INET:
-        buf = sock.getsockopt(socket.SOL_IP, constants.SO_ORIGINAL_DST, sockaddr_size)
-        sa = sockaddr_in.from_buffer_copy(buf)
-        addr = socket.ntohl(sa.sin_addr)
-        addr = str(addr >> 24) + '.' + str((addr >> 16) & 0xFF) + '.' + str((addr >> 8) & 0xFF) + '.' + str(addr & 0xFF)
-        port = socket.ntohs(sa.sin_port)
-        return addr, port
-    elif own_af == socket.AF_INET6:
-        buf = sock.getsockopt(constants.SOL_IPV6, constants.SO_ORIGINAL_DST, sockaddr6_size)
-        sa = sockaddr_in6.from_buffer_copy(buf)
-        addr = socket.inet_ntop(socket.AF_INET6, sa.sin6_addr)
-        port = socket.ntohs(sa.sin_port)
-        return addr, port
-    else:
-        raise RuntimeError("Unknown address family!")
+    if sock.family == socket.AF_INET6 and not own_addr.startswith('::ffff:'):
+        buf = sock.getsockopt(constants.SOL_IPV6, constants.SO_ORIGINAL_DST,
+                              SOCKADDR_IN6.size)
+        port, addr = SOCKADDR_IN6.unpack_from(buf)
+        return socket.inet_ntop(socket.AF_INET6, addr), port
+    buf = sock.getsockopt(socket.SOL_IP, constants.SO_ORIGINAL_DST,
+                          SOCKADDR_IN.size)
+    port, addr = SOCKADDR_IN.unpack_from(buf)
+    return socket.inet_ntoa(addr), port
+
+
+def tproxy_socket(host, port, reuse_port=False):
+    """ Creates listening socket which accepts connections diverted by
+    TPROXY rule. IPv6 socket also accepts IPv4 connections, so single
+    listener on "::" serves both families. """
+    family, _, _, _, sockaddr = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            sock.setsockopt(constants.SOL_IPV6, constants.IPV6_TRANSPARENT, 1)
+        else:
+            sock.setsockopt(socket.SOL_IP, constants.IP_TRANSPARENT, 1)
+        sock.bind(sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
 
 
 class TransparentListener(BaseListener):  # pylint: disable=too-many-instance-attributes
+    """ Serves connections intercepted on gateway. By default connections
+    are expected to be redirected by NAT and destination is looked up in
+    conntrack. In TPROXY mode connections keep their original destination
+    address, which is just local address of accepted socket. """
+
     def __init__(self, *,
                  listen_address,
                  listen_port,
                  pool,
                  timeout=4,
+                 reuse_port=False,
+                 sock=None,
+                 max_clients=None,
+                 limiter=None,
+                 shaper=None,
+                 tproxy=False,
+                 router=None,
                  loop=None):
         self._loop = loop if loop is not None else asyncio.get_event_loop()
         self._logger = logging.getLogger(self.__class__.__name__)
@@ -85,6 +90,23 @@ class TransparentListener(BaseListener):  # pylint: disable=too-many-instance-at
         self._server = None
         self._pool = pool
         self._timeout = timeout
+        self._reuse_port = reuse_port
+        self._sock = sock
+        self._max_clients = max_clients
+        self._limiter = limiter
+        self._shaper = shaper
+        self._tproxy = tproxy
+        self._router = router
+
+        label = "%s:%d" % (listen_address, listen_port)
+        metrics.LISTENER_CLIENTS.labels(label).set_function(
+            lambda: len(self._children))
+        self._handshake_hist = metrics.LISTENER_HANDSHAKE_LATENCY.labels(label)
+        self._open_hist = metrics.LISTENER_OPEN_LATENCY.labels(label)
+        self._open_failures = metrics.LISTENER_OPEN_FAILURES.labels(label)
+        self._rejected = metrics.LISTENER_REJECTED.labels(label)
+        self._tx_bytes = metrics.RELAY_BYTES.labels(label, 'upstream')
+        self._rx_bytes = metrics.RELAY_BYTES.labels(label, 'downstream')
 
     async def stop(self):
         self._server.close()
@@ -101,65 +123,118 @@ class TransparentListener(BaseListener):  # pylint: disable=too-many-instance-at
             # after wait_closed() completed
             await asyncio.sleep(.5)
 
-    async def _pump(self, writer, reader):
-        while True:
-            data = await reader.read(BUFSIZE)
-            if not data:
-                break
-            writer.write(data)
-            await writer.drain()
+    async def drain(self, timeout):
+        """ Stops accepting clients and waits up to timeout seconds for
+        active ones to finish """
+        self._server.close()
+        if self._children and timeout:
+            self._logger.info("Waiting for %d clients to finish...",
+                              len(self._children))
+            await asyncio.wait(list(self._children), timeout=timeout)
 
     async def handler(self, reader, writer):
         peer_addr = writer.transport.get_extra_info('peername')
         self._logger.info("Client %s connected", str(peer_addr))
-        dst_writer = None
+        relay = None
+        dst_addr = dst_port = None
+        started = self._loop.time()
         try:
-            # Instead get dst addr from socket options
-            sock = writer.transport.get_extra_info('socket')
-            dst_addr, dst_port = get_orig_dst(sock)
+            if self._tproxy:
+                dst_addr, dst_port = writer.get_extra_info('sockname')[:2]
+                dst_addr = unmap_address(dst_addr)
+            else:
+                dst_addr, dst_port = get_orig_dst(
+                    writer.get_extra_info('socket'))
+            self._handshake_hist.observe(self._loop.time() - started)
             self._logger.info("Client %s requested connection to %s:%s",
                               peer_addr, dst_addr, dst_port)
-            async with self._pool.borrow() as ssh_conn:
-                dst_reader, dst_writer = await asyncio.wait_for(
-                    ssh_conn.open_connection(dst_addr, dst_port),
-                    self._timeout)
-                t1 = asyncio.ensure_future(self._pump(writer, dst_reader))
-                t2 = asyncio.ensure_future(self._pump(dst_writer, reader))
-                try:
-                    await asyncio.gather(t1, t2)
-                finally:
-                    for t in (t1, t2):
-                        if not t.done():
-                            t.cancel()
-                            while not t.done():
-                                try:
-                                    await t
-                                except asyncio.CancelledError:
-                                    pass
+            route = (self._router.route(dst_addr)
+                     if self._router is not None else Route.tunnel)
+            if route is Route.reject:
+                self._logger.info("Client %s: connection to %s:%s rejected "
+                                  "by routing rules", peer_addr, dst_addr,
+                                  dst_port)
+                return
+            relay = Relay(loop=self._loop,
+                          tx_bytes=self._tx_bytes,
+                          rx_bytes=self._rx_bytes,
+                          shaper=self._shaper)
+            # Destination is known up front, so client data is accepted
+            # while channel is being opened
+            relay.attach(reader, writer)
+            started = self._loop.time()
+            if route is Route.direct:
+                await relay.open_direct(dst_addr, dst_port, self._timeout)
+            else:
+                await relay.open(self._pool, dst_addr, dst_port,
+                                 self._timeout, source=peer_addr[0])
+            self._open_hist.observe(self._loop.time() - started)
+            await relay.wait()
         except asyncio.CancelledError:  # pylint: disable=try-except-raise
             raise
+        except asyncssh.ChannelOpenError as exc:
+            self._open_failures.inc()
+            self._logger.info("Client %s: connection to %s:%s failed: %s",
+                              peer_addr, dst_addr, dst_port, exc.reason)
+        except asyncio.TimeoutError:
+            self._open_failures.inc()
+            self._logger.info("Client %s: connection to %s:%s timed out",
+                              peer_addr, dst_addr, dst_port)
+        except OSError as exc:
+            self._open_failures.inc()
+            self._logger.info("Client %s: connection to %s:%s failed: %s",
+                              peer_addr, dst_addr, dst_port, str(exc))
+        except PoolOverloaded:
+            self._rejected.inc()
+            self._logger.warning("Client %s: connection to %s:%s shed: "
+                                 "pool is overloaded",
+                                 peer_addr, dst_addr, dst_port)
         except Exception as exc:  # pragma: no cover
             self._logger.exception("Connection handler stopped with exception:"
                                    " %s", str(exc))
         finally:
             self._logger.info("Client %s disconnected", str(peer_addr))
-            if dst_writer is not None:
-                dst_writer.close()
+            if relay is not None:
+                relay.close()
             writer.close()
 
     async def start(self):
         def _spawn(reader, writer):
+            peer_addr = writer.get_extra_info('peername')
             def task_cb(task, fut):
                 self._children.discard(task)
+                if self._limiter is not None:
+                    self._limiter.leave(peer_addr[0])
+            if ((self._max_clients is not None and
+                 len(self._children) >= self._max_clients) or
+                    (self._limiter is not None and
+                     not self._limiter.admit(peer_addr[0]))):
+                self._rejected.inc()
+                self._logger.warning("Client %s rejected: clients limit "
+                                     "reached", peer_addr)
+                writer.close()
+                return
             task = self._loop.create_task(self.handler(reader, writer))
             self._children.add(task)
             task.add_done_callback(partial(task_cb, task))
 
-        self._server = await asyncio.start_server(_spawn,
-                                                  self._listen_address,
-                                                  self._listen_port)
-        self._logger.info("Transparent Proxy server listening on %s:%d",
-                          self._listen_address, self._listen_port)
+        if self._sock is not None:
+            self._server = await asyncio.start_server(_spawn, sock=self._sock)
+        elif self._tproxy:
+            sock = tproxy_socket(self._listen_address, self._listen_port,
+                                 self._reuse_port)
+            self._server = await asyncio.start_server(_spawn, sock=sock)
+        else:
+            self._server = await asyncio.start_server(
+                _spawn, self._listen_address, self._listen_port,
+                reuse_port=self._reuse_port)
+        self._logger.info("Transparent Proxy server listening on %s:%d%s",
+                          self._listen_address, self._listen_port,
+                          " (TPROXY)" if self._tproxy else "")
+
+    @property
+    def sockets(self):
+        return self._server.sockets
 
     async def __aenter__(self):
         await self.start()
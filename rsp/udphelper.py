@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import logging
+import signal
+import socket
+from functools import partial
+
+from . import utils
+from .constants import LogLevel, UDP_HELPER_PORT
+from .udprelay import FrameReader, FrameWriter, parse_address, pack_address
+
+
+RESOLVE_CACHE_SIZE = 1024
+RESOLVE_CACHE_TTL = 60
+READ_SIZE = 65536
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Rapid SSH Proxy: UDP helper. Runs next to SSH server "
+        "and sends datagrams of SOCKS5 UDP associations tunneled through "
+        "SSH channels",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-v", "--verbosity",
+                        help="logging verbosity",
+                        type=utils.check_loglevel,
+                        choices=LogLevel,
+                        default=LogLevel.info)
+    parser.add_argument("-l", "--logfile",
+                        help="log file location",
+                        metavar="FILE")
+    parser.add_argument("--disable-uvloop",
+                        help="do not use uvloop even if it is available",
+                        action="store_true")
+
+    listen_group = parser.add_argument_group('listen options')
+    listen_group.add_argument("-a", "--bind-address",
+                              default="127.0.0.1",
+                              help="bind address")
+    listen_group.add_argument("-p", "--bind-port",
+                              default=UDP_HELPER_PORT,
+                              type=utils.check_port,
+                              help="bind port")
+    listen_group.add_argument("-u", "--unix-socket",
+                              help="listen on UNIX socket at this path "
+                              "instead of TCP port",
+                              metavar="PATH")
+
+    return parser.parse_args()
+
+
+class _RemoteDatagrams(asyncio.DatagramProtocol):
+    """ Frames replies into stream transport. Like on client side, replies
+    are dropped while transport buffer is above its high-water mark. """
+
+    def __init__(self, writer, transport):
+        self._writer = writer
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        transport = self._transport
+        self._writer.paused = (transport.get_write_buffer_size() >
+                               transport.get_write_buffer_limits()[1])
+        self._writer.send(pack_address(addr[0], addr[1]) + data)
+
+    def error_received(self, exc):
+        pass
+
+
+class UDPHelper:
+    """ Accepts stream connections carrying framed datagrams. Each
+    connection gets its own UDP sockets (one per address family), replies
+    are framed back with their source address. """
+
+    def __init__(self, *,
+                 listen_address=None,
+                 listen_port=None,
+                 unix_path=None,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._listen_address = listen_address
+        self._listen_port = listen_port
+        self._unix_path = unix_path
+        self._children = set()
+        self._server = None
+        self._resolved = dict()
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        while self._children:
+            children = list(self._children)
+            self._children.clear()
+            for task in children:
+                task.cancel()
+            await asyncio.wait(children)
+
+    async def _resolve(self, host, port):
+        now = self._loop.time()
+        cached = self._resolved.get(host)
+        if cached is not None and cached[0] > now:
+            return cached[1], (cached[2], port)
+        info = await self._loop.getaddrinfo(host, port,
+                                            type=socket.SOCK_DGRAM)
+        family, _, _, _, addr = info[0]
+        if len(self._resolved) >= RESOLVE_CACHE_SIZE:
+            self._resolved.clear()
+        self._resolved[host] = (now + RESOLVE_CACHE_TTL, family, addr[0])
+        return family, (addr[0], port)
+
+    async def handler(self, reader, writer):
+        frames = FrameReader()
+        replies = FrameWriter(self._loop, writer.write)
+        endpoints = dict()
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                for frame in frames.feed(data):
+                    try:
+                        host, port, offset = parse_address(frame)
+                        if frame[0] == 3:
+                            family, addr = await self._resolve(host, port)
+                        else:
+                            family = (socket.AF_INET if frame[0] == 1
+                                      else socket.AF_INET6)
+                            addr = (host, port)
+                    except (ValueError, OSError) as exc:
+                        self._logger.debug("Dropping datagram: %s", str(exc))
+                        continue
+                    endpoint = endpoints.get(family)
+                    if endpoint is None:
+                        endpoint, _ = await self._loop.create_datagram_endpoint(
+                            partial(_RemoteDatagrams, replies,
+                                    writer.transport),
+                            family=family)
+                        endpoints[family] = endpoint
+                    endpoint.sendto(frame[offset:], addr)
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            raise
+        except ConnectionError:
+            pass
+        except Exception as exc:  # pragma: no cover
+            self._logger.exception("Association handler stopped with "
+                                   "exception: %s", str(exc))
+        finally:
+            for endpoint in endpoints.values():
+                endpoint.close()
+            writer.close()
+
+    async def start(self):
+        def _spawn(reader, writer):
+            def task_cb(task, fut):
+                self._children.discard(task)
+            task = self._loop.create_task(self.handler(reader, writer))
+            self._children.add(task)
+            task.add_done_callback(partial(task_cb, task))
+
+        if self._unix_path is not None:
+            self._server = await asyncio.start_unix_server(_spawn,
+                                                           self._unix_path)
+            self._logger.info("UDP helper listening on %s", self._unix_path)
+        else:
+            self._server = await asyncio.start_server(_spawn,
+                                                      self._listen_address,
+                                                      self._listen_port)
+            self._logger.info("UDP helper listening on %s:%d",
+                              self._listen_address, self._listen_port)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+
+async def amain(args, loop):  # pragma: no cover
+    helper = UDPHelper(listen_address=args.bind_address,
+                       listen_port=args.bind_port,
+                       unix_path=args.unix_socket,
+                       loop=loop)
+    async with helper:
+        exit_event = asyncio.Event()
+        async with utils.Heartbeat():
+            sig_handler = partial(utils.exit_handler, exit_event)
+            signal.signal(signal.SIGTERM, sig_handler)
+            signal.signal(signal.SIGINT, sig_handler)
+            await exit_event.wait()
+
+
+def main():  # pragma: no cover
+    args = parse_args()
+    with utils.AsyncLoggingHandler(args.logfile) as log_handler:
+        utils.setup_logger('UDPHelper', args.verbosity, log_handler)
+        logger = utils.setup_logger('MAIN', args.verbosity, log_handler)
+        if not args.disable_uvloop:
+            utils.enable_uvloop()
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(amain(args, loop))
+        loop.close()
+        logger.info("UDP helper finished its work.")
+
+
+if __name__ == '__main__':
+    main()
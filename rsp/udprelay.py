@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import socket
+
+import asyncssh
+
+from .relay import open_channel
+
+FRAME_LEN_SIZE = 2
+MAX_FRAME = 0xFFFF
+
+
+def pack_address(host, port):
+    """ Encodes address in SOCKS5 ATYP/ADDR/PORT form """
+    try:
+        addr = b'\x01' + socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        try:
+            addr = b'\x04' + socket.inet_pton(socket.AF_INET6, host)
+        except OSError:
+            name = host.encode('idna')
+            addr = b'\x03' + bytes((len(name),)) + name
+    return addr + port.to_bytes(2, 'big')
+
+
+def parse_address(buf, offset=0):
+    """ Decodes SOCKS5 ATYP/ADDR/PORT starting at offset. Returns host,
+    port and offset of first byte after address """
+    try:
+        atyp = buf[offset]
+        if atyp == 1:
+            end = offset + 5
+            host = socket.inet_ntop(socket.AF_INET, bytes(buf[offset + 1:end]))
+        elif atyp == 4:
+            end = offset + 17
+            host = socket.inet_ntop(socket.AF_INET6,
+                                    bytes(buf[offset + 1:end]))
+        elif atyp == 3:
+            end = offset + 2 + buf[offset + 1]
+            host = bytes(buf[offset + 2:end]).decode('idna')
+        else:
+            raise ValueError("Unknown address type %d" % atyp)
+        if len(buf) < end + 2:
+            raise ValueError("Truncated address")
+        port = int.from_bytes(buf[end:end + 2], 'big')
+    except (IndexError, UnicodeError) as exc:
+        raise ValueError("Malformed address") from exc
+    return host, port, end + 2
+
+
+class FrameReader:
+    """ Splits stream into frames prefixed with 16-bit length """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        pos = 0
+        while len(buf) - pos >= FRAME_LEN_SIZE:
+            size = int.from_bytes(buf[pos:pos + FRAME_LEN_SIZE], 'big')
+            end = pos + FRAME_LEN_SIZE + size
+            if len(buf) < end:
+                break
+            yield bytes(buf[pos + FRAME_LEN_SIZE:end])
+            pos = end
+        del buf[:pos]
+
+
+class FrameWriter:
+    """ Collects frames produced during one event loop iteration and sends
+    them with single write. Frames are dropped while writer is paused, as
+    datagram delivery is not guaranteed anyway. """
+
+    __slots__ = ('_loop', '_write', '_frames', '_scheduled', 'paused')
+
+    def __init__(self, loop, write):
+        self._loop = loop
+        self._write = write
+        self._frames = []
+        self._scheduled = False
+        self.paused = False
+
+    def send(self, frame):
+        if self.paused or len(frame) > MAX_FRAME:
+            return
+        self._frames.append(len(frame).to_bytes(FRAME_LEN_SIZE, 'big'))
+        self._frames.append(frame)
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._scheduled = False
+        if self._frames:
+            self._write(b''.join(self._frames))
+            self._frames.clear()
+
+
+class _ClientDatagrams(asyncio.DatagramProtocol):
+    def __init__(self, assoc):
+        self._assoc = assoc
+
+    def datagram_received(self, data, addr):
+        self._assoc._from_client(data, addr)
+
+    def error_received(self, exc):
+        pass
+
+
+class _HelperSession(asyncssh.SSHTCPSession):
+    def __init__(self, assoc):
+        self._assoc = assoc
+        self._frames = FrameReader()
+
+    def data_received(self, data, datatype):
+        for frame in self._frames.feed(data):
+            self._assoc._from_helper(frame)
+
+    def connection_lost(self, exc):
+        self._assoc._finish()
+
+    def pause_writing(self):
+        self._assoc._writer.paused = True
+
+    def resume_writing(self):
+        self._assoc._writer.paused = False
+
+
+class UDPAssociation:
+    """ One SOCKS5 UDP association. Datagrams from client are reframed
+    (SOCKS5 UDP header without RSV and FRAG, prefixed by length) and
+    carried to UDP helper over single SSH channel. Pooled connection is
+    borrowed for lifetime of association. """
+
+    __slots__ = ('_loop', '_logger', '_client_host', '_client_addr',
+                 '_transport', '_chan', '_writer', '_pool', '_conn', '_done')
+
+    def __init__(self, *, client_host, client_port=0, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._client_host = client_host
+        self._client_addr = ((client_host, client_port)
+                             if client_port else None)
+        self._transport = None
+        self._chan = None
+        self._writer = None
+        self._pool = None
+        self._conn = None
+        self._done = self._loop.create_future()
+
+    async def open(self, pool, helper, bind_host, timeout):
+        """ Opens channel to helper, which is either (host, port) tuple or
+        path to UNIX socket on SSH server, and binds local UDP socket.
+        Client host is passed to pool as source for fair queueing. """
+        def opener(conn):
+            if isinstance(helper, str):
+                return conn.create_unix_connection(
+                    lambda: _HelperSession(self), helper)
+            return conn.create_connection(
+                lambda: _HelperSession(self), *helper)
+
+        conn, (self._chan, _) = await open_channel(
+            pool, None, opener, timeout, loop=self._loop,
+            logger=self._logger, source=self._client_host)
+        self._pool, self._conn = pool, conn
+        self._writer = FrameWriter(self._loop, self._chan.write)
+        self._transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: _ClientDatagrams(self), local_addr=(bind_host, 0))
+
+    @property
+    def sockname(self):
+        return self._transport.get_extra_info('sockname')[:2]
+
+    def _from_client(self, data, addr):
+        if self._client_addr is None:
+            if addr[0] != self._client_host:
+                return
+            self._client_addr = addr
+        elif addr[:2] != self._client_addr[:2]:
+            return
+        # RSV(2) FRAG(1) ATYP ADDR PORT DATA; fragments are not supported
+        if len(data) < 4 or data[2] != 0:
+            return
+        self._writer.send(data[3:])
+
+    def _from_helper(self, frame):
+        if self._client_addr is not None:
+            self._transport.sendto(b'\x00\x00\x00' + frame, self._client_addr)
+
+    def _finish(self):
+        if not self._done.done():
+            self._done.set_result(None)
+
+    def close(self):
+        self._finish()
+        if self._transport is not None:
+            self._transport.close()
+        if self._chan is not None:
+            self._chan.close()
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+    async def wait(self):
+        await self._done
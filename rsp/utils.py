@@ -5,6 +5,7 @@ import logging.handlers
 import ssl
 import os
 import queue
+import collections
 import socket
 import ctypes
 
@@ -65,6 +66,74 @@ def check_port(value):
     return ivalue
 
 
+def _check_endpoint(value, default_port, what):
+    def fail():
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid %s address" % (value, what))
+    host, sep, port = value.rpartition(':')
+    if not sep or ']' in port or (':' in host and
+                                  not host.startswith('[')):
+        # Bare IPv6 address has no port, port needs address in brackets
+        host, port = value, str(default_port)
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    if not host:
+        fail()
+    try:
+        port = check_port(port)
+    except argparse.ArgumentTypeError:
+        fail()
+    return host, port
+
+
+def check_upstream(value):
+    return _check_endpoint(value, 22, 'upstream')
+
+
+def check_udp_helper(value):
+    """ Returns UNIX socket path or (host, port) tuple """
+    if value.startswith('/'):
+        return value
+    return _check_endpoint(value, constants.UDP_HELPER_PORT, 'UDP helper')
+
+
+LISTENER_PROTOCOLS = ('socks5', 'http', 'auto', 'transparent', 'tproxy')
+ListenerSpec = collections.namedtuple('ListenerSpec', ('protocol', 'address',
+                                                       'port', 'max_clients',
+                                                       'optimistic'))
+
+
+def check_listener(value):
+    """ Parses PROTOCOL:HOST[:PORT][,OPTION...] listener specification """
+    def fail(reason):
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid listener specification: %s" % (value, reason))
+    spec, *options = value.split(',')
+    protocol, sep, endpoint = spec.partition(':')
+    if not sep or protocol not in LISTENER_PROTOCOLS:
+        fail("protocol must be one of %s" % ", ".join(LISTENER_PROTOCOLS))
+    address, port = _check_endpoint(endpoint, 1080, 'listen')
+    max_clients = None
+    optimistic = False
+    for option in options:
+        name, sep, arg = option.partition('=')
+        if name == 'max-clients' and sep:
+            try:
+                max_clients = check_positive_int(arg)
+            except argparse.ArgumentTypeError:
+                fail("bad max-clients value")
+        elif name == 'optimistic' and not sep and protocol in ('socks5',
+                                                               'auto'):
+            optimistic = True
+        else:
+            fail("unknown option %s" % (option,))
+    return ListenerSpec(protocol, address, port, max_clients, optimistic)
+
+
+def check_dns_server(value):
+    return _check_endpoint(value, 53, 'DNS server')
+
+
 def check_positive_float(value):
     def fail():
         raise argparse.ArgumentTypeError(
@@ -78,6 +147,33 @@ def check_positive_float(value):
     return fvalue
 
 
+RATE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def check_rate(value):
+    """ Parses bytes per second rate with optional K, M or G suffix """
+    def fail():
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid rate" % value)
+    multiplier = RATE_SUFFIXES.get(value[-1:].lower())
+    try:
+        rate = float(value[:-1] if multiplier is not None else value)
+    except ValueError:
+        fail()
+    if rate <= 0:
+        fail()
+    return rate * (multiplier or 1)
+
+
+def check_size(value):
+    """ Parses size in bytes with optional K, M or G suffix """
+    try:
+        return int(check_rate(value))
+    except argparse.ArgumentTypeError:
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid size" % value) from None
+
+
 def check_nonnegative_float(value):
     def fail():
         raise argparse.ArgumentTypeError(
@@ -131,6 +227,19 @@ def exit_handler(exit_event, signum, frame):  # pragma: no cover pylint: disable
         exit_event.set()
 
 
+def reload_handler(reload_event, signum, frame):  # pragma: no cover pylint: disable=unused-argument
+    logging.getLogger('MAIN').warning("Got reload signal! Starting successor.")
+    reload_event.set()
+
+
+class AsyncNullContext:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+
 class Heartbeat:
     def __init__(self, interval=.5):
         self._interval = interval
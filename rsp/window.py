@@ -0,0 +1,109 @@
+import asyncio
+
+from .constants import CHANNEL_WINDOW, CHANNEL_WINDOW_MAX, WINDOW_BUDGET, \
+    WINDOW_RATE_TTL
+from . import metrics
+
+
+class WindowBudget:
+    """ Caps total size of receive windows of relayed channels, which bounds
+    memory SSH servers may fill while clients read slowly. Every channel
+    gets at least default window, only growth beyond it is limited. """
+
+    def __init__(self, *, limit=WINDOW_BUDGET, max_window=CHANNEL_WINDOW_MAX):
+        self._limit = limit
+        self.max_window = max_window
+        self.min_window = min(CHANNEL_WINDOW, max_window)
+        self._used = 0
+        metrics.WINDOW_RESERVED.labels().set_function(lambda: self._used)
+
+    def reserve(self, size, floor=0):
+        """ Grants up to size bytes, but not less than floor """
+        granted = max(min(size, self._limit - self._used), floor)
+        self._used += granted
+        return granted
+
+    def release(self, size):
+        self._used -= size
+
+
+class WindowTuner:
+    """ Sizes receive windows of channels to one upstream to bandwidth-delay
+    product of the path: twice the highest recent delivery rate of a
+    channel times round trip time of connection carrying it """
+
+    def __init__(self, budget, loop=None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.budget = budget
+        self._rate = None
+        self._stamp = None
+        self.grown = metrics.WINDOW_GROWN.labels()
+
+    def report_rate(self, rate):
+        """ Keeps maximum delivery rate seen over WINDOW_RATE_TTL """
+        now = self.loop.time()
+        if (self._rate is None or rate >= self._rate or
+                now - self._stamp > WINDOW_RATE_TTL):
+            self._rate = rate
+            self._stamp = now
+
+    def target(self, rtt):
+        budget = self.budget
+        if self._rate is None or rtt is None:
+            return budget.min_window
+        return int(min(max(2 * self._rate * rtt, budget.min_window),
+                       budget.max_window))
+
+    def window(self, rtt):
+        """ Creates window for new channel. rtt() returns current round
+        trip time estimate of connection carrying it or None. """
+        size = self.budget.reserve(self.target(rtt()), self.budget.min_window)
+        return ChannelWindow(self, rtt, size)
+
+
+class ChannelWindow:
+    """ Receive window of one channel. Delivery rate is sampled every half
+    window of received data, which is when SSH window adjust is sent. If
+    channel delivered at least half of its window per round trip, window
+    was what limited it and it is doubled in flight, so single bulk flow
+    ramps up to path capacity. """
+
+    __slots__ = ('size', '_tuner', '_rtt', '_count', '_stamp')
+
+    def __init__(self, tuner, rtt, size):
+        self._tuner = tuner
+        self._rtt = rtt
+        self.size = size
+        self._count = 0
+        self._stamp = None
+
+    def consume(self, size):
+        """ Accounts received data, returns True if window was grown """
+        self._count += size
+        if self._stamp is None:
+            self._stamp = self._tuner.loop.time()
+            return False
+        if self._count < self.size // 2:
+            return False
+        now = self._tuner.loop.time()
+        elapsed, self._stamp = now - self._stamp, now
+        count, self._count = self._count, 0
+        if elapsed <= 0:
+            return False
+        rate = count / elapsed
+        self._tuner.report_rate(rate)
+        budget = self._tuner.budget
+        rtt = self._rtt()
+        if (rtt is None or rate * rtt < self.size / 2 or
+                self.size >= budget.max_window):
+            return False
+        extra = budget.reserve(min(self.size, budget.max_window - self.size))
+        if not extra:
+            return False
+        self.size += extra
+        self._tuner.grown.inc()
+        return True
+
+    def close(self):
+        self._tuner.budget.release(self.size)
+        self.size = 0
@@ -13,18 +13,19 @@ setup(name='rsp',
       author_email='vladislav-ex-src@vm-0.com',
       license='MIT',
       packages=['rsp'],
-      python_requires='>=3.5.3',
+      python_requires='>=3.7',
       setup_requires=[
           'wheel',
       ],
       install_requires=[
-          'asyncssh>=1.16.0',
+          'asyncssh>=2.12.0,<2.25',
       ],
       extras_require={
           'dev': [
               'setuptools>=38.6.0',
               'wheel>=0.31.0',
               'twine>=1.11.0',
+              'pytest>=3.0',
           ],
           'uvloop': 'uvloop>=0.11.0',
       },
@@ -33,10 +34,12 @@ setup(name='rsp',
               'rsp=rsp.__main__:main',
               'rsp-trust=rsp.trust:main',
               'rsp-keygen=rsp.keygen:main',
+              'rsp-bench=rsp.bench:main',
+              'rsp-udp-helper=rsp.udphelper:main',
           ],
       },
       classifiers=[
-          "Programming Language :: Python :: 3.5",
+          "Programming Language :: Python :: 3.7",
           "License :: OSI Approved :: MIT License",
           "Operating System :: OS Independent",
           "Development Status :: 4 - Beta",
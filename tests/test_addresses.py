@@ -0,0 +1,64 @@
+import socket
+
+import pytest
+
+from rsp.addresses import interleave, race_connect, AddressBook
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def listener():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    yield sock.getsockname()
+    sock.close()
+
+
+def test_interleave():
+    infos = [(socket.AF_INET6, 1, 6, '', ('::1', 22, 0, 0)),
+             (socket.AF_INET6, 1, 6, '', ('::2', 22, 0, 0)),
+             (socket.AF_INET, 1, 6, '', ('127.0.0.1', 22)),
+             (socket.AF_INET, 1, 6, '', ('127.0.0.1', 22))]
+    assert [addr[1][0] for addr in interleave(infos)] == \
+        ['::1', '127.0.0.1', '::2']
+
+
+def test_race_connect_skips_refused(loop, listener):
+    refused = (socket.AF_INET, ('127.0.0.1', closed_port()))
+    good = (socket.AF_INET, listener)
+    reports = []
+    sock, address = loop.run_until_complete(
+        race_connect([refused, good], lambda addr, ok: reports.append(
+            (addr, ok)), loop=loop))
+    sock.close()
+    assert address == good
+    assert (refused, False) in reports and (good, True) in reports
+
+
+def test_race_connect_all_failed(loop):
+    addresses = [(socket.AF_INET, ('127.0.0.1', closed_port()))
+                 for _ in range(2)]
+    with pytest.raises(ConnectionRefusedError):
+        loop.run_until_complete(race_connect(addresses, loop=loop))
+    with pytest.raises(OSError):
+        loop.run_until_complete(race_connect([], loop=loop))
+
+
+def test_failed_address_goes_last(loop):
+    book = AddressBook('localhost', 22, loop=loop)
+    first = (socket.AF_INET, ('127.0.0.1', 22))
+    second = (socket.AF_INET, ('127.0.0.2', 22))
+    book._addresses = [first, second]
+    book._expires = loop.time() + 60
+    book.report(first, False)
+    assert loop.run_until_complete(book.candidates()) == [second, first]
+    book.report(first, True)
+    assert loop.run_until_complete(book.candidates()) == [first, second]
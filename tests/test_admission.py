@@ -0,0 +1,50 @@
+import pytest
+
+from rsp.admission import FairQueue, ClientLimiter
+
+
+def test_fair_queue_round_robin():
+    queue = FairQueue()
+    for item in ('a1', 'a2', 'a3'):
+        queue.append('a', item)
+    queue.append('b', 'b1')
+    queue.append('c', 'c1')
+    queue.append('c', 'c2')
+    assert len(queue) == 6
+    assert queue.count('a') == 3 and queue.count('d') == 0
+    assert [queue.popleft() for _ in range(6)] == \
+        ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+    with pytest.raises(IndexError):
+        queue.popleft()
+
+
+def test_fair_queue_remove():
+    queue = FairQueue()
+    queue.append('a', 'a1')
+    queue.append('b', 'b1')
+    queue.remove('a', 'a1')
+    queue.remove('a', 'a1')
+    queue.remove('b', 'missing')
+    assert len(queue) == 1 and queue.count('a') == 0
+    assert queue.popleft() == 'b1'
+    assert not queue
+
+
+def test_client_limiter():
+    limiter = ClientLimiter(max_clients=3, max_clients_per_source=2)
+    assert limiter.admit('a') and limiter.admit('a')
+    assert not limiter.admit('a')
+    assert limiter.admit('b')
+    assert not limiter.admit('c')
+    assert len(limiter) == 3
+    limiter.leave('a')
+    assert limiter.admit('c')
+    assert not limiter.admit('b')
+    limiter.leave('c')
+    assert limiter.admit('a')
+
+
+def test_client_limiter_unlimited():
+    limiter = ClientLimiter()
+    assert all(limiter.admit('a') for _ in range(100))
+    assert len(limiter) == 100
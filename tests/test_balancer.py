@@ -0,0 +1,79 @@
+from rsp.balancer import PoolBalancer
+
+
+class StubPool:
+    def __init__(self, name, latency=1., load=0, healthy=True):
+        self.name = name
+        self.latency = latency
+        self.load = load
+        self.healthy = healthy
+        self.conns = set()
+        self.released = []
+        self.discarded = []
+
+    async def get(self, dst=None, source=None):
+        conn = (self.name, len(self.conns))
+        self.conns.add(conn)
+        return conn
+
+    def is_alive(self, conn):
+        return conn in self.conns
+
+    def release(self, conn):
+        self.released.append(conn)
+
+    def discard(self, conn):
+        self.conns.discard(conn)
+        self.discarded.append(conn)
+
+
+class StubAffinity:
+    def __init__(self, preferred):
+        self._preferred = preferred
+
+    def preferred(self, dst):
+        return self._preferred.get(dst)
+
+
+def test_scores_latency_with_load(loop):
+    fast = StubPool('fast', latency=.1, load=9)
+    slow = StubPool('slow', latency=.5)
+    balancer = PoolBalancer([fast, slow])
+    conn = loop.run_until_complete(balancer.get())
+    assert slow.is_alive(conn)
+    fast.load = 0
+    conn = loop.run_until_complete(balancer.get())
+    assert fast.is_alive(conn)
+
+
+def test_unhealthy_pool_avoided(loop):
+    sick = StubPool('sick', latency=.1, healthy=False)
+    well = StubPool('well', latency=1.)
+    balancer = PoolBalancer([sick, well])
+    for _ in range(10):
+        assert well.is_alive(loop.run_until_complete(balancer.get()))
+    well.healthy = False
+    assert sick.is_alive(loop.run_until_complete(balancer.get()))
+
+
+def test_release_goes_to_owner(loop):
+    first, second = StubPool('first'), StubPool('second')
+    balancer = PoolBalancer([first, second])
+    conn = loop.run_until_complete(first.get())
+    balancer.release(conn)
+    balancer.release(('stale', 0))
+    assert first.released == [conn] and second.released == []
+    balancer.discard(conn)
+    assert first.discarded == [conn]
+    assert not balancer.is_alive(conn)
+
+
+def test_affinity_picks_owner(loop):
+    fast, slow = StubPool('fast', latency=.1), StubPool('slow', latency=1.)
+    owned = loop.run_until_complete(slow.get())
+    balancer = PoolBalancer([fast, slow],
+                            affinity=StubAffinity({'example.com': owned}))
+    conn = loop.run_until_complete(balancer.get('example.com'))
+    assert slow.is_alive(conn)
+    conn = loop.run_until_complete(balancer.get('example.org'))
+    assert fast.is_alive(conn)
@@ -0,0 +1,49 @@
+from rsp.constants import AFFINITY_MAX_BYTES
+from rsp.deststats import DestinationStats
+
+
+def test_lru_bound(loop):
+    stats = DestinationStats(size=2, loop=loop)
+    stats.report_open('a', 'conn', .1)
+    stats.report_open('b', 'conn', .1)
+    stats.report_open('a', 'conn', .1)
+    stats.report_open('c', 'conn', .1)
+    assert len(stats) == 2
+    assert stats.preferred('a') == 'conn'
+    assert stats.preferred('b') is None
+
+
+def test_binding_expires(loop):
+    stats = DestinationStats(ttl=0, loop=loop)
+    stats.report_open('a', 'conn', .1)
+    assert stats.preferred('a') is None
+
+
+def test_slow_or_busy_binding_released(loop):
+    stats = DestinationStats(loop=loop)
+    stats.report_open('slow', 'conn', .1)
+    for _ in range(20):
+        stats.report_open('slow', 'conn', 1.)
+    assert stats.preferred('slow') is None
+    stats.report_open('bulk', 'conn', .1)
+    stats.report_bytes('bulk', AFFINITY_MAX_BYTES, 1)
+    assert stats.preferred('bulk') is None
+
+
+def test_failing_destination_stays(loop):
+    stats = DestinationStats(loop=loop)
+    stats.report_open('bad', 'first', .1)
+    for _ in range(10):
+        stats.report_failure('bad', 'first')
+    stats.report_bytes('bad', AFFINITY_MAX_BYTES, 1)
+    assert stats.preferred('bad') == 'first'
+
+
+def test_rebind_and_forget(loop):
+    stats = DestinationStats(loop=loop)
+    stats.report_open('a', 'first', .1)
+    stats.report_bytes('a', AFFINITY_MAX_BYTES, 1)
+    stats.report_open('a', 'second', 1.)
+    assert stats.preferred('a') == 'second'
+    stats.forget('second')
+    assert stats.preferred('a') is None
@@ -0,0 +1,126 @@
+import asyncio
+import os
+import socket
+import time
+
+from rsp import handoff
+from rsp.asdnotify import AsyncSystemdNotifier
+from rsp.metricslistener import MetricsListener
+
+
+def listening(host='127.0.0.1'):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    sock.listen()
+    return sock
+
+
+def datagram(name):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind('\0' + name)
+    sock.settimeout(1)
+    return sock
+
+
+def test_listen_fds(monkeypatch):
+    sock = listening()
+    try:
+        monkeypatch.setattr(handoff, 'LISTEN_FDS_START', sock.fileno())
+        monkeypatch.setenv('LISTEN_FDS', '1')
+        monkeypatch.setenv('LISTEN_PID', str(os.getpid() + 1))
+        assert handoff.listen_fds() == []
+        monkeypatch.setenv('LISTEN_PID', str(os.getpid()))
+        inherited, = handoff.listen_fds()
+        assert inherited.fileno() == sock.fileno()
+        assert 'LISTEN_FDS' not in os.environ
+        assert 'LISTEN_PID' not in os.environ
+        inherited.detach()
+    finally:
+        sock.close()
+
+
+def test_take_socket():
+    first, second = listening(), listening()
+    try:
+        sockets = [first, second]
+        port = second.getsockname()[1]
+        assert handoff.take_socket(sockets, '127.0.0.1', port) is second
+        assert handoff.take_socket(sockets, '127.0.0.1', port) is None
+        assert handoff.take_socket(sockets, 'localhost',
+                                   first.getsockname()[1]) is first
+        assert not sockets
+    finally:
+        first.close()
+        second.close()
+
+
+def test_listener_serves_inherited_socket(loop):
+    sock = listening()
+    port = sock.getsockname()[1]
+
+    async def test():
+        listener = MetricsListener(listen_address='127.0.0.1',
+                                   listen_port=port, sock=sock, loop=loop)
+        async with listener:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.1\r\n\r\n')
+            assert (await reader.readline()).startswith(b'HTTP/1.1 200 ')
+            writer.close()
+
+    loop.run_until_complete(test())
+
+
+def test_notify_ready(loop):
+    name = 'rsp-test-%d' % (os.getpid(),)
+    systemd = datagram(name + '-systemd')
+    predecessor = datagram(name + '-predecessor')
+
+    async def test():
+        async with AsyncSystemdNotifier('@' + name + '-systemd') as notifier:
+            await handoff.notify_ready(notifier, '@' + name + '-predecessor')
+
+    try:
+        loop.run_until_complete(test())
+        assert systemd.recv(4096) == b'MAINPID=%d\nREADY=1' % (os.getpid(),)
+        assert predecessor.recv(4096) == b'READY=1'
+    finally:
+        systemd.close()
+        predecessor.close()
+
+
+def test_spawn_successor(loop, monkeypatch):
+    def ready(sockets, notify_addr):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.sendto(b'STATUS=warming\nREADY=1', '\0' + notify_addr[1:])
+        time.sleep(.5)
+
+    def failed(sockets, notify_addr):
+        pass
+
+    monkeypatch.setattr(handoff, '_exec_successor', ready)
+    assert loop.run_until_complete(handoff.spawn_successor([], 5, loop))
+    os.wait()
+    monkeypatch.setattr(handoff, '_exec_successor', failed)
+    assert not loop.run_until_complete(handoff.spawn_successor([], 5, loop))
+
+
+def test_wait_exit(loop):
+    async def test():
+        exit_event, reload_event = asyncio.Event(), asyncio.Event()
+        loop.call_soon(exit_event.set)
+        return await handoff.wait_exit(exit_event, reload_event, [], 1, loop)
+
+    assert loop.run_until_complete(test()) is False
+
+
+def test_wait_warm(loop, monkeypatch):
+    class Pool:
+        warm = False
+
+    pool = Pool()
+    monkeypatch.setattr(handoff, 'WARMUP_POLL', .01)
+    loop.call_later(.05, setattr, pool, 'warm', True)
+    loop.run_until_complete(handoff.wait_warm(pool, 5, loop))
+    assert pool.warm
+    pool.warm = False
+    loop.run_until_complete(handoff.wait_warm(pool, 0, loop))
@@ -0,0 +1,239 @@
+import asyncio
+
+import pytest
+
+from rsp.httplistener import parse_head, body_length, split_authority, \
+    split_absolute_uri, HttpError, HttpListener, CHUNKED, UNTIL_CLOSE, \
+    _BodyFramer
+from rsp.routing import Route
+
+
+def headers(*lines):
+    return parse_head(b'\r\n'.join((b'GET / HTTP/1.1',) + lines) +
+                      b'\r\n\r\n')[1]
+
+
+def test_parse_head():
+    start, hdrs = parse_head(b'GET http://example.com/ HTTP/1.1\r\n'
+                             b'Host: example.com\r\n'
+                             b'X-Test : a: b\r\n\r\n')
+    assert start == [b'GET', b'http://example.com/', b'HTTP/1.1']
+    assert hdrs == [(b'host', b'Host: example.com'),
+                    (b'x-test', b'X-Test : a: b')]
+
+
+def test_parse_head_errors():
+    with pytest.raises(HttpError):
+        parse_head(b'GET /\r\n\r\n')
+    with pytest.raises(HttpError):
+        parse_head(b'GET / HTTP/1.1\r\nNo colon\r\n\r\n')
+
+
+def test_body_length():
+    assert body_length(headers(), 0) == 0
+    assert body_length(headers(), UNTIL_CLOSE) == UNTIL_CLOSE
+    assert body_length(headers(b'Content-Length: 42'), 0) == 42
+    assert body_length(headers(b'Content-Length: 42, 42',
+                               b'Content-Length: 42'), 0) == 42
+    assert body_length(headers(b'Transfer-Encoding: gzip',
+                               b'Transfer-Encoding: Chunked'), 0) == CHUNKED
+    assert body_length(headers(b'Transfer-Encoding: chunked, gzip'),
+                       UNTIL_CLOSE) == UNTIL_CLOSE
+
+
+@pytest.mark.parametrize('lines', [
+    (b'Content-Length: -1',),
+    (b'Content-Length: +1',),
+    (b'Content-Length: 0x10',),
+    (b'Content-Length: 1 2',),
+    (b'Content-Length:',),
+    (b'Content-Length: 42', b'Content-Length: 43'),
+    (b'Content-Length: 42, 43',),
+    (b'Transfer-Encoding: chunked', b'Content-Length: 42'),
+    (b'Transfer-Encoding: chunked, gzip',),
+    (b'Transfer-Encoding: xchunked',),
+])
+def test_body_length_ambiguous(lines):
+    with pytest.raises(ValueError):
+        body_length(headers(*lines), 0)
+
+
+def test_split_authority():
+    assert split_authority(b'example.com', 80) == ('example.com', 80)
+    assert split_authority(b'user@example.com:8080', 80) == \
+        ('example.com', 8080)
+    assert split_authority(b'[::1]:443', None) == ('::1', 443)
+    for authority in (b'example.com', b'example.com:0', b':80'):
+        with pytest.raises(HttpError):
+            split_authority(authority, None)
+
+
+def test_split_absolute_uri():
+    assert split_absolute_uri(b'http://example.com') == \
+        (b'example.com', b'/')
+    assert split_absolute_uri(b'HTTP://example.com:81/a?b') == \
+        (b'example.com:81', b'/a?b')
+    assert split_absolute_uri(b'http://example.com?q') == \
+        (b'example.com', b'/?q')
+    with pytest.raises(HttpError):
+        split_absolute_uri(b'https://example.com/')
+
+
+def test_framer_fixed():
+    framer = _BodyFramer(5)
+    assert framer.feed(b'abc') == 3 and not framer.done
+    assert framer.feed(b'deGET') == 2 and framer.done
+    assert _BodyFramer(0).done
+
+
+def test_framer_chunked():
+    body = b'5;ext=1\r\nhello\r\nA \r\n0123456789\r\n0\r\nX: y\r\n\r\n'
+    framer = _BodyFramer(CHUNKED)
+    for pos, byte in enumerate(body):
+        assert not framer.done
+        assert framer.feed(bytes((byte,))) == 1
+    assert framer.done
+    framer = _BodyFramer(CHUNKED)
+    assert framer.feed(body + b'next') == len(body)
+
+
+@pytest.mark.parametrize('body', [
+    b'-5\r\nhello\r\n',
+    b'0x5\r\nhello\r\n',
+    b'\r\n',
+    b'5\nhello\r\n',
+    b'5\r\nhello!\r\n',
+    b'1' * 17 + b'\r\n',
+])
+def test_framer_malformed_chunked(body):
+    with pytest.raises(ValueError):
+        _BodyFramer(CHUNKED).feed(body)
+
+
+class DirectRouter:
+    def route(self, host, addr=None):
+        return Route.direct
+
+
+class Origin:
+    """ HTTP server with handful of canned responses """
+
+    def __init__(self):
+        self.connections = 0
+
+    async def handler(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                path = head.split(b' ')[1]
+                length = body_length(parse_head(head)[1], 0)
+                if length == CHUNKED:
+                    body = b''
+                    while True:
+                        size = int(await reader.readline(), 16)
+                        body += (await reader.readexactly(size + 2))[:-2]
+                        if not size:
+                            break
+                else:
+                    body = await reader.readexactly(length)
+                if path == b'/echo':
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n'
+                                 b'\r\n%s' % (len(body), body))
+                elif path == b'/chunked':
+                    writer.write(b'HTTP/1.1 100 Continue\r\n\r\n'
+                                 b'HTTP/1.1 200 OK\r\n'
+                                 b'Transfer-Encoding: chunked\r\n\r\n'
+                                 b'5\r\nhello\r\n0\r\n\r\n')
+                elif path == b'/upgrade':
+                    writer.write(b'HTTP/1.1 101 Switching Protocols\r\n\r\n')
+                    while True:
+                        data = await reader.read(4096)
+                        if not data:
+                            break
+                        writer.write(data)
+                    break
+                else:
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: x\r\n'
+                                 b'\r\n')
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+
+def run_proxy(loop, test):
+    async def main():
+        origin = Origin()
+        server = await asyncio.start_server(origin.handler, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        proxy = HttpListener(listen_address='127.0.0.1', listen_port=0,
+                             pool=None, router=DirectRouter(), loop=loop)
+        async with proxy:
+            reader, writer = await asyncio.open_connection(
+                *proxy.sockets[0].getsockname()[:2])
+            try:
+                await asyncio.wait_for(
+                    test(reader, writer, b'http://127.0.0.1:%d' % port), 5)
+            finally:
+                writer.close()
+        server.close()
+        return origin
+    return loop.run_until_complete(main())
+
+
+async def response(reader):
+    interim = b''
+    head = await reader.readuntil(b'\r\n\r\n')
+    while head.split(b' ')[1].startswith(b'1'):
+        interim += head
+        head = await reader.readuntil(b'\r\n\r\n')
+    length = body_length(parse_head(head)[1], 0)
+    if length == CHUNKED:
+        return interim + head, await reader.readuntil(b'0\r\n\r\n')
+    return interim + head, await reader.readexactly(length)
+
+
+def test_proxy_keeps_upstream(loop):
+    async def test(reader, writer, origin):
+        writer.write(b'POST %s/echo HTTP/1.1\r\nContent-Length: 4\r\n\r\n'
+                     b'ping'
+                     b'GET %s/chunked HTTP/1.1\r\n\r\n'
+                     b'POST %s/echo HTTP/1.1\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n'
+                     b'4\r\npong\r\n0\r\n\r\n' % (origin, origin, origin))
+        assert (await response(reader))[1] == b'ping'
+        head, body = await response(reader)
+        assert head.startswith(b'HTTP/1.1 100 Continue\r\n\r\n')
+        assert body == b'5\r\nhello\r\n0\r\n\r\n'
+        assert (await response(reader))[1] == b'pong'
+    assert run_proxy(loop, test).connections == 1
+
+
+def test_proxy_rejects_ambiguous_request(loop):
+    async def test(reader, writer, origin):
+        writer.write(b'POST %s/echo HTTP/1.1\r\nContent-Length: 4\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n' % origin)
+        assert (await reader.readline()).startswith(b'HTTP/1.1 400 ')
+    assert run_proxy(loop, test).connections == 0
+
+
+def test_proxy_bad_response(loop):
+    async def test(reader, writer, origin):
+        writer.write(b'GET %s/bad HTTP/1.1\r\n\r\n' % origin)
+        assert (await reader.readline()).startswith(b'HTTP/1.1 502 ')
+    run_proxy(loop, test)
+
+
+def test_proxy_upgrade(loop):
+    async def test(reader, writer, origin):
+        writer.write(b'GET %s/upgrade HTTP/1.1\r\nConnection: upgrade\r\n'
+                     b'\r\nearly' % origin)
+        assert b' 101 ' in await reader.readuntil(b'\r\n\r\n')
+        assert await reader.readexactly(5) == b'early'
+        writer.write(b'later')
+        assert await reader.readexactly(5) == b'later'
+        writer.write_eof()
+        assert await reader.read() == b''
+    run_proxy(loop, test)
@@ -0,0 +1,68 @@
+import asyncio
+
+from rsp.metrics import Registry
+from rsp.metricslistener import MetricsListener
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.counter('test_total', 'Counter', ('name',))
+    counter.labels('a"b').inc(2)
+    assert counter.labels('a"b') is counter.labels('a"b')
+    gauge = registry.gauge('test_gauge', 'Gauge')
+    gauge.labels().set_function(lambda: 1.5)
+    hist = registry.histogram('test_seconds', 'Histogram', buckets=(.1, 1.))
+    hist.labels().observe(.5)
+    hist.labels().observe(5)
+    assert registry.render().decode().split('\n') == [
+        '# HELP test_total Counter',
+        '# TYPE test_total counter',
+        'test_total{name="a\\"b"} 2',
+        '# HELP test_gauge Gauge',
+        '# TYPE test_gauge gauge',
+        'test_gauge 1.5',
+        '# HELP test_seconds Histogram',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 0',
+        'test_seconds_bucket{le="1"} 1',
+        'test_seconds_bucket{le="+Inf"} 2',
+        'test_seconds_sum 5.5',
+        'test_seconds_count 2',
+        '',
+    ]
+
+
+def test_remove():
+    registry = Registry()
+    gauge = registry.gauge('test_gauge', 'Gauge', ('name',))
+    gauge.labels('gone').set(1)
+    gauge.remove('gone')
+    assert b'gone' not in registry.render()
+
+
+def test_listener(loop):
+    registry = Registry()
+    registry.counter('test_total', 'Counter').labels().inc()
+
+    async def request(port, line):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(line + b'\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def test():
+        listener = MetricsListener(listen_address='127.0.0.1',
+                                   listen_port=0, registry=registry,
+                                   loop=loop)
+        async with listener:
+            port = listener.sockets[0].getsockname()[1]
+            response = await request(port, b'GET /metrics HTTP/1.1')
+            assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+            assert response.endswith(b'\r\n\r\n' + registry.render())
+            response = await request(port, b'GET /other HTTP/1.1')
+            assert response.startswith(b'HTTP/1.1 404 ')
+            response = await request(port, b'POST /metrics HTTP/1.1')
+            assert response.startswith(b'HTTP/1.1 405 ')
+
+    loop.run_until_complete(test())
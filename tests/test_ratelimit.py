@@ -0,0 +1,43 @@
+import asyncio
+
+from rsp.ratelimit import TokenBucket
+
+
+def test_burst(loop):
+    async def main():
+        bucket = TokenBucket(1, burst=3, loop=loop)
+        for _ in range(3):
+            await asyncio.wait_for(bucket.wait(), .01)
+        assert bucket.queue_depth == 0
+        waiter = loop.create_task(bucket.wait())
+        await asyncio.sleep(0)
+        assert bucket.queue_depth == 1
+        waiter.cancel()
+        await asyncio.wait((waiter,))
+    loop.run_until_complete(main())
+
+
+def test_rate(loop):
+    async def main():
+        bucket = TokenBucket(100, loop=loop)
+        started = loop.time()
+        for _ in range(6):
+            await bucket.wait()
+        return loop.time() - started
+    assert loop.run_until_complete(main()) >= .045
+
+
+def test_cancelled_waiters_leave_queue(loop):
+    async def main():
+        bucket = TokenBucket(100, loop=loop)
+        await bucket.wait()
+        waiters = [loop.create_task(bucket.wait()) for _ in range(4)]
+        await asyncio.sleep(0)
+        assert bucket.queue_depth == 4
+        for waiter in waiters[:3]:
+            waiter.cancel()
+        await asyncio.wait(waiters[:3])
+        assert bucket.queue_depth == 1
+        await waiters[3]
+        assert bucket.queue_depth == 0
+    loop.run_until_complete(main())
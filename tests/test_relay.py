@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import socket
+import struct
+
+import asyncssh
+import pytest
+
+from rsp.relay import open_channel, Relay
+from rsp.ssh_pool import is_transport_failure
+
+
+class StubPool:
+    """ Hands out given connections and records what happened to them """
+
+    def __init__(self, loop, conns):
+        self._loop = loop
+        self._conns = list(conns)
+        self.released = []
+        self.discarded = []
+        self.failed = []
+        self.opened = []
+
+    async def get(self, dst=None, source=None):
+        if not self._conns:
+            await self._loop.create_future()
+        return self._conns.pop(0)
+
+    def release(self, conn):
+        self.released.append(conn)
+
+    def discard(self, conn):
+        self.discarded.append(conn)
+
+    def is_alive(self, conn):
+        return conn not in self.discarded
+
+    def report_failure(self, conn, dst=None):
+        self.failed.append(conn)
+
+    def report_open(self, conn, latency, dst=None):
+        self.opened.append(conn)
+
+
+def opener(outcomes):
+    async def open_(conn):
+        outcome = outcomes[conn]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+    return open_
+
+
+def run_open(loop, pool, outcomes, timeout=1):
+    return loop.run_until_complete(open_channel(
+        pool, 'example.com', opener(outcomes), timeout, loop=loop,
+        logger=logging.getLogger('test')))
+
+
+def test_transport_failure():
+    assert is_transport_failure(ConnectionResetError())
+    assert is_transport_failure(asyncssh.ChannelOpenError(
+        asyncssh.OPEN_CONNECT_FAILED, 'SSH connection closed'))
+    assert not is_transport_failure(asyncssh.ChannelOpenError(
+        asyncssh.OPEN_CONNECT_FAILED, 'Connection refused'))
+
+
+def test_retry_on_dead_connection(loop):
+    pool = StubPool(loop, ['dead', 'live'])
+    outcomes = {'dead': ConnectionResetError(), 'live': 'chan'}
+    assert run_open(loop, pool, outcomes) == ('live', 'chan')
+    assert pool.discarded == ['dead']
+    assert pool.opened == ['live']
+
+
+def test_retry_on_resource_shortage(loop):
+    pool = StubPool(loop, ['busy', 'live'])
+    outcomes = {'busy': asyncssh.ChannelOpenError(
+        asyncssh.OPEN_RESOURCE_SHORTAGE, 'No channels'), 'live': 'chan'}
+    assert run_open(loop, pool, outcomes) == ('live', 'chan')
+    assert pool.released == ['busy']
+    assert pool.failed == ['busy']
+
+
+def test_refused_not_retried(loop):
+    pool = StubPool(loop, ['live', 'other'])
+    outcomes = {'live': asyncssh.ChannelOpenError(
+        asyncssh.OPEN_CONNECT_FAILED, 'Connection refused')}
+    with pytest.raises(asyncssh.ChannelOpenError):
+        run_open(loop, pool, outcomes)
+    assert pool.released == ['live']
+    assert pool.discarded == []
+
+
+def test_timeout_covers_pool_wait(loop):
+    pool = StubPool(loop, [])
+    started = loop.time()
+    with pytest.raises(asyncio.TimeoutError):
+        run_open(loop, pool, {}, timeout=.05)
+    assert loop.time() - started < 1
+
+
+def run_relay(loop, upstream_handler, client_test, before_attach=None):
+    """ Serves client with relay to direct connection to upstream """
+    async def main():
+        tasks = []
+
+        def tracked(handler):
+            async def run(reader, writer):
+                tasks.append(asyncio.current_task())
+                await handler(reader, writer)
+            return run
+
+        upstream = await asyncio.start_server(tracked(upstream_handler),
+                                              '127.0.0.1', 0)
+        port = upstream.sockets[0].getsockname()[1]
+
+        async def handler(reader, writer):
+            relay = Relay(loop=loop)
+            await relay.open_direct('127.0.0.1', port, 1)
+            if before_attach is not None:
+                await before_attach(relay)
+            relay.attach(reader, writer)
+            await relay.wait()
+
+        listener = await asyncio.start_server(tracked(handler),
+                                              '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(
+            *listener.sockets[0].getsockname()[:2])
+        try:
+            await asyncio.wait_for(client_test(reader, writer), 2)
+        finally:
+            writer.close()
+            listener.close()
+            upstream.close()
+            done, _ = await asyncio.wait(tasks, timeout=1)
+        assert len(done) == len(tasks) == 2
+    loop.run_until_complete(main())
+
+
+async def echo(reader, writer):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+def test_relay_echo_half_close(loop):
+    async def client(reader, writer):
+        writer.write(b'early')
+        data = b'x' * 1000000
+        writer.write(data)
+        writer.write_eof()
+        assert await reader.readexactly(5) == b'early'
+        assert await reader.readexactly(len(data)) == data
+        assert await reader.read() == b''
+    run_relay(loop, echo, client)
+
+
+def test_attach_after_upstream_eof(loop):
+    async def hello(reader, writer):
+        writer.write(b'hello')
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+
+    async def wait_eof(relay):
+        while not relay._eof_from_upstream:
+            await asyncio.sleep(.01)
+
+    async def client(reader, writer):
+        assert await reader.read() == b'hello'
+    run_relay(loop, hello, client, wait_eof)
+
+
+def test_attach_after_upstream_reset(loop):
+    async def hello(reader, writer):
+        writer.write(b'hello')
+        await asyncio.sleep(.1)
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                        struct.pack('ii', 1, 0))
+        writer.close()
+
+    async def wait_done(relay):
+        await relay.wait()
+
+    async def client(reader, writer):
+        assert await reader.read() == b'hello'
+    run_relay(loop, hello, client, wait_done)
@@ -0,0 +1,186 @@
+import asyncio
+import socket
+import struct
+
+import pytest
+
+from rsp.resolver import Resolver, HostNotFound, DNS_HEADER, DNS_RR, \
+    QTYPE_A, QTYPE_AAAA, QTYPE_SOA, RCODE_NXDOMAIN, build_query, \
+    parse_response
+
+
+def answer(query, rcode=0, addresses=(), ttl=60, negative_ttl=None):
+    """ Builds response to query with answer section pointing at question
+    name and optional SOA record in authority section """
+    qid, = struct.unpack_from('!H', query)
+    question = query[DNS_HEADER.size:]
+    records = b''
+    for address in addresses:
+        family, qtype = ((socket.AF_INET6, QTYPE_AAAA) if ':' in address
+                         else (socket.AF_INET, QTYPE_A))
+        rdata = socket.inet_pton(family, address)
+        records += b'\xc0\x0c' + DNS_RR.pack(qtype, 1, ttl, len(rdata)) + \
+            rdata
+    authority = b''
+    if negative_ttl is not None:
+        rdata = b'\x00\x00' + struct.pack('!IIIII', 1, 0, 0, 0, negative_ttl)
+        authority = b'\xc0\x0c' + DNS_RR.pack(QTYPE_SOA, 1, 3600,
+                                              len(rdata)) + rdata
+    return (DNS_HEADER.pack(qid, 0x8180 | rcode, 1, len(addresses),
+                            1 if authority else 0, 0) +
+            question + records + authority)
+
+
+def qname(query):
+    labels = []
+    pos = DNS_HEADER.size
+    while query[pos]:
+        labels.append(query[pos + 1:pos + 1 + query[pos]].decode())
+        pos += 1 + query[pos]
+    return '.'.join(labels)
+
+
+class DNSServer:
+    """ Answers queries over TCP from zone dict: name -> list of addresses.
+    Names missing from zone get NXDOMAIN. """
+
+    def __init__(self, zone):
+        self.zone = zone
+        self.queries = []
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(2), 'big')
+                query = await reader.readexactly(size)
+                qtype, = struct.unpack_from('!H', query, size - 4)
+                name = qname(query)
+                self.queries.append((name, qtype))
+                if name in self.zone:
+                    addresses = [address for address in self.zone[name]
+                                 if (':' in address) == (qtype == QTYPE_AAAA)]
+                    msg = answer(query, addresses=addresses)
+                else:
+                    msg = answer(query, RCODE_NXDOMAIN, negative_ttl=30)
+                writer.write(len(msg).to_bytes(2, 'big') + msg)
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+
+class StreamConn:
+    async def open_connection(self, host, port):
+        return await asyncio.open_connection(host, port)
+
+
+class StubPool:
+    def __init__(self):
+        self.conn = StreamConn()
+        self.released = []
+        self.discarded = []
+
+    async def get(self, dst=None, source=None):
+        return self.conn
+
+    def is_alive(self, conn):
+        return True
+
+    def release(self, conn):
+        self.released.append(conn)
+
+    def discard(self, conn):
+        self.discarded.append(conn)
+
+
+def run_resolver(loop, zone, test, **kw):
+    async def main():
+        server = DNSServer(zone)
+        listener = await asyncio.start_server(server.handler,
+                                              '127.0.0.1', 0)
+        pool = StubPool()
+        resolver = Resolver(pool=pool,
+                            server=listener.sockets[0].getsockname()[:2],
+                            timeout=1, loop=loop, **kw)
+        try:
+            async with resolver:
+                await test(resolver)
+        finally:
+            listener.close()
+        assert pool.released == [pool.conn]
+        return server
+    return loop.run_until_complete(main())
+
+
+def test_parse_response():
+    query = build_query(7, 'example.com', QTYPE_A)
+    assert parse_response(answer(query, addresses=('192.0.2.1', '192.0.2.2'),
+                                 ttl=30)) == \
+        (0, ['192.0.2.1', '192.0.2.2'], 30, None)
+    assert parse_response(answer(query, RCODE_NXDOMAIN, negative_ttl=5)) == \
+        (RCODE_NXDOMAIN, [], None, 5)
+
+
+def test_resolve_caches(loop):
+    async def test(resolver):
+        assert await resolver.resolve('192.0.2.9') == '192.0.2.9'
+        assert await resolver.resolve('example.com') == '192.0.2.1'
+        assert await resolver.resolve('Example.COM') == '192.0.2.1'
+        assert await resolver.resolve('v6.example.com') == '2001:db8::1'
+        for _ in range(2):
+            with pytest.raises(HostNotFound):
+                await resolver.resolve('missing.example.com')
+    server = run_resolver(loop, {'example.com': ['192.0.2.1'],
+                                 'v6.example.com': ['2001:db8::1']}, test)
+    assert server.queries == [('example.com', QTYPE_A),
+                              ('v6.example.com', QTYPE_A),
+                              ('v6.example.com', QTYPE_AAAA),
+                              ('missing.example.com', QTYPE_A)]
+
+
+def test_resolve_shares_lookup(loop):
+    async def test(resolver):
+        results = await asyncio.gather(*(resolver.resolve('example.com')
+                                         for _ in range(5)))
+        assert results == ['192.0.2.1'] * 5
+    server = run_resolver(loop, {'example.com': ['192.0.2.1']}, test)
+    assert len(server.queries) == 1
+
+
+def test_cache_bounded(loop):
+    zone = {'%d.example.com' % i: ['192.0.2.%d' % i] for i in range(3)}
+
+    async def test(resolver):
+        for name in ('0.example.com', '1.example.com', '0.example.com',
+                     '2.example.com', '0.example.com', '1.example.com'):
+            await resolver.resolve(name)
+    server = run_resolver(loop, zone, test, cache_size=2)
+    # 1 is least recently used when 2 arrives and gets evicted
+    assert [name for name, _ in server.queries] == [
+        '0.example.com', '1.example.com', '2.example.com', '1.example.com']
+
+
+def test_cache_expires(loop):
+    async def test(resolver):
+        await resolver.resolve('example.com')
+        expires, address = resolver._cache['example.com']
+        resolver._cache['example.com'] = (loop.time(), address)
+        await resolver.resolve('example.com')
+    server = run_resolver(loop, {'example.com': ['192.0.2.1']}, test)
+    assert len(server.queries) == 2
+
+
+def test_unreachable_server(loop):
+    async def main():
+        listener = await asyncio.start_server(lambda r, w: w.close(),
+                                              '127.0.0.1', 0)
+        address = listener.sockets[0].getsockname()[:2]
+        listener.close()
+        await listener.wait_closed()
+        pool = StubPool()
+        async with Resolver(pool=pool, server=address, timeout=1,
+                            loop=loop) as resolver:
+            assert await resolver.resolve('example.com') is None
+        # Refused connection looks like dead transport
+        assert pool.discarded == [pool.conn] and not pool.released
+    loop.run_until_complete(main())
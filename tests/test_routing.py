@@ -0,0 +1,107 @@
+import asyncio
+import ipaddress
+
+import pytest
+
+from rsp.routing import PrefixTrie, SuffixTrie, RoutingTable, Route, \
+    Router, load_rules, parse_ip
+
+
+def test_parse_ip():
+    assert parse_ip('example.com') is None
+    assert parse_ip('10.0.0.1') == ipaddress.ip_address('10.0.0.1')
+    assert parse_ip('::ffff:10.0.0.1') == ipaddress.ip_address('10.0.0.1')
+
+
+def test_prefix_trie_longest_match():
+    trie = PrefixTrie()
+    trie.insert(ipaddress.ip_network('10.0.0.0/8'), 'wide')
+    trie.insert(ipaddress.ip_network('10.1.0.0/16'), 'narrow')
+    assert trie.lookup(ipaddress.ip_address('10.1.2.3')) == 'narrow'
+    assert trie.lookup(ipaddress.ip_address('10.2.2.3')) == 'wide'
+    assert trie.lookup(ipaddress.ip_address('11.0.0.1')) is None
+
+
+def test_prefix_trie_default_route():
+    trie = PrefixTrie()
+    trie.insert(ipaddress.ip_network('::/0'), 'any')
+    assert trie.lookup(ipaddress.ip_address('2001:db8::1')) == 'any'
+
+
+def test_suffix_trie():
+    trie = SuffixTrie()
+    trie.insert('example.com', 'parent')
+    trie.insert('a.example.com', 'child')
+    assert trie.lookup('example.com') == 'parent'
+    assert trie.lookup('b.example.com') == 'parent'
+    assert trie.lookup('x.a.example.com') == 'child'
+    assert trie.lookup('notexample.com') is None
+    assert trie.lookup('com') is None
+
+
+def test_table_route():
+    table = RoutingTable()
+    table.add('*.Example.COM.', Route.direct)
+    table.add('192.168.0.0/16', Route.reject)
+    table.add('2001:db8::/32', Route.direct)
+    assert table.size == 3
+    assert table.route('www.example.com') is Route.direct
+    assert table.route('192.168.1.1') is Route.reject
+    assert table.route('2001:db8::5') is Route.direct
+    assert table.route('other.org') is Route.tunnel
+    # resolved address is checked when name matched nothing
+    assert table.route('other.org', '192.168.1.1') is Route.reject
+    assert table.route('example.com', '192.168.1.1') is Route.direct
+
+
+def test_table_default():
+    table = RoutingTable()
+    table.add('*', Route.reject)
+    assert table.route('anything') is Route.reject
+
+
+def test_table_bad_pattern():
+    with pytest.raises(ValueError):
+        RoutingTable().add('example.com/8', Route.direct)
+
+
+def test_load_rules(tmp_path):
+    path = tmp_path / 'routes.txt'
+    path.write_text("# comment\n"
+                    "direct lan 10.0.0.0/8  # inline comment\n"
+                    "\n"
+                    "REJECT ads.example.com\n")
+    table = load_rules(str(path))
+    assert table.size == 3
+    assert table.route('printer.lan') is Route.direct
+    assert table.route('10.1.1.1') is Route.direct
+    assert table.route('ads.example.com') is Route.reject
+    assert table.route('example.com') is Route.tunnel
+
+
+@pytest.mark.parametrize('text', ['bounce example.com\n', 'direct\n',
+                                  'direct .\n'])
+def test_load_rules_errors(tmp_path, text):
+    path = tmp_path / 'routes.txt'
+    path.write_text(text)
+    with pytest.raises(ValueError, match=':1:'):
+        load_rules(str(path))
+
+
+def test_router_reload(loop, tmp_path):
+    path = tmp_path / 'routes.txt'
+    path.write_text("direct example.com\n")
+
+    async def main():
+        router = Router(path=str(path), check_interval=.01, loop=loop)
+        router.load()
+        async with router:
+            assert router.route('example.com') is Route.direct
+            path.write_text("reject example.com\n# changed\n")
+            await asyncio.sleep(.1)
+            assert router.route('example.com') is Route.reject
+            # broken file keeps previous rules
+            path.write_text("bounce example.com\n")
+            await asyncio.sleep(.1)
+            assert router.route('example.com') is Route.reject
+    loop.run_until_complete(main())
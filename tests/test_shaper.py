@@ -0,0 +1,117 @@
+from rsp.shaper import Shaper
+from rsp.constants import SHAPER_QUANTUM
+
+
+class Timer:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Clock:
+    """ Stands in for event loop: time moves only when advanced """
+
+    def __init__(self):
+        self.now = 0.
+        self.timers = []
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback):
+        timer = Timer(self.now + delay, callback)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, delay):
+        self.now += delay
+        due = sorted((timer for timer in self.timers
+                      if timer.when <= self.now and not timer.cancelled),
+                     key=lambda timer: timer.when)
+        self.timers = [timer for timer in self.timers
+                       if timer not in due and not timer.cancelled]
+        for timer in due:
+            timer.callback()
+
+
+class Switch:
+    def __init__(self):
+        self.paused = 0
+        self.resumed = 0
+
+    def pause(self):
+        self.paused += 1
+
+    def resume(self):
+        self.resumed += 1
+
+
+def open_flow(shaper, source='127.0.0.1'):
+    switch = Switch()
+    return shaper.flow(source, switch.pause, switch.resume), switch
+
+
+def test_client_rate():
+    clock = Clock()
+    flow, switch = open_flow(Shaper(client_rate=1000, loop=clock))
+    flow.charge(200)
+    assert not flow.paused
+    flow.charge(100)
+    assert flow.paused and switch.paused == 1
+    flow.charge(1000)
+    assert switch.paused == 1
+    clock.advance(.5)
+    assert flow.paused
+    clock.advance(1)
+    assert not flow.paused and switch.resumed == 1
+    flow.close()
+
+
+def test_source_rate_serves_interactive_flows():
+    clock = Clock()
+    shaper = Shaper(source_rate=1000, loop=clock)
+    bulk, bulk_switch = open_flow(shaper)
+    light, light_switch = open_flow(shaper)
+    other, _ = open_flow(shaper, '127.0.0.2')
+    bulk.charge(300)
+    assert not bulk.paused
+    bulk.charge(SHAPER_QUANTUM)
+    assert bulk.paused
+    light.charge(100)
+    other.charge(200)
+    assert not light.paused and not other.paused
+    clock.advance(SHAPER_QUANTUM / 1000 + 1)
+    assert not bulk.paused and bulk_switch.resumed == 1
+    assert light_switch.paused == 0
+
+
+def test_total_rate():
+    clock = Clock()
+    shaper = Shaper(total_rate=1000, loop=clock)
+    first, _ = open_flow(shaper, '127.0.0.1')
+    second, _ = open_flow(shaper, '127.0.0.2')
+    first.charge(SHAPER_QUANTUM + 1)
+    assert first.paused
+    second.charge(SHAPER_QUANTUM + 1)
+    assert second.paused
+
+
+def test_close_releases_source():
+    clock = Clock()
+    shaper = Shaper(client_rate=1000, source_rate=1000, loop=clock)
+    first, first_switch = open_flow(shaper)
+    second, _ = open_flow(shaper)
+    assert len(shaper._sources) == 1
+    first.charge(SHAPER_QUANTUM + 1)
+    assert first.paused
+    first.close()
+    assert not first.paused
+    clock.advance(1000)
+    assert first_switch.resumed == 0
+    assert len(shaper._sources) == 1
+    second.close()
+    assert not shaper._sources
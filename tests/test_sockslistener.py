@@ -0,0 +1,58 @@
+import pytest
+
+from rsp.sockslistener import parse_greeting, parse_request, BadVersion, \
+    BadAuthMethod, BadAddress, UnsupportedCommand, UnsupportedAddress
+
+
+def test_greeting_incomplete():
+    assert parse_greeting(b'') is None
+    assert parse_greeting(b'\x05') is None
+    assert parse_greeting(b'\x05\x02\x00') is None
+
+
+def test_greeting():
+    assert parse_greeting(b'\x05\x01\x00') == 3
+    assert parse_greeting(b'\x05\x02\x02\x00\x05\x01') == 4
+
+
+def test_greeting_errors():
+    with pytest.raises(BadVersion):
+        parse_greeting(b'\x04\x01\x00')
+    with pytest.raises(BadAuthMethod):
+        parse_greeting(b'\x05\x00')
+    with pytest.raises(BadAuthMethod):
+        parse_greeting(b'\x05\x01\x02')
+
+
+def test_request_ipv4():
+    buf = b'\x05\x01\x00' + b'\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x50data'
+    assert parse_request(buf, 3) == (1, '127.0.0.1', 80, len(buf) - 4)
+
+
+def test_request_ipv6():
+    buf = b'\x05\x01\x00\x04' + b'\x00' * 15 + b'\x01\x01\xbb'
+    assert parse_request(buf, 0) == (1, '::1', 443, len(buf))
+
+
+def test_request_domain():
+    buf = b'\x05\x03\x00\x03\x0bexample.com\x00\x35'
+    assert parse_request(buf, 0) == (3, 'example.com', 53, len(buf))
+
+
+def test_request_incomplete():
+    buf = b'\x05\x01\x00\x03\x0bexample.com\x00\x35'
+    for size in range(len(buf)):
+        assert parse_request(buf[:size], 0) is None
+
+
+def test_request_errors():
+    with pytest.raises(BadVersion):
+        parse_request(b'\x04\x01\x00\x01\x7f\x00\x00\x01\x00\x50', 0)
+    with pytest.raises(UnsupportedCommand):
+        parse_request(b'\x05\x04\x00\x01\x7f\x00\x00\x01\x00\x50', 0)
+    with pytest.raises(UnsupportedAddress):
+        parse_request(b'\x05\x01\x00\x02\x7f\x00\x00\x01\x00\x50', 0)
+    with pytest.raises(BadAddress):
+        parse_request(b'\x05\x01\x00\x03\x00\x00\x50', 0)
+    with pytest.raises(BadAddress):
+        parse_request(b'\x05\x01\x00\x03\x01\xff\x00\x50', 0)
@@ -0,0 +1,191 @@
+import asyncio
+
+import pytest
+
+from rsp.admission import PoolOverloaded
+from rsp.ssh_pool import SSHPool
+from rsp.ratelimit import Ratelimit
+
+
+class FakeConn:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+
+class FakePool(SSHPool):
+    """ Pool which builds fake connections instantly """
+
+    def __init__(self, **kwargs):
+        super().__init__(dst_address='127.0.0.1', dst_port=22,
+                         ratelimit=Ratelimit(1000, loop=kwargs['loop']),
+                         **kwargs)
+        self.built = []
+
+    async def _connect(self):
+        conn = FakeConn()
+        self.built.append(conn)
+        return conn
+
+
+def run_pool(loop, test, **kwargs):
+    async def main():
+        pool = FakePool(loop=loop, **kwargs)
+        async with pool:
+            while not pool.warm:
+                await asyncio.sleep(0)
+            await test(pool)
+    loop.run_until_complete(main())
+
+
+def test_borrow_release(loop):
+    async def test(pool):
+        assert pool.spare == 2
+        first = await pool.get()
+        second = await pool.get()
+        assert first is not second
+        assert pool.load == 2
+        pool.release(first)
+        pool.release(second)
+        assert pool.load == 0
+        assert pool.spare >= 2
+        assert not first.closed and not second.closed
+    run_pool(loop, test, size=2)
+
+
+def test_shared_channels(loop):
+    async def test(pool):
+        conns = [await pool.get() for _ in range(3)]
+        assert len(set(conns)) == 1
+        assert pool.load == 3
+        for conn in conns:
+            pool.release(conn)
+        assert pool.load == 0
+        assert pool.spare == 1
+    run_pool(loop, test, size=1, max_channels=3)
+
+
+def test_waiter_served(loop):
+    async def test(pool):
+        conn = await pool.get()
+        waiter = loop.create_task(pool.get())
+        await asyncio.sleep(0)
+        assert pool.load == 2
+        pool.release(conn)
+        assert await waiter is not None
+        assert pool.load == 1
+    run_pool(loop, test, size=1)
+
+
+def test_cancelled_waiter_is_forgotten(loop):
+    async def test(pool):
+        conn = await pool.get()
+        waiter = loop.create_task(pool.get())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.wait((waiter,))
+        assert pool.load == 1
+        pool.release(conn)
+        assert pool.load == 0
+    run_pool(loop, test, size=1)
+
+
+def test_waiters_limited(loop):
+    async def test(pool):
+        conn = await pool.get()
+        waiters = [loop.create_task(pool.get(source=source))
+                   for source in ('a', 'b', 'b')]
+        await asyncio.sleep(0)
+        assert waiters[2].done()
+        with pytest.raises(PoolOverloaded):
+            waiters[2].result()
+        with pytest.raises(PoolOverloaded):
+            await pool.get(source='c')
+        pool.release(conn)
+        assert await waiters[0] is conn
+        waiters[1].cancel()
+        await asyncio.wait((waiters[1],))
+    run_pool(loop, test, size=1, max_waiters=2, max_waiters_per_source=1)
+
+
+def test_release_twice(loop):
+    async def test(pool):
+        conn = await pool.get()
+        other = await pool.get()
+        pool.release(conn)
+        pool.release(conn)
+        assert pool.load == 1
+        pool.release(other)
+        assert pool.load == 0
+    run_pool(loop, test, size=2)
+
+
+def test_discard(loop):
+    async def test(pool):
+        conn = await pool.get()
+        pool.discard(conn)
+        assert conn.closed
+        assert not pool.is_alive(conn)
+        assert pool.load == 0
+        # release after discard is ignored
+        pool.release(conn)
+        assert pool.load == 0
+    run_pool(loop, test, size=1)
+
+
+def test_expired_shared_conn_retires(loop):
+    async def test(pool):
+        old = await pool.get()
+        # age connection past its lifetime and let health loop run
+        pool._state[old].born -= 10  # pylint: disable=protected-access
+        await asyncio.sleep(.1)
+        assert not old.closed
+        fresh = await pool.get()
+        assert fresh is not old
+        pool.release(old)
+        assert old.closed
+        pool.release(fresh)
+        assert pool.load == 0
+    run_pool(loop, test, size=1, max_channels=2, check_interval=.01,
+             max_lifetime=5)
+
+
+def test_idle_reserve_conn_recycled(loop):
+    async def test(pool):
+        first = pool.built[0]
+        await asyncio.sleep(.2)
+        assert first.closed
+        assert pool.warm
+    run_pool(loop, test, size=1, check_interval=.01, max_idle=.05)
+
+
+def test_backoff_counts_build_attempts(loop):
+    pool = FakePool(loop=loop, backoff=1)
+    pool._failures = 10
+    for attempts, low, high in ((1, .5, 1), (3, 2, 4), (20, 30, 60)):
+        for _ in range(20):
+            assert low <= pool._backoff_delay(attempts) <= high
+
+
+def test_autoscale_follows_demand(loop):
+    async def test(pool):
+        pool._window.append((100, 1, 0))
+        pool._autoscale()
+        assert pool._size == 4
+        while len(pool._reserve) < 4:
+            await asyncio.sleep(0)
+        for size in (3, 2, 1, 1):
+            pool._window.clear()
+            pool._window.append((0, 0, 0))
+            pool._autoscale()
+            assert pool._size == size
+            assert len(pool._reserve) == size
+        pool._window.append((0, 0, 3))
+        pool._autoscale()
+        assert pool._size == 3
+    run_pool(loop, test, size=1, min_size=1, max_size=4)
@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from rsp.udprelay import pack_address, parse_address, FrameReader, \
+    FrameWriter, UDPAssociation
+from rsp.udphelper import UDPHelper
+
+
+def frame(data):
+    return len(data).to_bytes(2, 'big') + data
+
+
+class EchoDatagrams(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+class FakeChannel:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConn:
+    def __init__(self):
+        self.chan = FakeChannel()
+
+    async def create_connection(self, factory, host, port):
+        session = factory()
+        return self.chan, session
+
+
+class SourcePool:
+    """ Records source of every get() and returned connections """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.sources = []
+        self.released = []
+
+    async def get(self, dst=None, source=None):
+        self.sources.append(source)
+        return self._conn
+
+    def release(self, conn):
+        self.released.append(conn)
+
+    def report_open(self, conn, latency, dst=None):
+        pass
+
+
+@pytest.mark.parametrize('host', ['127.0.0.1', '::1', 'example.com'])
+def test_address_roundtrip(host):
+    buf = b'\x00' + pack_address(host, 53) + b'data'
+    assert parse_address(buf, 1) == (host, 53, len(buf) - 4)
+
+
+def test_address_errors():
+    for buf in (b'', b'\x02\x00', b'\x01\x7f\x00\x00\x01\x00',
+                b'\x03\x0bexample', b'\x03\x01\xff\x00\x35'):
+        with pytest.raises(ValueError):
+            parse_address(buf)
+
+
+def test_frame_reader_reassembles():
+    reader = FrameReader()
+    stream = frame(b'first') + frame(b'') + frame(b'second')
+    frames = []
+    for pos in range(0, len(stream), 3):
+        frames.extend(reader.feed(stream[pos:pos + 3]))
+    assert frames == [b'first', b'', b'second']
+
+
+def test_frame_writer_coalesces(loop):
+    writes = []
+    writer = FrameWriter(loop, writes.append)
+    writer.send(b'one')
+    writer.send(b'two')
+    writer.paused = True
+    writer.send(b'dropped')
+    writer.paused = False
+    writer.send(b'x' * 0x10000)
+    loop.run_until_complete(asyncio.sleep(0))
+    assert writes == [frame(b'one') + frame(b'two')]
+
+
+def test_association_queues_as_client(loop):
+    conn = FakeConn()
+    pool = SourcePool(conn)
+    assoc = UDPAssociation(client_host='127.0.0.1', loop=loop)
+    loop.run_until_complete(assoc.open(pool, ('localhost', 1081),
+                                       '127.0.0.1', 1))
+    assert pool.sources == ['127.0.0.1']
+    assert assoc.sockname[0] == '127.0.0.1'
+    assoc.close()
+    assert conn.chan.closed
+    assert pool.released == [conn]
+
+
+def test_association_bind_failure(loop):
+    conn = FakeConn()
+    pool = SourcePool(conn)
+    assoc = UDPAssociation(client_host='127.0.0.1', loop=loop)
+    with pytest.raises(OSError):
+        loop.run_until_complete(assoc.open(pool, ('localhost', 1081),
+                                           '192.0.2.1', 1))
+    assoc.close()
+    assert pool.released == [conn]
+
+
+def test_helper_relays_datagrams(loop, tmp_path):
+    path = str(tmp_path / 'helper.sock')
+
+    async def test():
+        echo, _ = await loop.create_datagram_endpoint(
+            EchoDatagrams, local_addr=('127.0.0.1', 0))
+        port = echo.get_extra_info('sockname')[1]
+        try:
+            async with UDPHelper(unix_path=path, loop=loop):
+                reader, writer = await asyncio.open_unix_connection(path)
+                addr = pack_address('127.0.0.1', port)
+                writer.write(frame(addr + b'ping') + frame(addr + b'pong'))
+                frames = FrameReader()
+                replies = []
+                while len(replies) < 2:
+                    data = await asyncio.wait_for(reader.read(4096), 1)
+                    assert data
+                    replies.extend(frames.feed(data))
+                writer.close()
+        finally:
+            echo.close()
+        for reply, payload in zip(replies, (b'ping', b'pong')):
+            host, reply_port, offset = parse_address(reply)
+            assert (host, reply_port) == ('127.0.0.1', port)
+            assert reply[offset:] == payload
+
+    loop.run_until_complete(test())
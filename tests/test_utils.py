@@ -0,0 +1,42 @@
+import argparse
+
+import pytest
+
+from rsp.utils import check_listener, check_upstream, ListenerSpec
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('example.com', ('example.com', 22)),
+    ('example.com:2222', ('example.com', 2222)),
+    ('10.0.0.1:2222', ('10.0.0.1', 2222)),
+    ('::1', ('::1', 22)),
+    ('2001:db8::1', ('2001:db8::1', 22)),
+    ('[::1]', ('::1', 22)),
+    ('[::1]:2222', ('::1', 2222)),
+])
+def test_endpoint(value, expected):
+    assert check_upstream(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', ':22', 'example.com:0',
+                                   'example.com:http', '[::1]:70000'])
+def test_bad_endpoint(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        check_upstream(value)
+
+
+def test_listener():
+    assert check_listener('socks5:127.0.0.1') == ListenerSpec(
+        'socks5', '127.0.0.1', 1080, None, False)
+    assert check_listener('auto:[::]:3128,max-clients=10,optimistic') == \
+        ListenerSpec('auto', '::', 3128, 10, True)
+    assert check_listener('http:::1').address == '::1'
+
+
+@pytest.mark.parametrize('value', ['socks4:127.0.0.1', '127.0.0.1',
+                                   'http:127.0.0.1,optimistic',
+                                   'socks5:127.0.0.1,max-clients=0',
+                                   'socks5:127.0.0.1,bogus'])
+def test_bad_listener(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        check_listener(value)
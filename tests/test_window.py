@@ -0,0 +1,64 @@
+from unittest import mock
+
+import asyncssh
+
+from rsp.window import WindowBudget, WindowTuner
+
+
+class FakeLoop:
+    def __init__(self):
+        self.now = 0.
+
+    def time(self):
+        return self.now
+
+
+def make_window(rtt=.1):
+    loop = FakeLoop()
+    tuner = WindowTuner(WindowBudget(limit=1 << 30, max_window=1 << 28),
+                        loop=loop)
+    return loop, tuner.window(lambda: rtt)
+
+
+def test_budget_floor():
+    budget = WindowBudget(limit=100, max_window=1000)
+    assert budget.reserve(80) == 80
+    assert budget.reserve(80) == 20
+    assert budget.reserve(80, floor=50) == 50
+    budget.release(150)
+    assert budget.reserve(80) == 80
+
+
+def test_first_chunk_counted():
+    loop, window = make_window()
+    half = window.size // 2
+    assert not window.consume(half - 1)
+    loop.now += .01
+    # fast delivery of half window grows it right away
+    assert window.consume(1)
+
+
+def test_slow_channel_not_grown():
+    loop, window = make_window()
+    size = window.size
+    window.consume(1)
+    loop.now += 100
+    assert not window.consume(size)
+    assert window.size == size
+
+
+def test_close_releases_budget():
+    loop, window = make_window()
+    budget = window._tuner.budget  # pylint: disable=protected-access
+    window.close()
+    assert budget.reserve(1 << 30) == 1 << 30
+
+
+def test_asyncssh_channel_window_attribute():
+    # window growth relies on this private attribute of asyncssh channels
+    conn = mock.Mock()
+    conn.add_channel.return_value = 0
+    chan = asyncssh.SSHTCPChannel(conn, None, None, 'strict', 1024, 1024)
+    assert chan.get_recv_window() == 1024
+    chan._init_recv_window = 4096  # pylint: disable=protected-access
+    assert chan.get_recv_window() == 4096